@@ -2,16 +2,55 @@
 #
 # Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
 
+import importlib
 import logging
 import os
 
-from kegwasher.actions import *
-from kegwasher.config import *
-from kegwasher.hardware import *
-from kegwasher.linked_list import *
-from kegwasher.operations import *
-from kegwasher.pca955x import *
-from kegwasher.service import *
+# Public names and the submodule each lives in. Submodules are imported on first access, so importing
+# the package is cheap and touches no hardware; drivers load when a backend is first used.
+_exports = {
+    'Action': 'actions',
+    'ControlServer': 'api', 'Progress': 'api', 'Snapshot': 'api',
+    'GPIO': 'backend', 'GPIOConstants': 'backend', 'backends': 'backend',
+    'CancellationToken': 'cancellation',
+    'Clock': 'clock', 'VirtualClock': 'clock', 'from_speed': 'clock',
+    'mode_config': 'config', 'pin_config': 'config', 'service_config': 'config',
+    'Dispatcher': 'dispatcher',
+    'BufferedDisplay': 'hardware', 'Display': 'hardware', 'Expander': 'hardware', 'HardwareObject': 'hardware',
+    'Heater': 'hardware', 'Pump': 'hardware', 'Switch': 'hardware', 'Valve': 'hardware',
+    'I2CBus': 'i2c',
+    'InputProcessor': 'inputs',
+    'Journal': 'journal', 'resume_point': 'journal',
+    'CircularDoublyLinkedList': 'linked_list', 'Node': 'linked_list',
+    'Counter': 'metrics', 'Exporter': 'metrics', 'Gauge': 'metrics', 'Histogram': 'metrics', 'Metric': 'metrics',
+    'Registry': 'metrics', 'registry': 'metrics',
+    'Operations': 'operations', 'batched': 'operations',
+    'optimize_modes': 'optimizer', 'optimize_program': 'optimizer',
+    'Program': 'programs', 'Step': 'programs', 'compile_program': 'programs', 'compile_programs': 'programs',
+    'ResourceScheduler': 'scheduler',
+    'KegWasher': 'service',
+    'SimulatedCharLCD': 'simulation', 'SimulatedGPIO': 'simulation', 'SimulatedPCA9555': 'simulation',
+    'SimulatedSMBus': 'simulation', 'Simulation': 'simulation',
+    'StartupReport': 'startup',
+    'State': 'state',
+    'Stations': 'stations',
+    'Telemetry': 'telemetry',
+    'FileWatcher': 'watch'
+}
+
+__all__ = sorted(_exports)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'{__name__}.{_exports[name]}'), name)
+    globals()[name] = value
+    return value
 
 
 #  Setup Logging
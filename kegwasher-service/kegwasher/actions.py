@@ -2,13 +2,11 @@
 #
 # Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
 
-import ctypes
 import logging
 import os
 import threading
-import time
 
-from kegwasher.exceptions import AbortException
+from kegwasher import clock, metrics
 
 log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
 
@@ -17,26 +15,23 @@ class Action(threading.Thread):
     def __init__(self, *args, **kwargs):
         threading.Thread.__init__(self)
         self._action = kwargs.get('action')
+        self._clock = kwargs.get('clock', clock.real)
+        # Debounced switch event behind this action: press, long_press, repeat, asserted or cleared
+        self._event = kwargs.get('event', None)
         self._hardware = kwargs.get('hardware', None)
+        self._journal = kwargs.get('journal', None)
+        # Steps ending later than this many seconds after their deadline are logged
+        self._max_overrun = kwargs.get('max_overrun', 1)
         self._modes = kwargs.get('modes', None)
         self._operations = kwargs.get('operations', None)
+        self._scheduler = kwargs.get('scheduler', None)
         self._state = kwargs.get('state', None)
+        self._station = kwargs.get('station', None)
         self._threads = kwargs.get('threads', None)
+        # Clock time of the switch interrupt that caused this action, if any
+        self._submitted = kwargs.get('submitted', None)
         #
-        self._mode_operation_map = {
-            'air_fill_closed': self._operations.air_fill_closed,
-            'air_fill_open':   self._operations.air_fill_open,
-            'all_off_closed':  self._operations.all_off_closed,
-            'clean_closed':    self._operations.clean_closed,
-            'clean_open':      self._operations.clean_open,
-            'cleaner_fill':    self._operations.cleaner_fill,
-            'co2_fill_closed': self._operations.co2_fill_closed,
-            'co2_fill_open':   self._operations.co2_fill_open,
-            'drain':           self._operations.drain,
-            'rinse':           self._operations.rinse,
-            'sanitize':        self._operations.sanitize,
-            'sanitizer_fill':  self._operations.sanitizer_fill
-        }
+        self._mode_operation_map = self._operations.operation_map
 
     def _remove_abort_state(self):
         self._state['aborted'] = False
@@ -44,112 +39,223 @@ class Action(threading.Thread):
         self._state['status'] = 'initialize'
 
     def _set_abort_state(self):
+        # Cancel first, the running program must not switch anything back on after all-off
+        if self._state.get('token', None):
+            self._state['token'].cancel()
         self._operations.all_off_closed()
         self._state['aborted'] = True
         self._state['button_lock'] = True
         self._state['status'] = 'aborted'
 
-    def get_tid(self):
-        if hasattr(self, '_thread_id'):
-            return self._thread_id
-        for id, thread in threading._active.items():
-            if thread is self:
-                return id
-
-    def abort_thread(self):
-        tid = self.get_tid()
-        res = ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, ctypes.py_object(SystemExit))
-        if res > 1:
-            ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, 0)
-            raise AbortException('Halting Thread')
-
     def abort(self):
-        if self._state['aborted'] and not self._hardware.get('switches').get('abort').state:
+        # The abort switch is closed in its run position, without a switch event its level is read directly
+        if self._event in ('asserted', 'cleared'):
+            cleared = self._event == 'cleared'
+        else:
+            cleared = bool(self._hardware.get('switches').get('abort').state)
+        if self._state['aborted'] and not cleared:
             log.debug(f'Already Aborted, passing')
             pass
-        elif self._hardware.get('switches').get('abort').state:
+        elif cleared:
             log.debug(f'Abort switch reset, resuming operation')
             self._remove_abort_state()
         else:
             log.debug(f'Aborting')
             self._set_abort_state()
-            for t in self._threads:
-                if t is self:
-                    log.debug('Abort thread itself is not committing suicide')
-                else:
-                    log.debug(f'Shooting thread {t.get_tid()} in the head')
-                    t.abort_thread()
-                    self._threads.remove(t)
+            if self._submitted is not None:
+                metrics.abort_latency.labels(self._station).observe(self._clock.monotonic() - self._submitted)
             self._hardware.get('display').clear()
             self._hardware.get('display').message(f'Aborted  ======>\nReset Abort SW')
 
+    def _resumable(self):
+        progress = self._state.get('progress', None)
+        return progress is not None and progress['mode'] is self._modes.data
+
     def display_mode_select(self):
-        log.debug(f'Select Mode: {self._modes.data["display_name"]}')
+        log.debug(f'Select Mode: {self._modes.data.display_name}')
+        title = 'Resume Mode' if self._resumable() else 'Select Mode'
         self._hardware.get('display').clear()
-        self._hardware.get('display').message(f'Select Mode\n{self._modes.data["display_name"]}')
+        self._hardware.get('display').message(f'{title}\n{self._modes.data.display_name}')
+        self._state['ready'] = True
 
     def enter(self):
-        if self._hardware.get('switches').get('enter').state:
-            self._state['enter_button_press_time'] = time.monotonic()
-            log.debug(f'Enter button pressed at {self._state["enter_button_press_time"]}')
+        # A press of any length, holding the button down doesn't repeat it
+        if self._event == 'repeat':
+            return
+        log.debug(f'Enter button {self._event}')
+        if self._state['status'] == 'execute_complete':
+            pass
+        elif self._state['status'] == 'select_mode':
+            log.debug('Executing Mode')
+            self._state['button_lock'] = True
+            self._state['status'] = 'execute_mode'
         else:
-            delta = time.monotonic() - self._state['enter_button_press_time']
-            self._state['enter_button_press_time'] = 0
-            log.debug(f'Enter button released, held for {round(delta, 3)} seconds')
-            if self._state['status'] == 'execute_complete':
-                pass
-            elif self._state['status'] == 'select_mode':
-                log.debug('Executing Mode')
-                self._state['button_lock'] = True
-                self._state['status'] = 'execute_mode'
-            else:
-                log.warn(f'Controller in unknown status {self._state["status"]} ignoring interrupt')
+            log.warn(f'Controller in unknown status {self._state["status"]} ignoring interrupt')
 
     def execute_mode(self):
-        log.debug(f'Executing Mode: {self._modes.data["display_name"]}')
-        operations = self._modes.data.get('operations')
-        for cmd, t in operations:
+        try:
+            self._execute_mode()
+        finally:
+            # Devices are off by now, whether the program completed or was cancelled
+            if self._scheduler:
+                self._scheduler.release(self._station)
+
+    def _execute_mode(self):
+        token = self._state.get('token')
+        program = self._modes.data
+        # Pick up where a paused-then-aborted run of this mode stopped, otherwise start from the top
+        if self._resumable():
+            step, remaining = self._state['progress']['step'], self._state['progress']['remaining']
+            log.debug(f'Resuming Mode: {program.display_name} at step {step}, {remaining} seconds left')
+        else:
+            step, remaining = 0, None
+            log.debug(f'Executing Mode: {program.display_name}')
+        self._state['progress'] = None
+        token.program = program
+        if self._journal:
+            self._journal.begin(program, step)
+        # Running time (pauses taken out) at which the previous step was due to end
+        deadline = None
+        for index in range(step, len(program.steps)):
+            cmd, handler, t = program.steps[index][:3]
             log.debug(f'Cmd: {cmd}, time: {t}')
-            self._mode_operation_map[cmd]()
-            for i in range(0, t):
+            if index != step or not remaining:
+                remaining = t
+            token.step, token.progress = index, (cmd, remaining)
+            if self._journal:
+                self._journal.step(index, cmd, t - remaining)
+            reserving = token.running_time
+            if not self._reserve(token, cmd):
+                return self._cancelled(program, index, remaining)
+            waited = token.running_time - reserving
+            if not token.apply(handler):
+                return self._cancelled(program, index, remaining)
+            self._state.notify()
+            if self._scheduler:
+                self._scheduler.settle(self._station, self._operations.resources[cmd])
+            started, whole = token.running_time, remaining == t
+            # Every second of the step is due at an absolute time counted from where the previous step was due to
+            # end, plus any wait for shared utilities. Display writes, I/O and late wake-ups delay one tick at
+            # most, they don't add up over a step or over the program. A step that starts later than max_overrun
+            # behind (a stalled bus, say) starts over from now rather than being cut short to catch up.
+            start = token.running_time
+            if deadline is not None and start - (deadline + waited) <= self._max_overrun:
+                start = deadline + waited
+            end = start + remaining
+            while remaining > 0:
                 self._hardware.get('display').clear()
-                self._hardware.get('display').message(f'{cmd}\nTime Left: {t - i}')
-                time.sleep(1)
+                self._hardware.get('display').message(f'{cmd}\n{self._eta(program, index, remaining)}')
+                if not token.wait_until(end - remaining + 1):
+                    return self._cancelled(program, index, remaining)
+                remaining -= 1
+                token.progress = (cmd, remaining)
+                # Wakes the run loop to publish the new step and countdown
+                self._state.notify()
+                if self._journal:
+                    self._journal.progress(index, t - remaining)
+            deadline = end
+            overrun = max(token.running_time - end, 0)
+            metrics.step_overrun.labels(self._station, cmd).observe(overrun)
+            if overrun > self._max_overrun:
+                log.warning(f'Step {index} {cmd} of {program.display_name} ended {round(overrun, 3)}s late')
+            # A resumed step only ran for part of its configured time, so only whole steps are recorded.
+            # Running time leaves out pauses, the step took as long as it was switched on.
+            if whole:
+                metrics.step_seconds.labels(self._station, cmd).observe(token.running_time - started)
         self._mode_operation_map.get('all_off_closed')()
+        if self._journal:
+            self._journal.end()
         self._state['status'] = 'execute_complete'
         self._state['button_lock'] = False
         self._hardware.get('display').clear()
         self._hardware.get('display').message(f'Operations Done\nPress Enter')
 
+    def _reserve(self, token, cmd, idle=False):
+        # Wait for the shared utilities the step needs, other stations may be using them. idle is for a paused
+        # station, whose devices are off and which holds nothing already.
+        if not self._scheduler:
+            return True
+        needs = self._operations.resources[cmd]
+        if self._scheduler.try_acquire(self._station, needs):
+            return True
+        # Never wait while holding anything, switch off and give back the previous step's utilities first
+        if not idle:
+            if not token.apply(self._mode_operation_map['all_off_closed']):
+                return False
+            self._scheduler.release(self._station)
+        self._hardware.get('display').clear()
+        self._hardware.get('display').message(f'{cmd}\nWaiting...')
+        return self._scheduler.acquire(self._station, needs, token)
+
+    def _cancelled(self, program, step, remaining):
+        log.info(f'Mode {program.display_name} cancelled at step {step} with {remaining} seconds left')
+        if self._journal:
+            self._journal.cancel(step, program.steps[step].seconds - remaining)
+        self._state['progress'] = {'mode': program, 'step': step, 'remaining': remaining}
+
+    @staticmethod
+    def _eta(program, index, remaining):
+        # Second display line: step seconds left, program percent done and program time left as m:ss
+        minutes, seconds = divmod(program.remaining(index, remaining), 60)
+        return f'{remaining:>4}s {program.percent(index, remaining):>3}% {minutes:>2}:{seconds:02}'
+
     def initialize(self):
-        log.debug(f'Executing Mode: {self._modes.data["display_name"]}')
+        log.debug(f'Executing Mode: {self._modes.data.display_name}')
         if not self._hardware.get('switches').get('abort').state:
             self._set_abort_state()
             self._hardware.get('display').clear()
             self._hardware.get('display').message(f'Reset Abort SW\nto activate ===>')
-        if self._state['status'] is not 'aborted':
+        if self._state['status'] != 'aborted':
             self._state['status'] = 'post_initialize'
 
     def mode(self):
-        if self._hardware.get('switches').get('mode').state:
-            log.debug('Button Press')
-            self._state['mode_button_press_time'] = time.monotonic()
+        # A short press moves to the next mode, a long press and every repeat while held go back one
+        log.debug(f'Mode button {self._event}')
+        if self._event == 'press':
+            self._modes.next()
         else:
-            delta = time.monotonic() - self._state['mode_button_press_time']
-            self._state['mode_button_press_time'] = 0
-            log.debug(f'Button Release, held for {round(delta, 3)} seconds')
-            if delta >= 1.5:  # Long Press
-                self._modes.previous()
-            else:
-                self._modes.next()
-            self.display_mode_select()
+            self._modes.previous()
+        self.display_mode_select()
+
+    def pause(self):
+        # Toggles once per press, holding the button down doesn't repeat it
+        if self._event == 'repeat':
+            return
+        token = self._state.get('token', None)
+        if self._state['status'] == 'executing' and token.pause(self._mode_operation_map.get('all_off_closed')):
+            cmd, remaining = token.progress
+            log.debug(f'Pausing at {cmd} with {remaining} seconds left')
+            # Everything is off, other stations can have the utilities until we resume
+            if self._scheduler:
+                self._scheduler.release(self._station)
+            self._state['status'] = 'paused'
+            self._hardware.get('display').clear()
+            self._hardware.get('display').message(f'Paused {cmd}\nPress to resume')
+        elif self._state['status'] == 'paused':
+            # Take the step's utilities back first, waiting for other stations if need be
+            if not self._reserve(token, token.progress[0], idle=True):
+                return
+            if token.resume(lambda: self._mode_operation_map[token.progress[0]]()):
+                log.debug(f'Resuming {token.progress[0]} with {token.progress[1]} seconds left')
+                self._state['status'] = 'executing'
+            elif self._scheduler:
+                self._scheduler.release(self._station)
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            # Let the controller know this action is done so it can be reaped without polling
+            self._state.notify()
+
+    def _run(self):
         log.debug(f'Execution action: {self._action}')
         if self._action.lower() == 'abort':
             self.abort()
         elif self._action.lower() == 'execute_mode':
             self.execute_mode()
+        elif self._action.lower() == 'pause':
+            self.pause()
         elif self._state.get('button_lock', False):
             log.debug('Control Panel Lockout Enabled, ignoring button press')
         elif self._action.lower() == 'mode':
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import collections
+import io
+import json
+import math
+import logging
+import os
+import stat
+import threading
+
+from kegwasher.exceptions import ControlError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+# What a station is doing, as published by its control loop. A new one replaces the old on every state change
+# and none is ever modified, so readers take the current reference and need no lock.
+Snapshot = collections.namedtuple('Snapshot', [
+    'station', 'version', 'timestamp', 'status', 'ready', 'aborted', 'mode', 'display_name', 'resumable',
+    'program', 'operation', 'devices', 'display'])
+# The running program: step index of steps, seconds left in the step and in the program
+Progress = collections.namedtuple('Progress', [
+    'mode', 'display_name', 'step', 'steps', 'operation', 'step_remaining', 'remaining', 'percent'])
+
+# Commands taking the station name, and whether they take a mode
+commands = {'abort': False, 'pause': False, 'resume': False, 'select': True, 'start': True}
+
+
+def as_dict(snapshot):
+    status = snapshot._asdict()
+    status['program'] = snapshot.program._asdict() if snapshot.program else None
+    status['devices'] = {kind: {name: value for device_kind, name, value in snapshot.devices if device_kind == kind}
+                         for kind in sorted({kind for kind, name, value in snapshot.devices})}
+    return status
+
+
+def _encode(value):
+    return (json.dumps(value, sort_keys=True) + '\n').encode('utf-8')
+
+
+def _server_classes(api):
+    # http.server is slow to import and only needed when the API is switched on
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import parse_qs
+
+    class ControlHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class ControlUnixServer(ThreadingMixIn, UnixStreamServer):
+        daemon_threads = True
+
+    class ControlHandler(BaseHTTPRequestHandler):
+        def _reply(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, code, message):
+            self._reply(code, _encode({'error': message}))
+
+        def _station(self, parts):
+            washer = api.stations.get(parts[1], None) if len(parts) > 1 else None
+            if washer is None:
+                self._error(404, f'No station {parts[1] if len(parts) > 1 else ""}')
+            return washer
+
+        def do_GET(self):
+            path, sep, query = self.path.partition('?')
+            parts = path.strip('/').split('/')
+            if parts == ['stations']:
+                self._reply(200, _encode({name: as_dict(washer.snapshot) for name, washer in api.stations.items()}))
+                return
+            if parts[0] != 'stations' or len(parts) > 3 or len(parts) == 3 and parts[2] not in ['modes', 'telemetry']:
+                self._error(404, f'No resource {self.path}')
+                return
+            washer = self._station(parts)
+            if washer is None:
+                return
+            if len(parts) == 3 and parts[2] == 'telemetry':
+                self._telemetry(washer, parse_qs(query))
+            elif len(parts) == 3:
+                self._reply(200, _encode([{'name': program.name, 'display_name': program.display_name,
+                                           'steps': len(program.steps), 'seconds': program.total}
+                                          for program in washer.programs.values()]))
+            else:
+                self._reply(200, api.encode(washer.snapshot))
+
+        def _telemetry(self, washer, query):
+            if washer.telemetry is None:
+                self._error(404, f'Telemetry is off for {washer.name}')
+                return
+            try:
+                since, interval = [float(query[name][0]) if name in query else None for name in ['since', 'interval']]
+                if since is not None and not 0 <= since < math.inf or \
+                        interval is not None and not 0 < interval < math.inf:
+                    raise ValueError('since and interval are positive seconds')
+            except ValueError as e:
+                self._error(400, f'Invalid telemetry query: {e}')
+                return
+            now = washer.clock.monotonic()
+            output = io.StringIO()
+            washer.telemetry.export_csv(output, None if since is None else now - since, now, interval)
+            self._reply(200, output.getvalue().encode('utf-8'), 'text/csv')
+
+        def do_POST(self):
+            parts = self.path.split('?')[0].strip('/').split('/')
+            if parts[0] != 'stations' or len(parts) != 3 or parts[2] not in commands:
+                self._error(404, f'No command {self.path}')
+                return
+            washer = self._station(parts)
+            if washer is None:
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0) or 0)
+                body = json.loads(self.rfile.read(length).decode('utf-8')) if length else dict()
+                if not isinstance(body, dict):
+                    raise ValueError('expecting a JSON object')
+            except ValueError as e:
+                self._error(400, f'Invalid request body: {e}')
+                return
+            mode = body.get('mode', None)
+            if mode is not None and (not commands[parts[2]] or mode not in washer.programs):
+                self._error(404 if commands[parts[2]] else 400, f'No mode {mode} for {parts[2]}')
+                return
+            try:
+                if commands[parts[2]]:
+                    getattr(washer, f'{parts[2]}_mode')(mode)
+                else:
+                    getattr(washer, f'{parts[2]}_mode')()
+            except ControlError as e:
+                self._error(409, str(e))
+                return
+            log.info(f'API {parts[2]} {mode or ""} accepted for {parts[1]}')
+            self._reply(202, _encode({'accepted': parts[2], 'station': parts[1], 'mode': mode}))
+
+        def address_string(self):
+            # Unix socket peers have no address
+            return self.client_address[0] if self.client_address else 'unix socket'
+
+        def log_message(self, format, *args):
+            log.debug(f'API request from {self.address_string()}: {format % args}')
+
+    return ControlUnixServer, ControlHTTPServer, ControlHandler
+
+
+class ControlServer(object):
+    # Local HTTP API to list modes, start, pause, resume and abort programs and read each station's status.
+    # Served on a Unix socket, and on address:port when a port is set. Status comes from the snapshot each
+    # station publishes, a request never waits on the thread driving the valves. Commands go through the
+    # station's dispatcher like button presses, so the panel and the API can't get in each other's way.
+    #   GET  /stations                   every station's status
+    #   GET  /stations/<name>            one station's status
+    #   GET  /stations/<name>/modes      the modes it can run
+    #   GET  /stations/<name>/telemetry  CSV of its device states, ?since=seconds back and ?interval=seconds
+    #   POST /stations/<name>/select     {"mode": name}, as pressing Mode until it shows
+    #   POST /stations/<name>/start      {"mode": name} or the selected mode, as pressing Enter
+    #   POST /stations/<name>/pause      /resume, as pressing Pause
+    #   POST /stations/<name>/abort      as opening the abort switch, which clears it again once cycled
+    def __init__(self, *args, **kwargs):
+        self.stations = kwargs.get('stations', dict())
+        self._address = kwargs.get('address', '127.0.0.1')
+        self._port = int(kwargs.get('port', 0) or 0)
+        self._socket = kwargs.get('socket', None)
+        self._socket_mode = kwargs.get('socket_mode', 0o660)
+        # Encoded body of the last snapshot served per station, polling clients mostly ask for the same one
+        self._encoded = dict()
+        self._servers = list()
+        self._threads = list()
+
+    @property
+    def port(self):
+        tcp = [server for server in self._servers if isinstance(server.server_address, tuple)]
+        return tcp[0].server_address[1] if tcp else None
+
+    def encode(self, snapshot):
+        # Replaced whole, no lock needed; two threads encoding the same snapshot at once only waste the work
+        cached = self._encoded.get(snapshot.station, None)
+        if cached is None or cached[0] is not snapshot:
+            cached = (snapshot, _encode(as_dict(snapshot)))
+            self._encoded[snapshot.station] = cached
+        return cached[1]
+
+    def _remove_socket(self):
+        try:
+            if stat.S_ISSOCK(os.lstat(self._socket).st_mode):
+                os.unlink(self._socket)
+        except FileNotFoundError:
+            pass
+
+    def start(self):
+        if not self._socket and not self._port:
+            return
+        unix_server, http_server, handler = _server_classes(self)
+        try:
+            if self._socket:
+                os.makedirs(os.path.dirname(self._socket) or '.', exist_ok=True)
+                # Left behind by a daemon that didn't shut down
+                self._remove_socket()
+                self._servers.append(unix_server(self._socket, handler))
+                os.chmod(self._socket, self._socket_mode)
+            if self._port:
+                self._servers.append(http_server((self._address, self._port), handler))
+        except OSError as e:
+            log.warning(f'Unable to start the control API, only the panel can be used: {e}')
+            for server in self._servers:
+                server.server_close()
+            self._servers = list()
+            return
+        if self._socket:
+            log.info(f'Serving the control API on {self._socket}')
+        if self._port:
+            log.info(f'Serving the control API on http://{self._address}:{self.port}/stations')
+        for server in self._servers:
+            t = threading.Thread(target=server.serve_forever, name='kegwasher-api')
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        for t in self._threads:
+            t.join()
+        if self._servers and self._socket:
+            self._remove_socket()
+        self._servers, self._threads = list(), list()
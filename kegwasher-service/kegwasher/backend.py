@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import logging
+import os
+
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+# Hardware backends, 'rpi' drives the real pins and bus, 'simulation' runs everything in-process
+backends = ['rpi', 'simulation']
+
+_selected = None
+_drivers = dict()
+
+
+class GPIOConstants(object):
+    # RPi.GPIO constant values. Every backend uses the same numbers, so configuration can refer to
+    # them without loading a driver.
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+
+class _GPIOProxy(GPIOConstants):
+    # Stands in for the RPi.GPIO module, forwarding calls to the selected backend
+    def __getattr__(self, name):
+        return getattr(_driver('gpio'), name)
+
+
+GPIO = _GPIOProxy()
+
+
+def _driver(kind):
+    name = selected()
+    if (name, kind) not in _drivers:
+        log.debug(f'Loading {name} {kind} driver')
+        if name == 'rpi':
+            if kind == 'gpio':
+                import RPi.GPIO as driver
+            elif kind == 'smbus':
+                import smbus2
+                driver = smbus2.SMBus
+            else:
+                import Adafruit_CharLCD
+                driver = Adafruit_CharLCD.Adafruit_CharLCD
+        else:
+            from kegwasher.simulation import simulation
+            driver = {'gpio': simulation.gpio, 'smbus': simulation.smbus, 'lcd': simulation.char_lcd}[kind]
+        _drivers[(name, kind)] = driver
+    return _drivers[(name, kind)]
+
+
+def char_lcd(*args, **kwargs):
+    return _driver('lcd')(*args, **kwargs)
+
+
+def select(name=None):
+    # Explicit name first, then the KEGWASHER_BACKEND environment variable, then real hardware
+    global _selected
+    name = name or os.getenv('KEGWASHER_BACKEND', 'rpi')
+    if name not in backends:
+        error_msg = f'Unknown hardware backend {name}, expecting one of {backends}'
+        log.fatal(error_msg)
+        raise ConfigError(error_msg)
+    if name != _selected:
+        log.info(f'Using {name} hardware backend')
+    _selected = name
+    return _selected
+
+
+def selected():
+    return _selected or select()
+
+
+def smbus(bus):
+    return _driver('smbus')(bus)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import sys
+import threading
+import time
+
+from kegwasher import backend
+from kegwasher.cancellation import CancellationToken
+from kegwasher.clock import VirtualClock
+from kegwasher.config import pin_config, mode_config, service_config
+from kegwasher.service import KegWasher
+from kegwasher.simulation import simulation
+from kegwasher.stations import Stations
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+# Metrics where a bigger number is an improvement, everything else regresses by growing
+higher_is_better = ('.transitions_per_second.median',)
+# Absolute changes too small to count whatever their ratio, an idle process burns a few microseconds a second
+noise_floor = {'idle.cpu_seconds_per_second': 0.001}
+
+
+def _summary(samples):
+    return {
+        'mean': statistics.mean(samples),
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'max': max(samples),
+        'samples': len(samples)
+    }
+
+
+def _io(bus_io):
+    return sum(counts['reads'] for counts in bus_io.values()), sum(counts['writes'] for counts in bus_io.values())
+
+
+def _rss():
+    # Current resident set size in bytes, peak RSS where /proc isn't available
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _washer(clock=None):
+    # A fresh controller on a fresh simulated bus, with the abort switch in its run position
+    simulation.reset()
+    simulation.gpio.inject(_switch_pin('abort'), 1)
+    config = dict(service_config, backend='simulation', journal=dict())
+    return KegWasher(copy.deepcopy(pin_config), mode_config, config, clock=clock)
+
+
+def _station_config(index):
+    # The stock washer moved to its own GPIO pins and the next expander address
+    station = copy.deepcopy(pin_config)
+    station['name'] = f'station_{index + 1}'
+    offset = 100 * (index + 1)
+    for entry in station['display'].values():
+        if isinstance(entry, dict):
+            entry['pin'] += offset
+    for switch in station['switches']:
+        switch['pin'] += offset
+    for expander in station['io_expanders']:
+        expander['address'] += index
+    return station
+
+
+def _switch_pin(name):
+    return next(switch['pin'] for switch in pin_config['switches'] if switch['name'] == name)
+
+
+def bench_startup(iterations):
+    samples = list()
+    for i in range(iterations):
+        start = time.perf_counter()
+        washer = _washer()
+        samples.append(time.perf_counter() - start)
+        washer.shutdown()
+    return {'seconds': _summary(samples)}
+
+
+def bench_operations(iterations):
+    # Every operation entered from every other one, the time and I2C traffic of the measured transition
+    washer = _washer()
+    operation_map = washer._operations.operation_map
+    results = dict()
+    for operation, handler in operation_map.items():
+        samples, reads, writes = list(), list(), list()
+        for i in range(iterations):
+            for source in operation_map:
+                if source == operation:
+                    continue
+                operation_map[source]()
+                before = _io(simulation.io)
+                start = time.perf_counter()
+                handler()
+                samples.append(time.perf_counter() - start)
+                after = _io(simulation.io)
+                reads.append(after[0] - before[0])
+                writes.append(after[1] - before[1])
+        results[operation] = {'seconds': _summary(samples), 'i2c_reads': _summary(reads), 'i2c_writes': _summary(writes)}
+    washer.shutdown()
+    return results
+
+
+def bench_interrupt_latency(iterations):
+    # Time from the release edge of a short press to a dispatcher worker building the action, debounce included
+    washer = _washer()
+    pin = _switch_pin('sw_4')
+    debounce = washer._inputs.debounce
+    dispatched = threading.Event()
+    received = [0]
+
+    def factory(action, submitted=None, event=None):
+        received[0] = time.perf_counter()
+        dispatched.set()
+        return washer._new_action(action, submitted, event)
+
+    washer._dispatcher.factory = factory
+    samples = list()
+    for i in range(iterations):
+        dispatched.clear()
+        simulation.gpio.inject(pin, 1)
+        time.sleep(debounce * 2)
+        start = time.perf_counter()
+        simulation.gpio.inject(pin, 0)
+        dispatched.wait()
+        samples.append(received[0] - start)
+        washer._dispatcher.wait_idle()
+    washer.shutdown()
+    return {'seconds': _summary(samples)}
+
+
+def bench_lcd(iterations):
+    # Runs every mode program on an instant clock and counts what reached the LCD per one second tick
+    clock = VirtualClock()
+    washer = _washer(clock)
+    lcd = simulation.lcds[-1]
+    results = dict()
+    for mode in mode_config.values():
+        ticks = sum(seconds for operation, seconds in mode['operations'])
+        samples = list()
+        for i in range(iterations):
+            before = lcd.stats['bytes']
+            washer._state.update(status='executing', token=CancellationToken(clock), progress=None)
+            washer._new_action('execute_mode').run()
+            samples.append((lcd.stats['bytes'] - before) / max(ticks, 1))
+        results[mode['display_name']] = {'bytes_per_tick': _summary(samples), 'ticks': ticks}
+        washer._modes.next()
+    washer.shutdown()
+    return results
+
+
+def bench_stations(iterations, counts=(1, 2, 3, 4)):
+    # Transitions per second each station manages while every station cycles its operations at once
+    results = dict()
+    for count in counts:
+        simulation.reset()
+        configs = [_station_config(index) for index in range(count)]
+        for config in configs:
+            simulation.gpio.inject(next(switch['pin'] for switch in config['switches'] if switch['name'] == 'abort'), 1)
+        stations = Stations({'stations': configs}, mode_config,
+                            dict(service_config, backend='simulation', journal=dict()))
+        washers = list(stations.stations.values())
+        rates = [0] * count
+        barrier = threading.Barrier(count)
+
+        def cycle(index):
+            operation_map = washers[index]._operations.operation_map
+            barrier.wait()
+            start = time.perf_counter()
+            for i in range(iterations):
+                for handler in operation_map.values():
+                    handler()
+            rates[index] = iterations * len(operation_map) / (time.perf_counter() - start)
+
+        threads = [threading.Thread(target=cycle, args=(index,)) for index in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stations.shutdown()
+        results[str(count)] = {'transitions_per_second': _summary(rates)}
+    return results
+
+
+def bench_idle(seconds):
+    # A ready station with nothing to do should sleep: process CPU time and run loop wakeups over seconds of idling
+    washer = _washer()
+    washer.start()
+    washer.wait_ready(5)
+    # Let start-up work settle before measuring
+    time.sleep(0.2)
+    wakeups, cpu, start = washer.stats['loop_wakeups'], time.process_time(), time.perf_counter()
+    time.sleep(seconds)
+    elapsed = time.perf_counter() - start
+    results = {'cpu_seconds_per_second': (time.process_time() - cpu) / elapsed,
+               'loop_wakeups_per_second': (washer.stats['loop_wakeups'] - wakeups) / elapsed}
+    washer.shutdown()
+    washer.join()
+    return results
+
+
+def run(iterations=20, idle=2):
+    backend.select('simulation')
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+            'timestamp': time.time()
+        },
+        'startup': bench_startup(iterations),
+        'operations': bench_operations(iterations),
+        'interrupt_latency': bench_interrupt_latency(iterations * 2),
+        'lcd': bench_lcd(max(iterations // 10, 1)),
+        'stations': bench_stations(iterations * 10),
+        'idle': bench_idle(idle)
+    }
+    results['rss_bytes'] = _rss()
+    return results
+
+
+def _flatten(results, prefix=''):
+    flat = dict()
+    for key, value in results.items():
+        if key == 'meta':
+            continue
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{name}.'))
+        elif isinstance(value, (int, float)) and not name.endswith(('.samples', '.min', '.max', '.mean')):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current, threshold=0.10):
+    # Medians and counters that moved the wrong way by more than threshold, {metric: (baseline, current)}
+    regressions = dict()
+    before, after = _flatten(baseline), _flatten(current)
+    for name, value in after.items():
+        if name not in before:
+            continue
+        old = before[name]
+        if abs(value - old) < noise_floor.get(name, 0):
+            continue
+        change = (value - old) / old if old else (1 if value else 0)
+        if name.endswith(higher_is_better):
+            change = -change
+        if change > threshold:
+            regressions[name] = (old, value)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the KegWasher control paths on simulated hardware')
+    parser.add_argument('-i', '--iterations', type=int, default=20, help='samples per measurement')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--idle', type=float, default=2, help='seconds to measure an idle station for, default 2')
+    parser.add_argument('-b', '--baseline', help='JSON results of an earlier run to check for regressions')
+    parser.add_argument('-t', '--threshold', type=float, default=0.10,
+                        help='relative change that counts as a regression, default 0.10')
+    args = parser.parse_args(argv)
+    log.setLevel(logging.WARNING)
+    results = run(args.iterations, args.idle)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(json.load(baseline), results, args.threshold)
+        for name, (old, new) in sorted(regressions.items()):
+            sys.stderr.write(f'REGRESSION {name}: {old} -> {new}\n')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import logging
+import os
+import threading
+
+from kegwasher import clock
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class CancellationToken(object):
+    # Handed to a running mode program. The program checks it at every wait and every device change,
+    # so cancel() stops it within one wait instead of whenever the interpreter gets around to it, and
+    # pause() holds it where it is until resume().
+    def __init__(self, clock=clock.real):
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._cancelled = False
+        self._paused = False
+        # When the current pause began and how long earlier pauses lasted, in clock time
+        self._paused_at = None
+        self._paused_total = 0
+        self._listeners = list()
+        # What the holder is doing right now, (operation, seconds remaining), published for pause/resume,
+        # and the compiled program and step index it is in, for progress and ETA
+        self.progress = None
+        self.program = None
+        self.step = None
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @property
+    def running_time(self):
+        # Clock time with the time spent paused taken out, program deadlines are set on it
+        with self._condition:
+            return self._running_time()
+
+    def _running_time(self):
+        now = self._clock.monotonic()
+        paused = self._paused_total + (now - self._paused_at if self._paused_at is not None else 0)
+        return now - paused
+
+    def apply(self, func):
+        # Run func unless cancelled, waiting out a pause first. Returns False when cancelled.
+        with self._condition:
+            self._condition.wait_for(lambda: self._cancelled or not self._paused)
+            if self._cancelled:
+                return False
+            func()
+            return True
+
+    def add_listener(self, func):
+        # func is called once on cancel(), from the cancelling thread, so waits elsewhere can be woken
+        with self._condition:
+            if not self._cancelled:
+                self._listeners.append(func)
+                return
+        func()
+
+    def cancel(self):
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+            listeners, self._listeners = self._listeners, list()
+        for func in listeners:
+            func()
+
+    def remove_listener(self, func):
+        with self._condition:
+            if func in self._listeners:
+                self._listeners.remove(func)
+
+    def pause(self, func=None):
+        # func runs under the token lock, so the holder can't change devices between it and the pause
+        with self._condition:
+            if self._cancelled or self._paused:
+                return False
+            self._paused = True
+            self._paused_at = self._clock.monotonic()
+            if func:
+                func()
+            self._condition.notify_all()
+            return True
+
+    def resume(self, func=None):
+        with self._condition:
+            if self._cancelled or not self._paused:
+                return False
+            if func:
+                func()
+            self._paused = False
+            self._paused_total += self._clock.monotonic() - self._paused_at
+            self._paused_at = None
+            self._condition.notify_all()
+            return True
+
+    def wait(self, timeout):
+        # Sleep for timeout seconds of running time, time spent paused does not count.
+        # Returns False as soon as the token is cancelled.
+        return self.wait_until(self.running_time + timeout)
+
+    def wait_until(self, deadline):
+        # Sleep until running_time reaches deadline. Waiting for an absolute time instead of an interval means
+        # whatever the caller did since its last wait, and how late it was woken, doesn't push the deadline.
+        # Returns False as soon as the token is cancelled.
+        with self._condition:
+            while not self._cancelled:
+                if self._paused:
+                    self._condition.wait()
+                    continue
+                left = deadline - self._running_time()
+                if left <= 0:
+                    return True
+                self._clock.wait(self._condition, left)
+            return False
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import logging
+import os
+import threading
+import time
+
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class Clock(object):
+    # Real time. Everything that measures or waits out time asks a clock instead of the time module,
+    # so a VirtualClock can be swapped in to run mode programs faster than real time.
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, condition, timeout=None):
+        # Like condition.wait(timeout) with timeout in clock seconds, the caller must hold condition
+        return condition.wait(timeout)
+
+
+class VirtualClock(Clock):
+    # Clock time decoupled from real time.
+    #   speed=None  every wait returns at once and moves the clock forward by its timeout
+    #   speed=N     the clock runs N times faster than real time
+    #   speed=0     the clock stands still until advance() moves it
+    # advance() jumps the clock forward at any speed and wakes whoever is waiting.
+    def __init__(self, speed=None, start=0):
+        self._lock = threading.Lock()
+        self._offset = start
+        self._real_start = time.monotonic()
+        self._sleepers = set()
+        self._speed = None
+        self.speed = speed
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @speed.setter
+    def speed(self, speed=None):
+        if speed is not None and speed < 0:
+            error_msg = f'Clock speed must be positive, received {speed}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        with self._lock:
+            # Rebase so changing speed doesn't make the clock jump
+            self._offset = self._now()
+            self._real_start = time.monotonic()
+            self._speed = speed
+
+    def _now(self):
+        if not self._speed:
+            return self._offset
+        return self._offset + (time.monotonic() - self._real_start) * self._speed
+
+    def advance(self, seconds):
+        with self._lock:
+            self._offset += seconds
+            sleepers = list(self._sleepers)
+        for condition in sleepers:
+            with condition:
+                condition.notify_all()
+
+    def monotonic(self):
+        with self._lock:
+            return self._now()
+
+    def sleep(self, seconds):
+        condition = threading.Condition()
+        deadline = self.monotonic() + seconds
+        with condition:
+            while self.monotonic() < deadline:
+                self.wait(condition, deadline - self.monotonic())
+
+    def wait(self, condition, timeout=None):
+        if self._speed is None:
+            if timeout is None:
+                return condition.wait()
+            # Let other threads get at the condition, then skip the time
+            notified = condition.wait(0)
+            self.advance(timeout)
+            return notified
+        with self._lock:
+            self._sleepers.add(condition)
+        try:
+            if timeout is None or not self._speed:
+                # Frozen clock, only advance() or a notify ends the wait
+                return condition.wait()
+            return condition.wait(timeout / self._speed)
+        finally:
+            with self._lock:
+                self._sleepers.discard(condition)
+
+
+def from_speed(speed=1):
+    # Build a clock from configuration, 1 is real time, 'instant' skips waits, anything else is N× speed
+    if speed in [1, '1', None]:
+        return Clock()
+    if speed == 'instant':
+        return VirtualClock()
+    try:
+        return VirtualClock(float(speed))
+    except ValueError:
+        error_msg = f'Invalid clock speed {speed}, expecting a number or instant'
+        log.fatal(error_msg)
+        raise ConfigError(error_msg)
+
+
+real = Clock()
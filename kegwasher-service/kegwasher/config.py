@@ -2,7 +2,9 @@
 #
 # Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
 
-import RPi.GPIO as GPIO
+import os
+
+from kegwasher.backend import GPIO
 
 # Mode Configuration
 # Available Mode Operations
@@ -125,6 +127,10 @@ mode_config = {
 }
 
 # Hardware Configuration
+# A single washer is described directly. To drive several washing heads from one daemon, use
+#   pin_config = {'stations': [{'name': 'station_1', 'display': ..., 'io_expanders': ..., ...}, ...]}
+# Each station needs its own display, switch pins and expanders, and may carry its own 'modes' (a
+# mode_config) and 'operations' (an Operations.operation_devices table for its device names).
 pin_config = {
     'display': {
         'lcd_rs':       {'pin': 16},
@@ -141,7 +147,11 @@ pin_config = {
         {'name': 'heater_1',     'expander': 'expander0', 'pin': 8}
     ],
     'io_expanders': [
-        {'name': 'expander0',    'bus': 1, 'driver': 'pca955x', 'address': 0x20, 'gpios': 16}
+        # verify: never | commit | periodic, read the registers back to catch expander resets
+        # interrupt: Pi GPIO pin wired to the INT output, needed for switches and sensors on expander pins, e.g.
+        #   {'name': 'keg_float', 'expander': 'expander0', 'pin': 12, 'PUD': GPIO.PUD_UP, 'event': GPIO.BOTH, ...}
+        {'name': 'expander0',    'bus': 1, 'driver': 'pca955x', 'address': 0x20, 'gpios': 16,
+         'verify': 'periodic', 'verify_interval': 30}
     ],
     'pumps': [
         {'name': 'pump_1',       'expander': 'expander0', 'pin': 4}
@@ -149,7 +159,7 @@ pin_config = {
     'switches': [
         {'name': 'mode',         'pin': 5,    'PUD': GPIO.PUD_DOWN,   'event': GPIO.BOTH,      'action': 'mode'},
         {'name': 'enter',        'pin': 6,    'PUD': GPIO.PUD_DOWN,   'event': GPIO.BOTH,      'action': 'enter'},
-        {'name': 'sw_3',         'pin': 12,   'PUD': GPIO.PUD_DOWN,   'event': GPIO.BOTH,      'action': 'nc'},
+        {'name': 'pause',        'pin': 12,   'PUD': GPIO.PUD_DOWN,   'event': GPIO.BOTH,      'action': 'pause'},
         {'name': 'sw_4',         'pin': 13,   'PUD': GPIO.PUD_DOWN,   'event': GPIO.BOTH,      'action': 'nc'},
         {'name': 'abort',        'pin': 20,   'PUD': GPIO.PUD_DOWN,   'event': GPIO.BOTH,      'action': 'abort'}
     ],
@@ -166,3 +176,104 @@ pin_config = {
     ]
 }
 
+# Service Configuration
+service_config = {
+    # rpi drives the real hardware, simulation runs GPIO, I2C expanders and the LCD in-process
+    'backend': os.getenv('KEGWASHER_BACKEND', 'rpi'),
+    # 1 is real time, a number runs mode programs that many times faster, instant skips every wait
+    'clock_speed': os.getenv('KEGWASHER_CLOCK_SPEED', '1'),
+    # Seconds from process start until every station shows Select Mode, slower start-ups are logged as a warning
+    'startup_budget': 10,
+    # pin_config and mode_config can come from a TOML or JSON file instead, with 'hardware' and 'modes' sections
+    # shaped like them (kegwasher-config --export writes these as a starting point). The file is fully checked
+    # once, the result is cached in cache_dir under its hash and reused while the file is unchanged.
+    'config_file': {
+        'path':             os.getenv('KEGWASHER_CONFIG', None),
+        'cache_dir':        os.getenv('KEGWASHER_CONFIG_CACHE', '/var/cache/kegwasher')
+    },
+    # Mode programs can be kept in a TOML or JSON file shaped like mode_config, which replaces it for every station
+    # without its own modes. The file is watched and reloaded while the daemon runs, new modes take effect
+    # between runs. Without inotify the file is checked every poll_interval seconds.
+    'mode_reload': {
+        'file':             os.getenv('KEGWASHER_MODES_FILE', None),
+        'poll_interval':    2
+    },
+    # Mode programs can be optimized as they are loaded: 0 second steps are dropped and adjacent steps that drive
+    # the same devices, and resume alike, are merged, which saves a transition each. min_dwell declares the
+    # shortest time a step of an operation may last ('default' for the rest), e.g. {'default': 5, 'drain': 20}.
+    # It is used to report each program's minimum cycle time and steps running shorter than their rule.
+    # transition is what a step change costs on top of its step. kegwasher-optimize shows the result offline.
+    'optimizer': {
+        'enabled':      False,
+        'min_dwell':    {'default': 0},
+        'transition':   0
+    },
+    # Append-only journal of each station's program run, so a run cut short by a power loss can be resumed.
+    # An empty directory disables it. Step changes are synced at once, progress every sync_interval seconds.
+    # resume sets per operation how an interrupted step picks up again: continue with the seconds it had
+    # left, restart the step, or rewind to the step before it; default covers every other operation.
+    'journal': {
+        'directory':        os.getenv('KEGWASHER_JOURNAL_DIR', '/var/lib/kegwasher'),
+        'sync_interval':    10,
+        'resume': {
+            'default':          'restart',
+            'air_fill_open':    'continue',
+            'cleaner_fill':     'continue',
+            'drain':            'continue',
+            'rinse':            'continue',
+            'sanitizer_fill':   'continue',
+            'clean_closed':     'rewind',
+            'co2_fill_closed':  'rewind'
+        }
+    },
+    # Local control and status API (HTTP with JSON bodies) on a Unix socket, and on address:port unless port is 0.
+    # An empty socket and port 0 leave it off. See kegwasher.api.ControlServer for the requests it takes.
+    'api': {
+        'socket':       os.getenv('KEGWASHER_API_SOCKET', '/run/kegwasher/api.sock'),
+        'socket_mode':  0o660,
+        'address':      '127.0.0.1',
+        'port':         int(os.getenv('KEGWASHER_API_PORT', '0'))
+    },
+    # Per station history of which valves, pumps and heaters were on, in a ring of capacity state changes held in
+    # memory (16 bytes each up to 64 devices) and read as CSV from the control API. 0 leaves it off.
+    'telemetry': {
+        'capacity':     int(os.getenv('KEGWASHER_TELEMETRY_CAPACITY', '16384'))
+    },
+    # Prometheus metrics, served on address:port (0 disables) and/or written to a textfile-collector file
+    'metrics': {
+        'address':              '127.0.0.1',
+        'port':                 int(os.getenv('KEGWASHER_METRICS_PORT', '0')),
+        'textfile':             os.getenv('KEGWASHER_METRICS_TEXTFILE', None),
+        'textfile_interval':    15
+    },
+    # Utilities shared between stations. limits caps heaters/pumps running at once and the stations using a
+    # supply line (by valve name) at once, steps wait for room; max_bypass bounds how often a waiting
+    # station may be overtaken by others whose steps fit
+    'resources': {
+        'limits': {
+            'heaters':  2,
+            'pumps':    2,
+            'co2_in':   1,
+            'water_in': 1
+        },
+        'max_bypass':   4
+    },
+    # Switch edges are debounced on one thread: an input counts once steady for debounce seconds, a button held
+    # for long_press seconds reports a long press and then a repeat every repeat seconds. levels lists the
+    # actions of level switches, which report asserted/cleared instead. Events emitted later than max_jitter
+    # after they were due are logged.
+    'inputs': {
+        'debounce':     0.02,
+        'long_press':   1.5,
+        'repeat':       0.5,
+        'max_jitter':   0.02,
+        'levels':       ['abort']
+    },
+    # Switch interrupts are queued and handled by a fixed pool of worker threads
+    'dispatcher': {
+        'workers':      2,
+        'queue_size':   16,
+        'coalesce':     ['mode'],
+        'priority':     ['abort']
+    }
+}
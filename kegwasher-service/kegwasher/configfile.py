@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import argparse
+import hashlib
+import json
+import logging
+import marshal
+import os
+import sys
+import zlib
+
+from kegwasher.backend import GPIOConstants
+from kegwasher.exceptions import ConfigError
+from kegwasher.operations import Operations
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+# Bump whenever the checks or the normalized form change, so caches written by older code are ignored
+schema_version = 1
+_magic = b'KWC\x01'
+
+# Symbolic names accepted for switch pull resistors and edges, the numbers work too
+pulls = {'off': GPIOConstants.PUD_OFF, 'down': GPIOConstants.PUD_DOWN, 'up': GPIOConstants.PUD_UP}
+edges = {'rising': GPIOConstants.RISING, 'falling': GPIOConstants.FALLING, 'both': GPIOConstants.BOTH}
+switch_actions = ('abort', 'enter', 'mode', 'nc', 'pause')
+verify_policies = ('never', 'commit', 'periodic')
+expander_drivers = ('pca955x',)
+display_pins = ('lcd_rs', 'lcd_en', 'lcd_d4', 'lcd_d5', 'lcd_d6', 'lcd_d7', 'lcd_bl')
+device_kinds = ('heaters', 'pumps', 'valves')
+# BCM numbering of the Pi header
+gpio_pins = range(0, 28)
+
+
+def _fail(source, where, message):
+    error_msg = f'{source}: {where} {message}'
+    log.fatal(error_msg)
+    raise ConfigError(error_msg)
+
+
+def _table(source, where, value, required=(), optional=()):
+    if not isinstance(value, dict):
+        _fail(source, where, f'must be a table, received {value!r}')
+    for key in value:
+        if key not in required and key not in optional:
+            _fail(source, where, f'has unknown key {key!r}, expecting {sorted(set(required) | set(optional))}')
+    for key in required:
+        if key not in value:
+            _fail(source, where, f'is missing {key!r}')
+    return value
+
+
+def _list(source, where, value, empty=False):
+    if not isinstance(value, (list, tuple)) or not (value or empty):
+        _fail(source, where, f'must be a {"" if empty else "non-empty "}list, received {value!r}')
+    return value
+
+
+def _integer(source, where, value, allowed):
+    if not isinstance(value, int) or isinstance(value, bool) or value not in allowed:
+        _fail(source, where, f'must be an integer from {allowed[0]} to {allowed[-1]}, received {value!r}')
+    return value
+
+
+def _name(source, where, value):
+    if not isinstance(value, str) or not value:
+        _fail(source, where, f'must be a non-empty string, received {value!r}')
+    return value
+
+
+def _choice(source, where, value, choices):
+    # A symbolic name from choices, or one of its values
+    if isinstance(value, str) and value.lower() in choices:
+        return choices[value.lower()]
+    if value in choices.values() and not isinstance(value, bool):
+        return value
+    _fail(source, where, f'must be one of {sorted(choices)}, received {value!r}')
+
+
+def _display(source, where, display):
+    _table(source, where, display, display_pins + ('lcd_columns', 'lcd_rows'))
+    normalized = dict()
+    for key in display_pins:
+        _table(source, f'{where}.{key}', display[key], ('pin',))
+        normalized[key] = {'pin': _integer(source, f'{where}.{key}.pin', display[key]['pin'], gpio_pins)}
+    normalized['lcd_columns'] = _integer(source, f'{where}.lcd_columns', display['lcd_columns'], range(1, 41))
+    normalized['lcd_rows'] = _integer(source, f'{where}.lcd_rows', display['lcd_rows'], range(1, 5))
+    return normalized
+
+
+def _expanders(source, where, expanders):
+    normalized = list()
+    for index, expander in enumerate(_list(source, where, expanders, empty=True)):
+        here = f'{where}[{index}]'
+        _table(source, here, expander, ('name', 'bus', 'driver', 'address', 'gpios'),
+               ('verify', 'verify_interval', 'interrupt'))
+        entry = {
+            'name': _name(source, f'{here}.name', expander['name']),
+            'bus': _integer(source, f'{here}.bus', expander['bus'], range(0, 256)),
+            'driver': expander['driver'],
+            'address': _integer(source, f'{here}.address', expander['address'], range(0x20, 0x28)),
+            'gpios': _integer(source, f'{here}.gpios', expander['gpios'], range(1, 17))
+        }
+        if entry['driver'] not in expander_drivers:
+            _fail(source, f'{here}.driver', f'must be one of {list(expander_drivers)}, received {entry["driver"]!r}')
+        if 'verify' in expander:
+            entry['verify'] = expander['verify']
+            if entry['verify'] not in verify_policies:
+                _fail(source, f'{here}.verify', f'must be one of {list(verify_policies)}, received {entry["verify"]!r}')
+        if 'verify_interval' in expander:
+            interval = expander['verify_interval']
+            if not isinstance(interval, (int, float)) or isinstance(interval, bool) or interval <= 0:
+                _fail(source, f'{here}.verify_interval', f'must be a positive number of seconds, received {interval!r}')
+            entry['verify_interval'] = interval
+        if 'interrupt' in expander:
+            entry['interrupt'] = _integer(source, f'{here}.interrupt', expander['interrupt'], gpio_pins)
+        if any(other['name'] == entry['name'] for other in normalized):
+            _fail(source, f'{here}.name', f'{entry["name"]!r} is used by another expander')
+        normalized.append(entry)
+    return normalized
+
+
+def _devices(source, where, devices, expanders, used, switches=False):
+    # used maps each claimed pin, (expander name or None, pin), to the entry that claimed it
+    normalized, names = list(), set()
+    for index, device in enumerate(_list(source, where, devices)):
+        here = f'{where}[{index}]'
+        if switches:
+            _table(source, here, device, ('name', 'pin', 'PUD', 'event', 'action'), ('expander',))
+        else:
+            _table(source, here, device, ('name', 'pin'), ('expander',))
+        entry = {'name': _name(source, f'{here}.name', device['name'])}
+        if entry['name'] in names:
+            _fail(source, f'{here}.name', f'{entry["name"]!r} is used twice')
+        names.add(entry['name'])
+        expander = device.get('expander', None)
+        if expander is None:
+            entry['pin'] = _integer(source, f'{here}.pin', device['pin'], gpio_pins)
+        elif expander not in expanders:
+            _fail(source, f'{here}.expander', f'{expander!r} is not one of the configured io_expanders')
+        else:
+            entry['expander'] = expander
+            entry['pin'] = _integer(source, f'{here}.pin', device['pin'], range(0, expanders[expander]['gpios']))
+        key = (expander, entry['pin'])
+        if key in used:
+            _fail(source, f'{here}.pin', f'{entry["pin"]} is already used by {used[key]}')
+        used[key] = here
+        if switches:
+            entry['action'] = device['action']
+            if entry['action'] not in switch_actions:
+                _fail(source, f'{here}.action', f'must be one of {list(switch_actions)}, received {entry["action"]!r}')
+            entry['event'] = _choice(source, f'{here}.event', device['event'], edges)
+            entry['PUD'] = _choice(source, f'{here}.PUD', device['PUD'], pulls)
+        normalized.append(entry)
+    return normalized
+
+
+def _operations(source, where, operations, devices):
+    normalized = dict()
+    for operation, kinds in _table(source, where, operations, optional=operations).items():
+        here = f'{where}.{operation}'
+        normalized[_name(source, here, operation)] = dict()
+        for kind, names in _table(source, here, kinds, optional=device_kinds).items():
+            for index, name in enumerate(_list(source, f'{here}.{kind}', names, empty=True)):
+                if name not in devices[kind]:
+                    _fail(source, f'{here}.{kind}[{index}]', f'{name!r} is not one of the configured {kind}')
+            normalized[operation][kind] = list(names)
+    return normalized
+
+
+def _modes(source, where, modes, operations):
+    if not modes:
+        _fail(source, where, f'must define at least one mode')
+    normalized = dict()
+    for name, mode in _table(source, where, modes, optional=modes).items():
+        here = f'{where}.{name}'
+        _table(source, here, mode, ('display_name', 'operations'))
+        steps = list()
+        for index, step in enumerate(_list(source, f'{here}.operations', mode['operations'])):
+            at = f'{here}.operations[{index}]'
+            if not isinstance(step, (list, tuple)) or len(step) != 2:
+                _fail(source, at, f'must be [operation, seconds], received {step!r}')
+            if step[0] not in operations:
+                _fail(source, f'{at}[0]', f'{step[0]!r} is not an operation, expecting one of {sorted(operations)}')
+            if not isinstance(step[1], int) or isinstance(step[1], bool) or step[1] < 0:
+                _fail(source, f'{at}[1]', f'must be a whole number of seconds, received {step[1]!r}')
+            steps.append((step[0], step[1]))
+        normalized[name] = {'display_name': _name(source, f'{here}.display_name', mode['display_name']),
+                            'operations': steps}
+    return normalized
+
+
+def _station(source, where, station, named):
+    _table(source, where, station, ('display', 'heaters', 'pumps', 'switches', 'valves') + (('name',) if named else ()),
+           ('io_expanders', 'modes', 'operations'))
+    normalized = dict()
+    if named:
+        normalized['name'] = _name(source, f'{where}.name', station['name'])
+    normalized['display'] = _display(source, f'{where}.display', station['display'])
+    normalized['io_expanders'] = _expanders(source, f'{where}.io_expanders', station.get('io_expanders', list()))
+    expanders = {expander['name']: expander for expander in normalized['io_expanders']}
+    used = {(None, entry['pin']): f'{where}.display.{key}' for key, entry in normalized['display'].items()
+            if isinstance(entry, dict)}
+    used.update({(None, expander['interrupt']): f'{where}.io_expanders[{index}].interrupt'
+                 for index, expander in enumerate(normalized['io_expanders']) if 'interrupt' in expander})
+    for kind in device_kinds:
+        normalized[kind] = _devices(source, f'{where}.{kind}', station[kind], expanders, used)
+    normalized['switches'] = _devices(source, f'{where}.switches', station['switches'], expanders, used, True)
+    # Aborting and start-up read the abort switch by name
+    if not any(switch['name'] == 'abort' for switch in normalized['switches']):
+        _fail(source, f'{where}.switches', f'must include the abort switch, a switch named \'abort\'')
+    operations = Operations.operation_devices
+    if 'operations' in station:
+        devices = {kind: {device['name'] for device in normalized[kind]} for kind in device_kinds}
+        operations = normalized['operations'] = _operations(source, f'{where}.operations', station['operations'], devices)
+    if 'modes' in station:
+        normalized['modes'] = _modes(source, f'{where}.modes', station['modes'], operations)
+    return normalized, operations
+
+
+def check(document, source='config'):
+    # Validate a parsed configuration file and return (pin_config, mode_config) in the form config.py uses,
+    # None for a section the file leaves out. Raises ConfigError naming the offending entry.
+    _table(source, 'the document', document, optional=('hardware', 'modes'))
+    if not document:
+        _fail(source, 'the document', f'needs a hardware or modes section')
+    pin_config, mode_config = None, None
+    # Operation tables of the stations that run the shared modes
+    shared = [Operations.operation_devices]
+    if 'hardware' in document:
+        hardware = document['hardware']
+        if isinstance(hardware, dict) and 'stations' in hardware:
+            _table(source, 'hardware', hardware, ('stations',))
+            stations, shared, names = list(), list(), set()
+            for index, station in enumerate(_list(source, 'hardware.stations', hardware['stations'])):
+                station, operations = _station(source, f'hardware.stations[{index}]', station, True)
+                if station['name'] in names:
+                    _fail(source, f'hardware.stations[{index}].name', f'{station["name"]!r} is used by another station')
+                names.add(station['name'])
+                if 'modes' not in station:
+                    shared.append(operations)
+                stations.append(station)
+            pin_config = {'stations': stations}
+        else:
+            pin_config, operations = _station(source, 'hardware', hardware, False)
+            shared = [operations]
+    if 'modes' in document:
+        for operations in shared:
+            mode_config = _modes(source, 'modes', document['modes'], operations)
+    return pin_config, mode_config
+
+
+def parse(data, source='config'):
+    # TOML or JSON by file extension, JSON when it can't be told
+    try:
+        if source.endswith('.toml'):
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    _fail(source, 'TOML', f'needs Python 3.11 or the tomli package, use JSON instead')
+            return tomllib.loads(data.decode('utf-8'))
+        return json.loads(data.decode('utf-8'))
+    except UnicodeDecodeError as e:
+        _fail(source, 'the file', f'is not UTF-8: {e}')
+    except ValueError as e:
+        # json.JSONDecodeError and tomllib.TOMLDecodeError both carry the line and column
+        _fail(source, 'the file', f'could not be parsed: {e}')
+
+
+def _cache_key(data):
+    # The marshal format may change between interpreter versions, as may the checks between releases
+    header = f'{schema_version}\0{sys.implementation.cache_tag}\0'.encode('utf-8')
+    return hashlib.sha256(header + data).digest()
+
+
+def _read_cache(path, key):
+    try:
+        with open(path, 'rb') as cache:
+            blob = cache.read()
+    except OSError:
+        return None
+    header = len(_magic) + len(key)
+    if blob[:header] != _magic + key or len(blob) < header + 4:
+        return None
+    payload = blob[header + 4:]
+    if int.from_bytes(blob[header:header + 4], 'little') != zlib.crc32(payload):
+        log.warning(f'Ignoring corrupt configuration cache {path}')
+        return None
+    try:
+        return marshal.loads(payload)
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def _write_cache(path, key, result):
+    payload = marshal.dumps(result)
+    temp = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp, 'wb') as cache:
+            cache.write(_magic + key + zlib.crc32(payload).to_bytes(4, 'little') + payload)
+        os.replace(temp, path)
+    except OSError as e:
+        log.warning(f'Unable to write configuration cache {path}, the next start will check the file again: {e}')
+
+
+def load(path, cache_dir=None):
+    # (pin_config, mode_config) from a TOML or JSON file. The checked result is cached in cache_dir, keyed on
+    # the file's contents, so an unchanged file costs one read and a hash. A file that fails the checks is
+    # never cached. The cache is trusted as it is, cache_dir must only be writable by the daemon's user.
+    with open(path, 'rb') as config_file:
+        data = config_file.read()
+    key = _cache_key(data)
+    cache = os.path.join(cache_dir, f'{os.path.basename(path)}.cache') if cache_dir else None
+    result = _read_cache(cache, key) if cache else None
+    if result is not None:
+        log.debug(f'Configuration {path} unchanged, using {cache}')
+        return result
+    log.info(f'Checking configuration {path}')
+    result = check(parse(data, path), path)
+    if cache:
+        _write_cache(cache, key, result)
+    return result
+
+
+def export(pin_config, mode_config):
+    # JSON for the given configuration, with pull resistors and edges by name, as a starting point for a file
+    names = {value: name for choices in [pulls, edges] for name, value in choices.items()}
+
+    def symbolic(station):
+        station = dict(station)
+        station['switches'] = [dict(switch, **{key: names.get(switch[key], switch[key])
+                                               for key in ['PUD', 'event'] if key in switch})
+                               for switch in station.get('switches', list())]
+        return station
+
+    if 'stations' in pin_config:
+        hardware = {'stations': [symbolic(station) for station in pin_config['stations']]}
+    else:
+        hardware = symbolic(pin_config)
+    return json.dumps({'hardware': hardware, 'modes': mode_config}, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check a KegWasher configuration file, or export the built-in one')
+    parser.add_argument('file', nargs='?', help='TOML or JSON configuration file to check')
+    parser.add_argument('-e', '--export', action='store_true', help='print the built-in configuration as JSON')
+    args = parser.parse_args(argv)
+    if args.export:
+        from kegwasher.config import pin_config, mode_config
+        sys.stdout.write(export(pin_config, mode_config) + '\n')
+        return 0
+    if not args.file:
+        parser.error('a configuration file is needed unless --export is given')
+    # Errors are reported once, on stderr
+    log.setLevel(logging.CRITICAL + 1)
+    try:
+        with open(args.file, 'rb') as config_file:
+            pin_config, mode_config = check(parse(config_file.read(), args.file), args.file)
+    except (ConfigError, OSError) as e:
+        sys.stderr.write(f'{e}\n')
+        return 1
+    stations = len(pin_config.get('stations', [pin_config])) if pin_config else 0
+    sys.stdout.write(f'{args.file}: OK, {stations} stations, {len(mode_config or dict())} modes\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
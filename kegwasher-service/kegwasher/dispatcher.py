@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import collections
+import logging
+import os
+import threading
+
+from kegwasher import clock, metrics
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class Dispatcher(object):
+    # Runs switch actions on a fixed pool of worker threads fed by a bounded queue.
+    #  - an action never runs on two workers at once, so the events of one switch are handled in order
+    #  - a coalescing action absorbs an event identical to the last one it has queued
+    #  - priority actions jump the queue, in the order they came, and when the queue is full they evict the
+    #    oldest routine event
+    def __init__(self, *args, **kwargs):
+        self._coalesce = None
+        self._factory = None
+        self._priority = None
+        self._queue_size = None
+        self._workers = None
+        #
+        self.coalesce = kwargs.get('coalesce', ['mode'])
+        self.factory = kwargs.get('factory', None)
+        self.name = kwargs.get('name', 'kegwasher')
+        self.priority = kwargs.get('priority', ['abort'])
+        self.queue_size = kwargs.get('queue_size', 16)
+        self.workers = kwargs.get('workers', 2)
+        # Switch edges are timestamped on this clock, latencies are measured on it too
+        self._clock = kwargs.get('clock', None) or clock.real
+        #
+        self._active = set()
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._queued = collections.Counter()
+        self._running = False
+        # When each queued event happened and what it was, per action in queue order
+        self._submitted = collections.defaultdict(collections.deque)
+        self._stats = {'submitted': 0, 'dispatched': 0, 'coalesced': 0, 'dropped': 0, 'failed': 0}
+        self._threads = list()
+
+    @property
+    def coalesce(self):
+        return self._coalesce
+
+    @coalesce.setter
+    def coalesce(self, coalesce=None):
+        self._coalesce = frozenset(coalesce or list())
+
+    @property
+    def factory(self):
+        return self._factory
+
+    @factory.setter
+    def factory(self, factory=None):
+        if not callable(factory):
+            error_msg = f'Dispatcher requires a callable action factory, received {factory}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._factory = factory
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @priority.setter
+    def priority(self, priority=None):
+        self._priority = frozenset(priority or list())
+
+    @property
+    def queue_size(self):
+        return self._queue_size
+
+    @queue_size.setter
+    def queue_size(self, queue_size=None):
+        if not isinstance(queue_size, int) or queue_size < 1:
+            error_msg = f'Dispatcher queue size must be a positive integer, received {queue_size}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._queue_size = queue_size
+
+    @property
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+            stats['active'] = len(self._active)
+            return stats
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers=None):
+        if not isinstance(workers, int) or workers < 1:
+            error_msg = f'Dispatcher worker count must be a positive integer, received {workers}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._workers = workers
+
+    def _next(self):
+        # First queued action that is not already running on another worker, with when and what its event was
+        for index, action in enumerate(self._queue):
+            if action not in self._active:
+                del self._queue[index]
+                self._queued[action] -= 1
+                return (action,) + self._submitted[action].popleft()
+        return None, None, None
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                action, submitted, event = self._next() if self._running else (None, None, None)
+                while self._running and action is None:
+                    self._condition.wait()
+                    action, submitted, event = self._next()
+                if not self._running:
+                    return
+                self._active.add(action)
+            # Commands from the control API have no switch edge behind them and aren't interrupts
+            if submitted is not None:
+                metrics.interrupt_latency.labels(self.name, action).observe(self._clock.monotonic() - submitted)
+            try:
+                self.factory(action, submitted, event).run()
+            except Exception:
+                log.exception(f'Action {action} failed')
+                with self._condition:
+                    self._stats['failed'] += 1
+            finally:
+                with self._condition:
+                    self._active.discard(action)
+                    self._stats['dispatched'] += 1
+                    self._condition.notify_all()
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        log.debug(f'Starting dispatcher with {self.workers} workers, queue size {self.queue_size}')
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f'{self.name}-dispatcher-{i}')
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._queue.clear()
+            self._queued.clear()
+            self._submitted.clear()
+            self._condition.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = list()
+
+    def submit(self, action, submitted=None, event=None):
+        # submitted is when the switch edge behind the action happened, None for commands without one
+        with self._condition:
+            self._stats['submitted'] += 1
+            if action in self._coalesce and self._queued[action] and self._submitted[action][-1][1] == event:
+                log.debug(f'Coalescing {action} {event}, already queued')
+                self._stats['coalesced'] += 1
+                return False
+            if len(self._queue) >= self.queue_size:
+                routine = [queued for queued in self._queue if queued not in self.priority]
+                if action not in self.priority or not routine:
+                    log.warning(f'Dispatcher queue full, dropping {action}')
+                    self._stats['dropped'] += 1
+                    return False
+                log.warning(f'Dispatcher queue full, dropping {routine[0]} for {action}')
+                self._queue.remove(routine[0])
+                self._queued[routine[0]] -= 1
+                self._submitted[routine[0]].popleft()
+                self._stats['dropped'] += 1
+            if action in self.priority:
+                # Behind the priority events already queued, an abort switch's last event has to win
+                index = 0
+                while index < len(self._queue) and self._queue[index] in self.priority:
+                    index += 1
+                self._queue.insert(index, action)
+            else:
+                self._queue.append(action)
+            self._queued[action] += 1
+            self._submitted[action].append((submitted, event))
+            self._condition.notify_all()
+            return True
+
+    def wait_idle(self, timeout=None):
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._queue and not self._active, timeout)
@@ -16,3 +16,9 @@ class AbortException(KegwasherException):
 class ConfigError(KegwasherException):
     def __init__(self, message):
         super(ConfigError, self).__init__(message)
+
+
+class ControlError(KegwasherException):
+    # A command the station can't take in its current state
+    def __init__(self, message):
+        super(ControlError, self).__init__(message)
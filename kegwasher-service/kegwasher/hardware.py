@@ -2,20 +2,88 @@
 #
 # Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
 
-import Adafruit_CharLCD as LCD
 import logging
-import RPi.GPIO as GPIO
 import os
+
+from contextlib import nullcontext
+from kegwasher import backend, metrics
+from kegwasher.backend import GPIO
 from kegwasher.pca955x import pca955x
 
 from kegwasher.exceptions import ConfigError
 
 log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
 
+class BufferedDisplay(object):
+    # Keeps a framebuffer of what the LCD shows and, on each message, sends only the cells that changed
+    # using cursor-positioned writes. clear() is deferred to the next message, so the usual
+    # clear()/message() pair costs the countdown digits instead of a slow, flickering clear command.
+    def __init__(self, lcd, columns, rows):
+        self._lcd = lcd
+        self._columns = columns
+        self._rows = rows
+        # None until the first flush, the panel contents are unknown at start-up
+        self._frame = None
+        self._target = [[' '] * columns for row in range(rows)]
+        self._cursor = [0, 0]
+        self._stats = {'bytes': 0, 'commands': 0, 'flushes': 0}
+
+    def __getattr__(self, name):
+        # Anything not buffered (backlight, cursor display, ...) goes straight to the driver
+        return getattr(self._lcd, name)
+
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    @property
+    def text(self):
+        return '\n'.join(''.join(row) for row in self._target)
+
+    def _command(self, func, *args):
+        func(*args)
+        self._stats['commands'] += 1
+        self._stats['bytes'] += 1
+
+    def clear(self):
+        self._target = [[' '] * self._columns for row in range(self._rows)]
+        self._cursor = [0, 0]
+
+    def flush(self):
+        self._stats['flushes'] += 1
+        if self._frame is None:
+            self._command(self._lcd.clear)
+            self._frame = [[' '] * self._columns for row in range(self._rows)]
+        for row in range(self._rows):
+            position = None
+            for column in range(self._columns):
+                char = self._target[row][column]
+                if self._frame[row][column] == char:
+                    continue
+                if position != column:
+                    self._command(self._lcd.set_cursor, column, row)
+                self._lcd.write8(ord(char), True)
+                self._stats['bytes'] += 1
+                self._frame[row][column] = char
+                # The controller advances the cursor after each character
+                position = column + 1
+
+    def message(self, text):
+        for char in text:
+            if char == '\n':
+                self._cursor = [0, self._cursor[1] + 1]
+                continue
+            column, row = self._cursor
+            if row < self._rows and column < self._columns:
+                self._target[row][column] = char
+            self._cursor[0] += 1
+        self.flush()
+
+
 class Display(object):
     def init_display(self, display=dict()):
         log.debug(f'Initializing Display Driver')
-        lcd = LCD.Adafruit_CharLCD(
+        lcd = backend.char_lcd(
             display.get('lcd_rs').get('pin'),
             display.get('lcd_en').get('pin'),
             display.get('lcd_d4').get('pin'),
@@ -25,7 +93,7 @@ class Display(object):
             display.get('lcd_columns'),
             display.get('lcd_rows'),
             display.get('lcd_bl').get('pin'))
-        return lcd
+        return BufferedDisplay(lcd, display.get('lcd_columns'), display.get('lcd_rows'))
 
 
 class Expander(object):
@@ -40,6 +108,11 @@ class Expander(object):
     def GPIO(self):
         return self._gpio
 
+    def transaction(self, urgent=False):
+        if self._gpio is None:
+            return nullcontext()
+        return self._gpio.transaction(urgent)
+
 
 class HardwareObject(object):
     def __init__(self, *args, **kwargs):
@@ -47,9 +120,16 @@ class HardwareObject(object):
         self._expander = None
         self._name = None
         self._pin = None
+        self._value = None
         self.expander = kwargs.get('expander', None)
         self.name = kwargs.get('name', None)
         self.pin = kwargs.get('pin', None)
+        # Device names are only unique within a station
+        self.station = kwargs.get('station', None)
+        # Set by the station's Telemetry while it records, for devices on a Pi pin
+        self.telemetry = None
+        self._switched = {'on': metrics.device_switches.labels(self.station, self.name, 'on'),
+                          'off': metrics.device_switches.labels(self.station, self.name, 'off')}
         self.setup()
 
     @property
@@ -80,13 +160,20 @@ class HardwareObject(object):
 
     @pin.setter
     def pin(self, pin):
-        if not pin:
+        if pin is None:
             error_msg = f'Required attribute "pin" not specified'
             log.fatal(error_msg)
             raise ConfigError(error_msg)
         self._pin = pin
         return self.pin
 
+    @property
+    def value(self):
+        # Last state driven onto the pin, None until the pin has been driven
+        if self.expander:
+            return int(bool(self.expander.GPIO.outputvalue & (1 << self.pin)))
+        return self._value
+
     # Alias to off
     def close(self):
         self.off()
@@ -97,6 +184,10 @@ class HardwareObject(object):
             self.expander.GPIO.output(self.pin, 0)
         else:
             GPIO.output(self.pin, 0)
+            if self.telemetry is not None:
+                self.telemetry.record(self, 0)
+        self._value = 0
+        self._switched['off'].inc()
 
     def on(self):
         log.debug(f'Setting pin {self.pin} to ON/High Voltage')
@@ -104,6 +195,10 @@ class HardwareObject(object):
             self.expander.GPIO.output(self.pin, 1)
         else:
             GPIO.output(self.pin, 1)
+            if self.telemetry is not None:
+                self.telemetry.record(self, 1)
+        self._value = 1
+        self._switched['on'].inc()
 
     # Alias to on
     def open(self):
@@ -174,16 +269,30 @@ class Switch(HardwareObject):
     def PUD(self, PUD=None):
         if not PUD:
             error_msg = f'No PUD defined'
-            log.fata(error_msg)
+            log.fatal(error_msg)
             raise ConfigError(error_msg)
         self._PUD = PUD
         return self.PUD
 
     @property
     def state(self):
+        if self.expander:
+            return self.expander.GPIO.input(self.pin)
         return GPIO.input(self.pin)
 
+    def add_event_detect(self, event, callback):
+        # Edge detection on the Pi pin, or through the expander's interrupt line
+        if self.expander:
+            self.expander.GPIO.add_event_detect(self.pin, event, callback)
+        else:
+            GPIO.add_event_detect(self.pin, event, callback)
+
     def setup(self):
+        if self.expander:
+            # PCA955x inputs have fixed pull-ups, PUD doesn't apply
+            log.debug(f'Setting expander pin {self.pin} to GPIO.IN mode')
+            self.expander.GPIO.setup(self.pin, GPIO.IN)
+            return
         log.debug(f'Setting pin {self.pin} to GPIO.IN mode, Pull-UP/DOWN resistor to {self.PUD}')
         GPIO.setup(self.pin, GPIO.IN, pull_up_down=self.PUD)
 
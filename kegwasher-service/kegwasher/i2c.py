@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import logging
+import os
+import threading
+import time
+
+from kegwasher import metrics
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class _Transfer(object):
+    __slots__ = ('kind', 'address', 'register', 'value', 'word', 'urgent', 'done', 'error')
+
+    def __init__(self, kind, address, register, value=None, word=False, urgent=False):
+        self.kind = kind
+        self.address = address
+        self.register = register
+        self.value = value
+        self.word = word
+        self.urgent = urgent
+        self.done = False
+        self.error = None
+
+
+class I2CBus(object):
+    # Every transfer on one I2C bus goes through here, one at a time, whichever device it is for.
+    # Callers queue their transfers and block until they are done. There is no I/O thread: whoever finds the
+    # bus idle performs queued transfers, its own and other threads', until its own are done.
+    #  - urgent transfers (all-off, abort) are queued ahead of routine ones, taking routine writes already queued
+    #    for the same device along, so writes to one register still go out in the order they were decided
+    #  - a write to a register that already has a write queued, with nothing else for that device queued
+    #    after it, replaces the queued value; callers always write whole registers, so the last value wins
+    #    and both callers wait for the one write
+    # Queue depth and the time the bus spends transferring are exported per bus.
+    def __init__(self, smbus, bus):
+        self._smbus = smbus
+        self.bus = bus
+        self._busy = False
+        self._condition = threading.Condition()
+        self._queue = list()
+        self._started = time.monotonic()
+        self._waiting = 0
+        self._stats = {'reads': 0, 'writes': 0, 'merged': 0, 'max_depth': 0, 'busy_seconds': 0}
+        self._metrics = {name: getattr(metrics, f'i2c_{name}').labels(bus)
+                         for name in ['busy_seconds', 'merged_writes', 'queue_depth']}
+
+    @property
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+            stats['utilization'] = stats['busy_seconds'] / max(time.monotonic() - self._started, 1e-9)
+            return stats
+
+    def _enqueue(self, transfer):
+        # Returns the queued transfer the caller has to wait for, which may be an earlier one it merged into
+        if transfer.kind == 'write':
+            queue = self._queue
+            if transfer.urgent:
+                # Routine writes to the device queued earlier go ahead with it, in their order, or a stale one
+                # would land after it; routine reads stay behind
+                for queued in [queued for queued in self._queue if not queued.urgent and queued.kind == 'write'
+                               and queued.address == transfer.address]:
+                    self._queue.remove(queued)
+                    queued.urgent = True
+                    self._insert(queued)
+                queue = [queued for queued in self._queue if queued.urgent]
+            for queued in reversed(queue):
+                if queued.address != transfer.address:
+                    continue
+                if queued.kind == 'write' and queued.register == transfer.register and queued.word == transfer.word:
+                    queued.value = transfer.value
+                    self._stats['merged'] += 1
+                    self._metrics['merged_writes'].inc()
+                    return queued
+                break
+        self._insert(transfer)
+        self._stats['max_depth'] = max(self._stats['max_depth'], len(self._queue))
+        self._metrics['queue_depth'].set(len(self._queue))
+        return transfer
+
+    def _insert(self, transfer):
+        if not transfer.urgent:
+            self._queue.append(transfer)
+            return
+        index = 0
+        while index < len(self._queue) and self._queue[index].urgent:
+            index += 1
+        self._queue.insert(index, transfer)
+
+    def _perform(self, transfer):
+        start = time.monotonic()
+        try:
+            if transfer.kind == 'read':
+                if transfer.word:
+                    transfer.value = self._smbus.read_word_data(transfer.address, transfer.register)
+                else:
+                    transfer.value = self._smbus.read_byte_data(transfer.address, transfer.register)
+            elif transfer.word:
+                self._smbus.write_word_data(transfer.address, transfer.register, transfer.value)
+            else:
+                self._smbus.write_byte_data(transfer.address, transfer.register, transfer.value)
+        except OSError as e:
+            transfer.error = e
+        return time.monotonic() - start
+
+    def _drive(self, transfer):
+        # Wait for transfer, performing whatever is at the head of the queue whenever the bus is idle
+        while True:
+            with self._condition:
+                while self._busy and not transfer.done:
+                    self._waiting += 1
+                    self._condition.wait()
+                    self._waiting -= 1
+                if transfer.done:
+                    return
+                current = self._queue.pop(0)
+                self._metrics['queue_depth'].set(len(self._queue))
+                self._busy = True
+            elapsed = self._perform(current)
+            with self._condition:
+                current.done = True
+                self._busy = False
+                self._stats[f'{current.kind}s'] += 1
+                self._stats['busy_seconds'] += elapsed
+                self._metrics['busy_seconds'].inc(elapsed)
+                if self._waiting:
+                    self._condition.notify_all()
+
+    def queue_read(self, address, register, word=False, urgent=False):
+        with self._condition:
+            return self._enqueue(_Transfer('read', address, register, word=word, urgent=urgent))
+
+    def queue_write(self, address, register, value, word=False, urgent=False):
+        # Queue a write without waiting for it, so a caller can queue under its own lock and wait outside it.
+        # Writes to one register must be queued in the order their values were decided.
+        with self._condition:
+            return self._enqueue(_Transfer('write', address, register, value, word, urgent))
+
+    def wait(self, transfers):
+        # Block until every queued transfer is done, raising the first error. Returns the values read.
+        for transfer in transfers:
+            self._drive(transfer)
+        for transfer in transfers:
+            if transfer.error is not None:
+                raise transfer.error
+        return [transfer.value for transfer in transfers]
+
+    def read(self, address, register, word=False, urgent=False):
+        return self.wait([self.queue_read(address, register, word, urgent)])[0]
+
+    def write(self, address, register, value, word=False, urgent=False):
+        self.wait([self.queue_write(address, register, value, word, urgent)])
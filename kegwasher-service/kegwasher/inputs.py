@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import collections
+import functools
+import logging
+import os
+import threading
+
+from kegwasher import clock, metrics
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class _Input(object):
+    # Debounce state of one switch
+    def __init__(self, switch, station, emit, latching, debounced):
+        self.device = switch
+        self.name = switch.name
+        self.station = station
+        self.emit = emit
+        # Level switches report changes, buttons report presses
+        self.latching = latching
+        self.debounced = debounced
+        # First edge of a transition that hasn't settled yet, and when the input will have been quiet long enough
+        self.edge = None
+        self.settle = None
+        # Buttons only: when the next long press or repeat is due, and whether one fired during this press
+        self.hold = None
+        self.held = False
+
+
+class InputProcessor(object):
+    # Turns switch edges into clean events on one thread. The GPIO callback only timestamps the edge and
+    # queues it, this thread runs every switch's debounce state machine:
+    #  - a switch has to read the same level for debounce seconds after its last edge before that level counts,
+    #    the event is stamped with the first edge of the transition
+    #  - buttons emit 'press' on release, 'long_press' once held for long_press seconds, then 'repeat' every
+    #    repeat seconds for as long as they stay down; a release after a long press emits nothing
+    #  - level switches (the abort switch, closed in its run position) emit 'asserted' when they open and
+    #    'cleared' when they close again
+    # Each event is handed to the switch's emit(event, timestamp). Edge to event latency is recorded, as is
+    # jitter, how late the thread was for the event's due time; events later than max_jitter are counted in
+    # kegwasher_input_late_events_total and logged. Edges are timestamped on the clock, so debouncing follows a
+    # VirtualClock. The lock only guards the edge queue: switch levels are read and events emitted without it,
+    # so a slow handler never holds up edge capture.
+    def __init__(self, *args, **kwargs):
+        self._debounce = None
+        self._levels = None
+        self._long_press = None
+        self._max_jitter = None
+        self._repeat = None
+        #
+        self.debounce = kwargs.get('debounce', 0.02)
+        self.levels = kwargs.get('levels', ['abort'])
+        self.long_press = kwargs.get('long_press', 1.5)
+        self.max_jitter = kwargs.get('max_jitter', 0.02)
+        self.repeat = kwargs.get('repeat', 0.5)
+        self._clock = kwargs.get('clock', None) or clock.real
+        #
+        self._condition = threading.Condition()
+        self._edges = collections.deque()
+        self._inputs = dict()
+        self._running = False
+        self._stats = {'edges': 0, 'events': 0, 'late': 0}
+        self._thread = None
+
+    @staticmethod
+    def _seconds(name, value):
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+            error_msg = f'Input {name} must be a positive number of seconds, received {value}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        return value
+
+    @property
+    def debounce(self):
+        return self._debounce
+
+    @debounce.setter
+    def debounce(self, debounce=None):
+        self._debounce = self._seconds('debounce', debounce)
+
+    @property
+    def levels(self):
+        return self._levels
+
+    @levels.setter
+    def levels(self, levels=None):
+        self._levels = frozenset(levels or list())
+
+    @property
+    def long_press(self):
+        return self._long_press
+
+    @long_press.setter
+    def long_press(self, long_press=None):
+        self._long_press = self._seconds('long_press', long_press)
+
+    @property
+    def max_jitter(self):
+        return self._max_jitter
+
+    @max_jitter.setter
+    def max_jitter(self, max_jitter=None):
+        self._max_jitter = self._seconds('max_jitter', max_jitter)
+
+    @property
+    def repeat(self):
+        return self._repeat
+
+    @repeat.setter
+    def repeat(self, repeat=None):
+        self._repeat = self._seconds('repeat', repeat)
+        if not self._repeat:
+            error_msg = f'Input repeat must be longer than 0 seconds'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+
+    @property
+    def stats(self):
+        with self._condition:
+            return dict(self._stats)
+
+    def add(self, switch, emit, station=None):
+        # Debounce switch, which must be set up as an input, and hand its events to emit(event, timestamp).
+        # Switches on a Pi pin and on an expander pin may share a pin number, the pair identifies them.
+        key = (switch.expander, switch.pin)
+        with self._condition:
+            self._inputs[key] = _Input(switch, station, emit, switch.action in self._levels, bool(switch.state))
+        switch.add_event_detect(switch.event, functools.partial(self._edge, key))
+
+    def _edge(self, key, *args):
+        # GPIO callback, keep it short: note when the edge happened and let the input thread look at it
+        now = self._clock.monotonic()
+        with self._condition:
+            self._edges.append((key, now))
+            self._stats['edges'] += 1
+            self._condition.notify()
+
+    def _emit(self, switch, event, timestamp, due, now):
+        latency, jitter = now - timestamp, max(now - due, 0)
+        metrics.input_latency.labels(switch.station, event).observe(latency)
+        metrics.input_jitter.labels(switch.station).observe(jitter)
+        late = jitter > self._max_jitter
+        with self._condition:
+            self._stats['events'] += 1
+            self._stats['late'] += late
+        if late:
+            metrics.input_late.labels(switch.station).inc()
+            log.warning(f'Switch {switch.name} {event} was {round(jitter * 1000, 1)}ms late')
+        log.debug(f'Switch {switch.name} {event}, {round(latency * 1000, 1)}ms after its edge')
+        try:
+            switch.emit(event, timestamp)
+        except Exception:
+            log.exception(f'Handling switch {switch.name} {event} failed')
+
+    def _settled(self, switch, now):
+        # The switch has been quiet for the debounce time, see where it ended up
+        edge, due = switch.edge, switch.settle
+        switch.edge, switch.settle = None, None
+        level = bool(switch.device.state)
+        if level == switch.debounced:
+            # A glitch, or a press and release both shorter than the debounce time
+            return
+        switch.debounced = level
+        if switch.latching:
+            self._emit(switch, 'cleared' if level else 'asserted', edge, due, now)
+        elif level:
+            switch.hold, switch.held = edge + self._long_press, False
+        else:
+            if not switch.held:
+                self._emit(switch, 'press', edge, due, now)
+            switch.hold, switch.held = None, False
+
+    def _held(self, switch, now):
+        due = switch.hold
+        event = 'repeat' if switch.held else 'long_press'
+        switch.held = True
+        # Catch up without a burst if the thread was held up for more than one repeat period
+        while switch.hold <= now:
+            switch.hold += self._repeat
+        self._emit(switch, event, due, due, now)
+
+    def _run(self):
+        while True:
+            # Take the queued edges and the switches under the lock, everything else happens outside it
+            with self._condition:
+                if not self._running:
+                    return
+                edges, self._edges = self._edges, collections.deque()
+                inputs = list(self._inputs.items())
+            switches = dict(inputs)
+            for key, timestamp in edges:
+                switch = switches.get(key, None)
+                if switch is None:
+                    continue
+                if switch.edge is None:
+                    switch.edge = timestamp
+                switch.settle = timestamp + self._debounce
+            now = self._clock.monotonic()
+            wake = None
+            for key, switch in inputs:
+                if switch.settle is not None and switch.settle <= now:
+                    self._settled(switch, now)
+                if switch.hold is not None and switch.hold <= now and switch.edge is None:
+                    self._held(switch, now)
+                # Holding only counts while the switch is steady
+                due = switch.settle if switch.edge is not None else switch.hold
+                if due is not None and (wake is None or due < wake):
+                    wake = due
+            with self._condition:
+                if self._running and not self._edges:
+                    self._clock.wait(self._condition, None if wake is None else max(wake - self._clock.monotonic(), 0))
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        log.debug(f'Starting input processor, debounce {self._debounce}s, long press {self._long_press}s')
+        self._thread = threading.Thread(target=self._run, name='kegwasher-inputs')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from kegwasher import clock
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+# How a step interrupted by a power loss is picked up again:
+#   continue - run the seconds the step had left
+#   restart  - run the whole step again
+#   rewind   - run the step before it again first, e.g. a closed loop that has to be primed by the previous step
+resume_modes = ('continue', 'restart', 'rewind')
+
+
+def fingerprint(program):
+    # Identifies a program's steps, a journal written for a since-edited program is not resumed
+    return zlib.crc32(repr([(step.operation, step.seconds) for step in program.steps]).encode())
+
+
+def resume_point(program, step, elapsed, rules=None):
+    # Where to pick program up again after step ran for elapsed seconds, as (step, remaining) for Action.
+    # rules maps operation names to a resume mode, 'default' applies to every other operation.
+    rules = rules or dict()
+    default = rules.get('default', 'restart')
+    while True:
+        rule = rules.get(program.steps[step].operation, default)
+        if rule == 'continue':
+            if elapsed < program.steps[step].seconds:
+                return step, program.steps[step].seconds - elapsed
+            if step + 1 < len(program.steps):
+                # The step had run its course, carry on with the next one
+                return step + 1, program.steps[step + 1].seconds
+        if rule == 'rewind' and step > 0:
+            step, elapsed = step - 1, 0
+            continue
+        return step, program.steps[step].seconds
+
+
+def validate_rules(rules, operations):
+    for operation, rule in (rules or dict()).items():
+        if operation != 'default' and operation not in operations:
+            error_msg = f'Resume rule for unknown operation {operation}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        if rule not in resume_modes:
+            error_msg = f'Resume rule for {operation} must be one of {resume_modes}, received {rule}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+    return dict(rules or dict())
+
+
+class Journal(object):
+    # Append-only record of a station's program run, so a run cut short by a power loss can be resumed.
+    # One JSON object per line: start, step and cancel/end records are synced to disk as they happen,
+    # the per-second progress records are buffered and synced every sync_interval seconds so the SD card
+    # sees a handful of writes per step rather than one per second, counted on the station's clock. A line torn
+    # by the power loss is skipped when reading back. Each run starts a fresh file.
+    def __init__(self, *args, **kwargs):
+        self._file = None
+        self._lock = threading.Lock()
+        self._path = None
+        self._pending = list()
+        self._sync_interval = None
+        self._synced = 0
+        self._syncs = 0
+        #
+        self.path = kwargs.get('path', None)
+        self.sync_interval = kwargs.get('sync_interval', 10)
+        self._clock = kwargs.get('clock', None) or clock.real
+
+    @property
+    def path(self):
+        return self._path
+
+    @path.setter
+    def path(self, path=None):
+        if not path:
+            error_msg = f'Journal needs a path, received {path}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._path = path
+
+    @property
+    def stats(self):
+        return {'syncs': self._syncs, 'pending': len(self._pending)}
+
+    @property
+    def sync_interval(self):
+        return self._sync_interval
+
+    @sync_interval.setter
+    def sync_interval(self, sync_interval=None):
+        if not isinstance(sync_interval, (int, float)) or sync_interval < 0:
+            error_msg = f'Journal sync_interval must be a positive number of seconds, received {sync_interval}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._sync_interval = sync_interval
+
+    def _append(self, record, sync=True):
+        with self._lock:
+            if self._file is None:
+                return
+            self._pending.append(json.dumps(record, separators=(',', ':')) + '\n')
+            if sync or self._clock.monotonic() - self._synced >= self._sync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.write(''.join(self._pending))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = list()
+        self._synced = self._clock.monotonic()
+        self._syncs += 1
+
+    def begin(self, program, step=0):
+        # Start a new run of program from step, dropping whatever the previous run left behind
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            created = not os.path.exists(self._path)
+            self._file = open(self._path, 'w')
+            self._pending = list()
+            if created:
+                # The new directory entry has to survive the power loss too
+                directory = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY)
+                try:
+                    os.fsync(directory)
+                finally:
+                    os.close(directory)
+        self._append({'event': 'start', 'mode': program.name, 'fingerprint': fingerprint(program), 'step': step,
+                       'time': time.time()})
+
+    def step(self, index, operation, elapsed=0):
+        self._append({'event': 'step', 'step': index, 'operation': operation, 'elapsed': elapsed})
+
+    def progress(self, index, elapsed):
+        self._append({'event': 'progress', 'step': index, 'elapsed': elapsed}, sync=False)
+
+    def cancel(self, index, elapsed):
+        self._append({'event': 'cancel', 'step': index, 'elapsed': elapsed})
+
+    def end(self):
+        self._append({'event': 'end', 'time': time.time()})
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            if self._pending:
+                self._sync()
+            self._file.close()
+            self._file = None
+
+    def recover(self):
+        # The unfinished run the journal describes as {'mode', 'fingerprint', 'step', 'elapsed'}, or None
+        try:
+            with open(self._path) as journal:
+                lines = journal.readlines()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            log.warning(f'Unable to read journal {self._path}: {e}')
+            return None
+        run = None
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                log.warning(f'Skipping torn journal record in {self._path}')
+                continue
+            event = record.get('event', None)
+            if event == 'start':
+                run = {'mode': record['mode'], 'fingerprint': record['fingerprint'], 'step': record['step'],
+                       'elapsed': 0}
+            elif run is None:
+                continue
+            elif event in ('step', 'progress', 'cancel'):
+                run.update(step=record['step'], elapsed=record['elapsed'])
+            elif event == 'end':
+                run = None
+        return run
@@ -2,14 +2,35 @@
 #
 # Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
 
-from kegwasher.config import pin_config, mode_config
-from kegwasher.service import KegWasher
+from kegwasher.startup import StartupReport
+
+startup = StartupReport()
+startup.mark('interpreter')
+
+from kegwasher import configfile
+from kegwasher.config import pin_config, mode_config, service_config
+from kegwasher.stations import Stations
+
+startup.mark('import')
 
 def main():
-    keg_washer = KegWasher(pin_config, mode_config)
-    keg_washer.daemon = True
-    keg_washer.start()
-    keg_washer.join()
+    startup.budget = service_config.get('startup_budget', None)
+    pins, modes = pin_config, mode_config
+    config_file = service_config.get('config_file', dict())
+    if config_file.get('path', None):
+        # Sections the file leaves out keep their config.py defaults
+        loaded_pins, loaded_modes = configfile.load(config_file['path'], config_file.get('cache_dir', None))
+        pins, modes = loaded_pins or pins, loaded_modes or modes
+        startup.mark('config file')
+    stations = Stations(pins, modes, service_config, startup=startup)
+    stations.start()
+    try:
+        ready = stations.wait_ready(startup.budget)
+        startup.mark('first frame')
+        startup.report(ready)
+        stations.join()
+    except KeyboardInterrupt:
+        stations.shutdown()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -2,6 +2,8 @@
 #
 # Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
 
+import threading
+
 
 class Node(object):
     def __init__(self, data):
@@ -13,6 +15,8 @@ class Node(object):
 class CircularDoublyLinkedList(object):
     def __init__(self):
         self.head = None
+        # Moving the head and replacing the ring may happen on different threads
+        self._lock = threading.Lock()
 
     @property
     def data(self):
@@ -51,7 +55,14 @@ class CircularDoublyLinkedList(object):
         self.head = new_node
 
     def next(self):
-        self.head = self.head.next
+        with self._lock:
+            self.head = self.head.next
 
     def previous(self):
-        self.head = self.head.previous
+        with self._lock:
+            self.head = self.head.previous
+
+    def replace(self, head):
+        # Switch to another ring, built beforehand, in one step
+        with self._lock:
+            self.head = head
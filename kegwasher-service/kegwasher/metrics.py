@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import bisect
+import logging
+import os
+import threading
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class _Value(object):
+    # One labelled series. inc/set are a lock and an add, cheap enough for the device on/off path.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+
+class Metric(object):
+    # A named metric with fixed label names. labels() returns the series for one set of label values,
+    # callers on hot paths keep hold of it instead of looking it up every time.
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self._lock = threading.Lock()
+        self._series = dict()
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.name = name
+
+    def _new(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        series = self._series.get(values, None)
+        if series is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f'{self.name} expects labels {self.labelnames}, received {values}')
+            with self._lock:
+                series = self._series.setdefault(values, self._new())
+        return series
+
+    def _labelstring(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                   for name, value in pairs]
+        return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for values, series in sorted(self._series.items()):
+            lines.extend(self._render(values, series))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new(self):
+        return _Value()
+
+    def _render(self, values, series):
+        return [f'{self.name}{self._labelstring(values)} {series.value}']
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new(self):
+        return _Histogram(self.buckets)
+
+    def _render(self, values, series):
+        lines = list()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), series.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f'{self.name}_bucket{self._labelstring(values, [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{self._labelstring(values)} {series.sum}')
+        lines.append(f'{self.name}_count{self._labelstring(values)} {series.count}')
+        return lines
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = dict()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.default_buckets):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = list()
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # Written beside the target and renamed over it, so the node exporter never reads half a file
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'w') as textfile:
+            textfile.write(self.render())
+        os.replace(temp, path)
+
+
+def _http_server(address, port, registry):
+    # http.server is slow to import and only needed when the endpoint is switched on
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ['/', '/metrics']:
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(f'Metrics request from {self.address_string()}: {format % args}')
+
+    server = MetricsServer((address, port), MetricsHandler)
+    server.registry = registry
+    return server
+
+
+class Exporter(object):
+    # Publishes a registry on a local HTTP endpoint, to a node exporter textfile-collector file, or both
+    def __init__(self, *args, **kwargs):
+        self._registry = kwargs.get('registry', registry)
+        self._address = kwargs.get('address', '127.0.0.1')
+        self._port = int(kwargs.get('port', 0) or 0)
+        self._textfile = kwargs.get('textfile', None)
+        self._textfile_interval = kwargs.get('textfile_interval', 15)
+        self._server = None
+        self._stopped = threading.Event()
+        self._threads = list()
+
+    @property
+    def port(self):
+        return self._server.server_address[1] if self._server else None
+
+    def _textfile_loop(self):
+        while True:
+            try:
+                self._registry.write_textfile(self._textfile)
+            except OSError as e:
+                log.warning(f'Unable to write metrics to {self._textfile}: {e}')
+            if self._stopped.wait(self._textfile_interval):
+                return
+
+    def start(self):
+        # Port 0 leaves the HTTP endpoint off
+        if self._port:
+            self._server = _http_server(self._address, self._port, self._registry)
+            log.info(f'Serving metrics on http://{self._address}:{self.port}/metrics')
+            self._threads.append(threading.Thread(target=self._server.serve_forever, name='metrics-http'))
+        if self._textfile:
+            log.info(f'Writing metrics to {self._textfile} every {self._textfile_interval} seconds')
+            self._threads.append(threading.Thread(target=self._textfile_loop, name='metrics-textfile'))
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        for t in self._threads:
+            t.join()
+        self._threads = list()
+
+
+registry = Registry()
+
+# Metrics recorded by the service
+abort_latency = registry.histogram(
+    'kegwasher_abort_latency_seconds', 'Time from the abort switch interrupt to all devices off', ['station'])
+action_threads = registry.gauge(
+    'kegwasher_action_threads', 'Action threads currently alive', ['station'])
+device_switches = registry.counter(
+    'kegwasher_device_switches_total', 'Devices switched through on/off', ['station', 'device', 'state'])
+i2c_busy_seconds = registry.counter(
+    'kegwasher_i2c_busy_seconds_total', 'Time the I2C bus spent transferring, its rate is the bus utilization', ['bus'])
+i2c_errors = registry.counter(
+    'kegwasher_i2c_errors_total', 'Failed I2C transfers', ['bus', 'expander'])
+i2c_merged_writes = registry.counter(
+    'kegwasher_i2c_merged_writes_total', 'Register writes merged into one already queued', ['bus'])
+i2c_queue_depth = registry.gauge(
+    'kegwasher_i2c_queue_depth', 'Transfers waiting for the I2C bus', ['bus'])
+i2c_reads = registry.counter(
+    'kegwasher_i2c_reads_total', 'I2C register reads', ['bus', 'expander'])
+i2c_writes = registry.counter(
+    'kegwasher_i2c_writes_total', 'I2C register writes', ['bus', 'expander'])
+input_jitter = registry.histogram(
+    'kegwasher_input_jitter_seconds', 'How late the input thread emitted a debounced switch event', ['station'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1))
+input_late = registry.counter(
+    'kegwasher_input_late_events_total', 'Debounced switch events emitted later than max_jitter', ['station'])
+input_latency = registry.histogram(
+    'kegwasher_input_latency_seconds', 'Time from a switch edge to its debounced event', ['station', 'event'],
+    buckets=(0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5))
+interrupt_latency = registry.histogram(
+    'kegwasher_interrupt_latency_seconds', 'Time from a switch edge to its action starting', ['station', 'action'])
+resource_wait = registry.histogram(
+    'kegwasher_resource_wait_seconds', 'Time a station waited for shared resources before a step', ['station'],
+    buckets=(0.001, 0.01, 0.1, 1, 5, 10, 30, 60, 120, 300, 600))
+startup_seconds = registry.gauge(
+    'kegwasher_startup_seconds', 'Time taken by each phase of daemon start-up', ['phase'])
+step_overrun = registry.histogram(
+    'kegwasher_step_overrun_seconds', 'How late a program step ended against its deadline, pauses excluded',
+    ['station', 'operation'], buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+step_seconds = registry.histogram(
+    'kegwasher_step_seconds', 'Time a completed program step ran for, pauses excluded', ['station', 'operation'],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200))
@@ -2,129 +2,231 @@
 #
 # Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
 
+import functools
 import logging
 import os
 
+from contextlib import contextmanager, ExitStack
+
 from kegwasher.exceptions import ConfigError
 
 log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
 
 
+def batched(func):
+    # Run the wrapped operation inside one transaction so each expander sees a single port write
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.transaction():
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 class Operations(object):
+    # Devices each operation switches on, every other valve, pump and heater is off/closed
+    operation_devices = {
+        'air_fill_closed': {'valves': ['air_in']},
+        'air_fill_open':   {'valves': ['air_in', 'waste_out']},
+        'all_off_closed':  {},
+        'clean_closed':    {'valves': ['cleaner_in', 'cleaner_rtn', 'pump_in', 'pump_out'],
+                            'pumps': ['pump_1'], 'heaters': ['heater_1']},
+        'clean_open':      {'valves': ['cleaner_in', 'waste_out', 'pump_in', 'pump_out'],
+                            'pumps': ['pump_1'], 'heaters': ['heater_1']},
+        'cleaner_fill':    {'valves': ['water_in', 'cleaner_in']},
+        'co2_fill_closed': {'valves': ['co2_in']},
+        'co2_fill_open':   {'valves': ['co2_in', 'waste_out']},
+        'drain':           {'valves': ['waste_out', 'air_in']},
+        'rinse':           {'valves': ['water_in', 'pump_in', 'pump_out', 'waste_out'],
+                            'pumps': ['pump_1'], 'heaters': ['heater_1']},
+        'sanitize':        {'valves': ['sanitizer_in', 'pump_in', 'pump_out', 'waste_out'],
+                            'pumps': ['pump_1'], 'heaters': ['heater_1']},
+        'sanitizer_fill':  {'valves': ['water_in', 'sanitizer_in']}
+    }
+
     def __init__(self, *args, **kwargs):
         self._hardware = kwargs.get('hardware', None)
         if not self._hardware:
             error_msg = f'Hardware configuration not provided'
             log.fatal(error_msg)
             raise ConfigError(error_msg)
-
+        self._current = None
+        # Every output device, and the expander bits they occupy
+        self._devices = list()
+        self._managed = dict()
+        for kind in ['valves', 'pumps', 'heaters']:
+            for device in self._hardware.get(kind, dict()).values():
+                self._devices.append(device)
+                if device.expander:
+                    self._managed[device.expander] = self._managed.get(device.expander, 0) | (1 << device.pin)
+        self._gpio_devices = [device for device in self._devices if not device.expander]
+        # Stations with their own device names can bring their own operation table
+        operation_devices = kwargs.get('operation_devices', None) or self.operation_devices
+        # The table in use, for tools that reason about what operations do
+        self.operation_devices = operation_devices
+        self._compiled = self._compile(operation_devices)
+        self._resources = self._derive_resources(operation_devices)
+        # Operation name to handler, built once and shared by every Action. Only the built-in operations have
+        # methods of their own, any other name is a plain transition even if it matches an attribute.
+        self._operation_map = {operation: getattr(self, operation) if operation in Operations.operation_devices
+                               else functools.partial(self.transition, operation) for operation in self._compiled}
+
+    def _compile(self, operation_devices):
+        # Resolve each operation to {expander: target output mask} plus the direct GPIO devices it turns on
+        log.debug(f'Compiling operation bitmasks')
+        compiled = dict()
+        for operation, kinds in operation_devices.items():
+            masks = {expander: 0 for expander in self._managed}
+            gpio_on = set()
+            for kind, names in kinds.items():
+                for name in names:
+                    device = self._hardware.get(kind, dict()).get(name, None)
+                    if not device:
+                        error_msg = f'Operation {operation} uses unknown {kind} device {name}'
+                        log.fatal(error_msg)
+                        raise ConfigError(error_msg)
+                    if device.expander:
+                        masks[device.expander] |= 1 << device.pin
+                    else:
+                        gpio_on.add(device)
+            compiled[operation] = (masks, frozenset(gpio_on))
+        return compiled
+
+    @staticmethod
+    def _derive_resources(operation_devices):
+        # Shared utilities each operation draws on: the number of heaters and pumps it runs (power budget)
+        # and every valve it opens by name (supply lines such as co2_in or water_in)
+        resources = dict()
+        for operation, kinds in operation_devices.items():
+            needs = dict()
+            for kind in ['heaters', 'pumps']:
+                if kinds.get(kind, None):
+                    needs[kind] = len(kinds[kind])
+            for valve in kinds.get('valves', list()):
+                needs[valve] = 1
+            resources[operation] = needs
+        return resources
+
+    @property
+    def current(self):
+        return self._current
+
+    @property
+    def operation_map(self):
+        return self._operation_map
+
+    @property
+    def resources(self):
+        return self._resources
+
+    def transition(self, operation):
+        # Move from the current device state to the operation's, writing only what differs
+        log.debug(f'Operation state {operation}')
+        masks, gpio_on = self._compiled[operation]
+        for expander, mask in masks.items():
+            expander.GPIO.output_mask(self._managed[expander], mask)
+        for device in self._gpio_devices:
+            if device in gpio_on:
+                if device.value != 1:
+                    device.on()
+            elif device.value != 0:
+                device.off()
+        self._current = operation
+
+    @contextmanager
+    def transaction(self, urgent=False):
+        # Expanders are always entered in the same order, so concurrent transactions can't deadlock.
+        # Urgent transactions are written ahead of routine traffic on the bus.
+        with ExitStack() as stack:
+            for expander in self._hardware.get('expanders', dict()).values():
+                stack.enter_context(expander.transaction(urgent))
+            yield self
+
+    @batched
     def heaters_off(self, *args):
         for heater in args:
             log.debug(f'Requesting {heater} heater state to off')
             self._hardware.get('heaters').get(heater).off()
 
+    @batched
     def heaters_on(self, *args):
         for heater in args:
             log.debug(f'Requesting {heater} heater state to on')
             self._hardware.get('heaters').get(heater).on()
 
+    @batched
     def pumps_off(self, *args):
         for pump in args:
             log.debug(f'Requesting {pump} pump state to off')
             self._hardware.get('pumps').get(pump).off()
 
+    @batched
     def pumps_on(self, *args):
         for pump in args:
             log.debug(f'Requesting {pump} pump state to on')
             self._hardware.get('pumps').get(pump).on()
 
+    @batched
     def valves_close(self, *args):
         for valve in args:
             log.debug(f'Requesting {valve} valve state to closed')
             self._hardware.get('valves').get(valve).close()
 
+    @batched
     def valves_open(self, *args):
         for valve in args:
             log.debug(f'Requesting {valve} valve state to open')
             self._hardware.get('valves').get(valve).open()
 
+    @batched
     def all_heaters_off(self):
         log.debug(f'Requesting all heaters off')
         self.heaters_off(*self._hardware.get('heaters').keys())
 
+    @batched
     def all_pumps_off(self):
         log.debug(f'Requesting all pumps off')
         self.pumps_off(*self._hardware.get('pumps').keys())
 
+    @batched
     def all_valves_closed(self):
         log.debug(f'Requisting all valves closed')
         self.valves_close(*self._hardware.get('valves').keys())
 
     def all_off_closed(self):
+        # Safety critical, used by abort and shutdown, so it jumps the I2C queue
         log.debug(f'Requesting all devices off, all valves closed')
-        self.all_pumps_off()
-        self.all_heaters_off()
-        self.all_valves_closed()
+        with self.transaction(urgent=True):
+            self.transition('all_off_closed')
 
     def air_fill_closed(self):
-        log.debug('Operation state air_fill_closed')
-        self.all_off_closed()
-        self.valves_open('air_in')
+        self.transition('air_fill_closed')
 
     def air_fill_open(self):
-        log.debug('Operation state air_fill_open')
-        self.all_off_closed()
-        self.valves_open('air_in', 'waste_out')
+        self.transition('air_fill_open')
 
     def clean_closed(self):
-        log.debug('Operation state clean_closed')
-        self.all_off_closed()
-        self.valves_open('cleaner_in', 'cleaner_rtn', 'pump_in', 'pump_out')
-        self.pumps_on('pump_1')
-        self.heaters_on('heater_1')
+        self.transition('clean_closed')
 
     def clean_open(self):
-        log.debug('Operation state clean_open')
-        self.all_off_closed()
-        self.valves_open('cleaner_in', 'waste_out', 'pump_in', 'pump_out')
-        self.pumps_on('pump_1')
-        self.heaters_on('heater_1')
+        self.transition('clean_open')
 
     def cleaner_fill(self):
-        log.debug('Operation state cleaner_fill')
-        self.all_off_closed()
-        self.valves_open('water_in', 'cleaner_in')
+        self.transition('cleaner_fill')
 
     def co2_fill_closed(self):
-        log.debug('Operation state co2_fill_closed')
-        self.all_off_closed()
-        self.valves_open('co2_in')
+        self.transition('co2_fill_closed')
 
     def co2_fill_open(self):
-        log.debug('Operation state co2_fill_open')
-        self.all_off_closed()
-        self.valves_open('co2_in', 'waste_out')
+        self.transition('co2_fill_open')
 
     def drain(self):
-        log.debug('Operation state drain')
-        self.all_off_closed()
-        self.valves_open('waste_out', 'air_in')
+        self.transition('drain')
 
     def rinse(self):
-        log.debug('Operation state rinse')
-        self.all_off_closed()
-        self.valves_open('water_in', 'pump_in', 'pump_out', 'waste_out')
-        self.pumps_on('pump_1')
-        self.heaters_on('heater_1')
+        self.transition('rinse')
 
     def sanitize(self):
-        log.debug('Operation state sanitize')
-        self.all_off_closed()
-        self.valves_open('sanitizer_in', 'pump_in', 'pump_out', 'waste_out')
-        self.pumps_on('pump_1')
-        self.heaters_on('heater_1')
+        self.transition('sanitize')
 
     def sanitizer_fill(self):
-        log.debug('Operation state santizer_fill')
-        self.all_off_closed()
-        self.valves_open('water_in', 'sanitizer_in')
+        self.transition('sanitizer_fill')
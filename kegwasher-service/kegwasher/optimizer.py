@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import argparse
+import collections
+import difflib
+import json
+import logging
+import os
+import sys
+
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+# What the optimizer did to a mode: 'drop' removes a step, 'merge' folds steps into one. index is the position
+# of the first step in the original program, steps the (operation, seconds) it replaced, result the new step.
+Change = collections.namedtuple('Change', ['kind', 'index', 'steps', 'result'])
+# Per mode: step counts before and after, cycle seconds before and after (transition cost included), the
+# theoretical minimum cycle under the dwell rules, steps shorter than their dwell, and the changes made
+Report = collections.namedtuple('Report', [
+    'name', 'steps', 'optimized_steps', 'seconds', 'optimized_seconds', 'minimum_seconds', 'violations', 'changes'])
+
+
+def validate_dwell(rules=None, operation_devices=dict()):
+    # {operation: seconds}, the shortest time a step of that operation may last; 'default' covers the rest
+    rules = dict(rules or dict())
+    for operation, seconds in rules.items():
+        if operation != 'default' and operation not in operation_devices:
+            error_msg = f'Minimum dwell set for unknown operation {operation}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        if not isinstance(seconds, (int, float)) or isinstance(seconds, bool) or seconds < 0:
+            error_msg = f'Minimum dwell of {operation} must be a positive number of seconds, received {seconds}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+    return rules
+
+
+def _signature(operation_devices, operation):
+    # The devices an operation leaves on, every other device is off whatever the operation is called
+    return frozenset((kind, name) for kind, names in operation_devices[operation].items() for name in names)
+
+
+def _dwell(rules, operation):
+    return rules.get(operation, rules.get('default', 0))
+
+
+def _groups(operations, operation_devices, resume_rules):
+    # The original steps each optimized step stands for, [[(index, operation, seconds)]], and the dropped steps
+    groups, dropped = list(), list()
+    for index, (operation, seconds) in enumerate(operations):
+        if seconds == 0:
+            dropped.append(Change('drop', index, ((operation, seconds),), None))
+            continue
+        if groups:
+            previous = groups[-1][-1][1]
+            if _signature(operation_devices, previous) == _signature(operation_devices, operation) and \
+                    resume_rules.get(previous, resume_rules.get('default', None)) == \
+                    resume_rules.get(operation, resume_rules.get('default', None)):
+                groups[-1].append((index, operation, seconds))
+                continue
+        groups.append([(index, operation, seconds)])
+    if not groups:
+        # Nothing but 0 second steps, leave the program as it is rather than empty
+        return [[(index, operation, seconds)] for index, (operation, seconds) in enumerate(operations)], list()
+    return groups, dropped
+
+
+def optimize_program(operations, operation_devices, resume_rules=None):
+    # Returns (steps, changes) for one program's [(operation, seconds)]. Only changes that leave every device
+    # in the state it would have been in, for as long, are made:
+    #  - a step of 0 seconds is dropped, the next step's transition sets every device anyway
+    #  - adjacent steps driving the same devices are merged into one step as long as both together, named
+    #    after the longer of them. Steps that would resume differently after a power loss are left apart.
+    groups, changes = _groups(operations, operation_devices, resume_rules or dict())
+    steps = list()
+    for group in groups:
+        longest = max(group, key=lambda step: step[2])
+        step = (longest[1], sum(seconds for index, operation, seconds in group))
+        if len(group) > 1:
+            changes.append(Change('merge', group[0][0],
+                                  tuple((operation, seconds) for index, operation, seconds in group), step))
+        steps.append(step)
+    changes.sort(key=lambda change: change.index)
+    return steps, changes
+
+
+def _cycle(steps, transition):
+    return sum(seconds for operation, seconds in steps) + transition * len(steps)
+
+
+def optimize_modes(mode_config, operation_devices, min_dwell=None, resume_rules=None, transition=0):
+    # Returns (optimized mode_config, [Report]). transition is what each step change costs on top of the step,
+    # valve travel for instance. The minimum cycle is every optimized step cut to its dwell rule, for a merged
+    # step the longest rule among the steps it replaced.
+    min_dwell = validate_dwell(min_dwell, operation_devices)
+    optimized, reports = dict(), list()
+    for name, mode in mode_config.items():
+        operations = [tuple(step) for step in mode['operations']]
+        steps, changes = optimize_program(operations, operation_devices, resume_rules)
+        groups = _groups(operations, operation_devices, resume_rules or dict())[0]
+        dwell = [max(_dwell(min_dwell, operation) for index, operation, seconds in group) for group in groups]
+        violations = [(index, operation, seconds, dwell[index]) for index, (operation, seconds) in enumerate(steps)
+                      if seconds < dwell[index]]
+        optimized[name] = dict(mode, operations=steps)
+        reports.append(Report(name, len(operations), len(steps), _cycle(operations, transition),
+                              _cycle(steps, transition), sum(dwell) + transition * len(steps), violations, changes))
+    return optimized, reports
+
+
+def diff(mode_config, optimized):
+    # Unified diff of the programs, one step per line
+    def lines(modes):
+        for name, mode in modes.items():
+            yield f'[{name}] {mode["display_name"]}\n'
+            for operation, seconds in mode['operations']:
+                yield f'    {operation:<18}{seconds:>6}\n'
+    return ''.join(difflib.unified_diff(list(lines(mode_config)), list(lines(optimized)), 'configured', 'optimized'))
+
+
+def summary(report):
+    text = f'{report.name}: {report.steps} -> {report.optimized_steps} steps, ' \
+           f'{report.seconds}s -> {report.optimized_seconds}s, minimum {report.minimum_seconds}s'
+    for index, operation, seconds, dwell in report.violations:
+        text += f', step {index} {operation} runs {seconds}s of its {dwell}s minimum'
+    return text
+
+
+def _rule(text):
+    operation, sep, seconds = text.partition('=')
+    try:
+        return operation, float(seconds) if '.' in seconds else int(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expecting operation=seconds, received {text}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge and drop redundant mode program steps and report cycle times')
+    parser.add_argument('file', nargs='?', help='TOML or JSON configuration or modes file, the built-in modes if left out')
+    parser.add_argument('-d', '--min-dwell', type=_rule, action='append', default=list(),
+                        help='operation=seconds, the shortest a step may last; repeatable, default= covers the rest')
+    parser.add_argument('-t', '--transition', type=float, default=None, help='seconds each step change costs')
+    parser.add_argument('-o', '--output', help='write the optimized modes here as JSON, usable as KEGWASHER_MODES_FILE')
+    args = parser.parse_args(argv)
+    # Modes, operations and rules are imported here, config.py reads the environment
+    from kegwasher import configfile
+    from kegwasher.config import mode_config, service_config
+    from kegwasher.operations import Operations
+    log.setLevel(logging.CRITICAL + 1)
+    options = service_config.get('optimizer', dict())
+    operation_devices = Operations.operation_devices
+    try:
+        if args.file:
+            with open(args.file, 'rb') as config_file:
+                document = configfile.parse(config_file.read(), args.file)
+            if isinstance(document, dict) and ('modes' in document or 'hardware' in document):
+                pin_config, modes = configfile.check(document, args.file)
+                if pin_config and pin_config.get('operations', None):
+                    operation_devices = pin_config['operations']
+                mode_config = modes or mode_config
+            else:
+                mode_config = configfile.check({'modes': document}, args.file)[1]
+        min_dwell = dict(options.get('min_dwell', dict()), **dict(args.min_dwell))
+        transition = options.get('transition', 0) if args.transition is None else args.transition
+        resume_rules = service_config.get('journal', dict()).get('resume', None)
+        optimized, reports = optimize_modes(mode_config, operation_devices, min_dwell, resume_rules, transition)
+    except (ConfigError, OSError) as e:
+        sys.stderr.write(f'{e}\n')
+        return 1
+    for report in reports:
+        sys.stdout.write(summary(report) + '\n')
+    sys.stdout.write(diff(mode_config, optimized))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(optimized, output, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,12 +4,31 @@
 
 import logging
 import os
-import smbus2
+import threading
 
+from contextlib import contextmanager
+
+from kegwasher import backend, clock, metrics
+from kegwasher.backend import GPIO
 from kegwasher.exceptions import ConfigError
+from kegwasher.i2c import I2CBus
 
 log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
 
+# One open handle and transfer queue per I2C bus, shared by every expander on it, {(backend, bus): I2CBus}
+_buses = dict()
+_buses_lock = threading.Lock()
+
+
+def _shared_bus(bus):
+    # Each smbus2 transfer selects the slave address and then transfers, so two expanders on the same
+    # bus must not interleave; their transfers are queued on the bus and performed one at a time
+    with _buses_lock:
+        key = (backend.selected(), bus)
+        if key not in _buses:
+            _buses[key] = I2CBus(backend.smbus(bus), bus)
+        return _buses[key]
+
 
 class pca955x(object):
     def __init__(self, *args, **kwargs):
@@ -19,21 +38,53 @@ class pca955x(object):
             'POLARITY_PORT': 2,
             'CONFIG_PORT': 3
         }
+        self._verify_policies = ['never', 'commit', 'periodic']
+        self._clock = kwargs.get('clock', clock.real)
         #
         self._address = None
         self._bus = None
-        self._direction = None
         self._gpios = None
-        self._outputvalue = None
+        self._verify = None
+        self._verify_interval = None
+        # Authoritative copies of the OUTPUT, CONFIG and POLARITY registers, {port: value}
+        self._shadow = dict()
+        self._drift_count = 0
+        self._last_verify = 0
+        # INPUT register as of the last interrupt, and edge detection per input pin {pin: [edge, callbacks]}
+        self._events = dict()
+        self._input_cache = None
+        self._input_lock = threading.Lock()
+        self._interrupt = None
+        # Pending port values while a transaction is open, {port: [original, pending]}
+        self._lock = threading.RLock()
+        self._transaction = None
+        self._transaction_depth = 0
+        self._transaction_urgent = False
+        # Called with (expander, value) before each OUTPUT port write that changes it, in write order
+        self._output_listeners = list()
+        # Ports whose last write failed, the chip may not match the shadow until verify() rewrites them
+        self._dirty = set()
         #
         self.address = kwargs.get('address', None)
         self.bus = kwargs.get('bus', None)
         self.gpios = kwargs.get('gpios', None)
-        # Create i2c bus interface
-        self._smbus = smbus2.SMBus(self.bus)
+        self.verify_policy = kwargs.get('verify', 'never')
+        self.verify_interval = kwargs.get('verify_interval', 60)
+        self.interrupt = kwargs.get('interrupt', None)
+        # Attach to the i2c bus interface
+        self._i2c = _shared_bus(self.bus)
+        self._metrics = {name: getattr(metrics, f'i2c_{name}').labels(self.bus, hex(self.address))
+                         for name in ['errors', 'reads', 'writes']}
         #
         self.direction = self._readport(self._ports['CONFIG_PORT'])
         self.outputvalue = self._readport(self._ports['OUTPUT_PORT'])
+        self.polarityvalue = self._readport(self._ports['POLARITY_PORT'])
+        self._last_verify = self._clock.monotonic()
+        if self.interrupt is not None:
+            # Inputs are read when the chip signals a change on its INT output instead of on every input() call
+            self._input_cache = self._readport(self._ports['INPUT_PORT'])
+            GPIO.setup(self.interrupt, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            GPIO.add_event_detect(self.interrupt, GPIO.FALLING, self._serve_interrupt)
 
     @property
     def address(self):
@@ -61,15 +112,19 @@ class pca955x(object):
 
     @property
     def direction(self):
-        return self._direction
+        return self._shadow.get(self._ports['CONFIG_PORT'])
 
     @direction.setter
     def direction(self, direction=None):
-        if not direction:
+        if direction is None:
             error_msg = "Expecting chip direction data, received null"
             log.fatal(error_msg)
             raise ConfigError(error_msg)
-        self._direction = direction
+        self._shadow[self._ports['CONFIG_PORT']] = direction
+
+    @property
+    def drift_count(self):
+        return self._drift_count
 
     @property
     def gpios(self):
@@ -83,17 +138,66 @@ class pca955x(object):
             raise ConfigError(error_msg)
         self._gpios = gpios
 
+    @property
+    def interrupt(self):
+        return self._interrupt
+
+    @interrupt.setter
+    def interrupt(self, interrupt=None):
+        # Pi GPIO pin wired to the expander's open-drain INT output, None to read inputs on demand
+        if interrupt is not None and (not isinstance(interrupt, int) or interrupt < 0):
+            error_msg = f'Interrupt must be a GPIO pin number, received {interrupt}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._interrupt = interrupt
+
     @property
     def outputvalue(self):
-        return self._outputvalue
+        return self._shadow.get(self._ports['OUTPUT_PORT'])
 
     @outputvalue.setter
     def outputvalue(self, outputvalue=None):
-        if not outputvalue:
+        if outputvalue is None:
             error_msg = f'Expecting chip output value data, received null'
             log.fatal(error_msg)
             raise ConfigError(error_msg)
-        self._outputvalue = outputvalue
+        self._shadow[self._ports['OUTPUT_PORT']] = outputvalue
+
+    @property
+    def polarityvalue(self):
+        return self._shadow.get(self._ports['POLARITY_PORT'])
+
+    @polarityvalue.setter
+    def polarityvalue(self, polarityvalue=None):
+        if polarityvalue is None:
+            error_msg = f'Expecting chip polarity data, received null'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._shadow[self._ports['POLARITY_PORT']] = polarityvalue
+
+    @property
+    def verify_policy(self):
+        return self._verify
+
+    @verify_policy.setter
+    def verify_policy(self, verify=None):
+        if verify not in self._verify_policies:
+            error_msg = f'Verify policy must be one of {self._verify_policies}, received {verify}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._verify = verify
+
+    @property
+    def verify_interval(self):
+        return self._verify_interval
+
+    @verify_interval.setter
+    def verify_interval(self, verify_interval=None):
+        if not isinstance(verify_interval, (int, float)) or verify_interval <= 0:
+            error_msg = f'Verify interval must be a positive number of seconds, received {verify_interval}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._verify_interval = verify_interval
 
     def _bitchange(self, bitmap, bit, value):
         if not 0 <= value <= 1:
@@ -105,57 +209,252 @@ class pca955x(object):
         return bitmap | (1 << bit)
 
     def _changepin(self, port, pin, value):
-        bits = self._bitchange(self._readpin(port, pin), pin, value)
-        if self.gpios > 8:
-            self._smbus.write_word_data(self.address, port << 1, bits)
-        else:
-            self._smbus.write_byte_data(self.address, port, bits)
+        with self._lock:
+            if self._transaction is not None:
+                if port not in self._transaction:
+                    current = self._readpin(port, pin)
+                    self._transaction[port] = [current, current]
+                bits = self._bitchange(self._transaction[port][1], pin, value)
+                self._transaction[port][1] = bits
+                return bits
+            current = self._readpin(port, pin)
+            bits = self._bitchange(current, pin, value)
+            queued = self._queueport(port, bits)
+        # Wait for the bus without the lock, other changes to this expander can queue up and merge meanwhile
+        self._wait([queued])
+        self._after_write(bits != current)
         return bits
 
+    def _changemask(self, port, mask, bits):
+        # Set every bit selected by mask to the matching bit of bits, touching the bus only on a difference
+        with self._lock:
+            if self._transaction is not None:
+                if port not in self._transaction:
+                    self._transaction[port] = [self._shadow[port], self._shadow[port]]
+                self._transaction[port][1] = (self._transaction[port][1] & ~mask) | (bits & mask)
+                return self._transaction[port][1]
+            current = self._shadow[port]
+            value = (current & ~mask) | (bits & mask)
+            if value == current:
+                return value
+            queued = self._queueport(port, value)
+        self._wait([queued])
+        self._after_write(True)
+        return value
+
+    @property
+    def i2c(self):
+        return self._i2c
+
+    def _after_write(self, changed):
+        if self.verify_policy == 'commit' and changed:
+            self.verify()
+        else:
+            self._verify_if_due()
+
+    def _commit(self, pending, urgent=False):
+        queued = list()
+        for port, (original, bits) in pending.items():
+            if bits != original:
+                log.debug(f'Committing port {port} on {hex(self.address)}: {bin(original)} -> {bin(bits)}')
+                queued.append(self._queueport(port, bits, urgent))
+        return queued
+
+    def _queueport(self, port, bits, urgent=False):
+        # Queue a register write on the bus. The shadow takes the new value right away, so the next change
+        # builds on it even before the bus got to this write.
+        self._metrics['writes'].inc()
+        if port == self._ports['OUTPUT_PORT'] and bits != self._shadow.get(port, None):
+            for listener in self._output_listeners:
+                listener(self, bits)
+        if port in self._shadow:
+            self._shadow[port] = bits
+        if self.gpios > 8:
+            return self._i2c.queue_write(self.address, port << 1, bits, word=True, urgent=urgent)
+        return self._i2c.queue_write(self.address, port, bits, urgent=urgent)
+
+    def _serve_interrupt(self, channel=None):
+        # INT fell: one read of the INPUT port releases it, and the difference with the cached value says which
+        # pins changed. A change during the read keeps INT low without a new falling edge, so read until it's high.
+        for attempt in range(8):
+            with self._input_lock:
+                value = self._readport(self._ports['INPUT_PORT'])
+                changed = (value ^ self._input_cache) & self.direction
+                self._input_cache = value
+                events = [(pin, self._events[pin]) for pin in list(self._events) if changed & (1 << pin)]
+            for pin, (edge, callbacks) in events:
+                level = (value >> pin) & 1
+                if edge == GPIO.RISING and not level or edge == GPIO.FALLING and level:
+                    continue
+                for callback in list(callbacks):
+                    try:
+                        callback(pin)
+                    except Exception:
+                        log.exception(f'Expander {hex(self.address)} pin {pin} callback failed')
+            if GPIO.input(self.interrupt):
+                return
+        log.warning(f'Expander {hex(self.address)} INT stays asserted after {attempt + 1} reads')
+
     def _readpin(self, port, pin):
         if not 0 <= pin <= self.gpios:
             error_msg = f'Expecting pin value between 0 and {self.gpios}, received: {pin}'
             log.fatal(error_msg)
             raise Exception(error_msg)
-        if self.gpios > 8:
-            return self._smbus.read_word_data(self.address, port << 1)
-        return self._smbus.read_byte_data(self.address, port)
+        if port in self._shadow:
+            return self._shadow[port]
+        return self._readport(port)
 
     def _readport(self, port):
-        if self.gpios > 8:
-            return self._smbus.read_word_data(self.address, port << 1)
-        return self._smbus.read_byte_data(self.address, port)
+        self._metrics['reads'].inc()
+        try:
+            if self.gpios > 8:
+                return self._i2c.read(self.address, port << 1, word=True)
+            return self._i2c.read(self.address, port)
+        except OSError:
+            self._metrics['errors'].inc()
+            raise
+
+    def _verify_if_due(self):
+        # A failed write is put right on the next access whatever the policy
+        if self._dirty or \
+                self.verify_policy == 'periodic' and self._clock.monotonic() - self._last_verify >= self.verify_interval:
+            self.verify()
+
+    def _wait(self, queued):
+        try:
+            self._i2c.wait(queued)
+        except OSError:
+            self._metrics['errors'].inc()
+            with self._lock:
+                for transfer in queued:
+                    if transfer.kind == 'write' and transfer.error is not None:
+                        self._dirty.add(transfer.register >> 1 if transfer.word else transfer.register)
+            raise
+
+    def add_event_callback(self, pin, callback):
+        with self._input_lock:
+            self._events[pin][1].append(callback)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        # Same interface as RPi.GPIO, callback(pin) runs on the interrupt thread. bouncetime is not supported,
+        # debounce in the caller.
+        if self.interrupt is None:
+            error_msg = f'Expander {hex(self.address)} needs an interrupt pin for edge detection on pin {pin}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        if not self.direction & (1 << pin):
+            error_msg = f'Pin {pin} is not set to input'
+            log.critical(error_msg)
+            raise IOError(error_msg)
+        with self._input_lock:
+            self._events[pin] = [edge, [callback] if callback else list()]
 
     def config(self, pin, mode):
-        self.direction = self._changepin(self._ports['CONFIG_PORT'], pin, mode)
-        return self.direction
+        bits = self._changepin(self._ports['CONFIG_PORT'], pin, mode)
+        if self._input_cache is not None and self._transaction is None:
+            # A pin turned input reads its external level from now on, don't report that as a change
+            with self._input_lock:
+                self._input_cache = self._readport(self._ports['INPUT_PORT'])
+        return bits
 
     def input(self, pin):
-        if not self.direction & (1 << pin) == 1:
+        if not self.direction & (1 << pin):
             error_msg = f'Pin {pin} is not set to input'
             log.critical(error_msg)
             raise IOError(error_msg)
-        return self._readpin(self._ports['INPUT_PORT'], pin) & (1 << pin)
+        self._verify_if_due()
+        if self._input_cache is not None:
+            return (self._input_cache >> pin) & 1
+        return (self._readpin(self._ports['INPUT_PORT'], pin) >> pin) & 1
+
+    def add_output_listener(self, callback):
+        with self._lock:
+            self._output_listeners.append(callback)
+
+    def remove_output_listener(self, callback):
+        with self._lock:
+            if callback in self._output_listeners:
+                self._output_listeners.remove(callback)
 
     def output(self, pin, value):
-        if self.direction & (1 << pin) == 1:
+        if self.direction & (1 << pin):
             error_msg = f'Pin {pin} is not set to output'
             log.critical(error_msg)
             raise IOError(error_msg)
         return self._changepin(self._ports['OUTPUT_PORT'], pin, value)
 
+    def output_mask(self, mask, bits):
+        if self.direction & mask:
+            error_msg = f'Pins {bin(self.direction & mask)} are not set to output'
+            log.critical(error_msg)
+            raise IOError(error_msg)
+        return self._changemask(self._ports['OUTPUT_PORT'], mask, bits)
+
     def polarity(self, pin, value):
         return self._changepin(self._ports['POLARITY_PORT'], pin, value)
 
+    def remove_event_detect(self, pin):
+        with self._input_lock:
+            self._events.pop(pin, None)
+
+    def verify(self):
+        # Read the shadowed registers back from the chip. Any drift (e.g. the expander reset itself
+        # after a brown-out) is reported and the shadow, which is authoritative, is written back, as are
+        # ports whose last write failed. Outputs are restored before the direction so pins come back driving
+        # the right level. The bus is only used outside the lock, pin changes carry on meanwhile; a register
+        # changed during the read-back is left alone, its new write sets the chip anyway.
+        names = ['OUTPUT_PORT', 'POLARITY_PORT', 'CONFIG_PORT']
+        with self._lock:
+            expected = {name: self._shadow[self._ports[name]] for name in names}
+            self._last_verify = self._clock.monotonic()
+        actual = {name: self._readport(self._ports[name]) for name in names}
+        drift, queued = dict(), list()
+        with self._lock:
+            for name in names:
+                port = self._ports[name]
+                if self._shadow[port] != expected[name]:
+                    continue
+                if actual[name] != expected[name]:
+                    drift[name] = (expected[name], actual[name])
+                    log.warning(f'Expander {hex(self.address)} {name} drifted, '
+                                f'expected {bin(expected[name])} read {bin(actual[name])}, restoring')
+                elif port not in self._dirty:
+                    continue
+                self._dirty.discard(port)
+                queued.append(self._queueport(port, expected[name]))
+            if drift:
+                self._drift_count += 1
+        self._wait(queued)
+        return drift
+
     def setmode(self, mode):
         pass
 
     def setup(self, pin, mode):
         self.config(pin, mode)
 
-
-
-
-
-
-
+    @contextmanager
+    def transaction(self, urgent=False):
+        # Collect every pin change made inside the block and write each touched port once on exit.
+        # Transactions nest; only the outermost one commits, ahead of routine bus traffic if any of them
+        # was urgent. The lock keeps other threads from writing into (or around) an open transaction.
+        queued = None
+        try:
+            with self._lock:
+                self._transaction_depth += 1
+                if self._transaction is None:
+                    self._transaction = dict()
+                self._transaction_urgent = self._transaction_urgent or urgent
+                try:
+                    yield self
+                finally:
+                    self._transaction_depth -= 1
+                    if not self._transaction_depth:
+                        pending, self._transaction = self._transaction, None
+                        urgent, self._transaction_urgent = self._transaction_urgent, False
+                        queued = self._commit(pending, urgent)
+        finally:
+            # Queued writes are waited for outside the lock, and even if the block raised
+            if queued is not None:
+                self._wait(queued)
+                self._after_write(bool(queued))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import collections
+import logging
+import os
+
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+# One step of a compiled program. start is the program time at which the step begins.
+Step = collections.namedtuple('Step', ['operation', 'handler', 'seconds', 'start'])
+
+
+class Program(collections.namedtuple('Program', ['name', 'display_name', 'steps', 'total'])):
+    # A mode program resolved against a station's operations. Steps are a tuple of Step, with start
+    # holding the prefix sum of the durations before it, so progress at any point is a subtraction.
+    __slots__ = ()
+
+    def elapsed(self, index, remaining):
+        # Program seconds done when step index has remaining seconds left
+        step = self.steps[index]
+        return step.start + step.seconds - remaining
+
+    def percent(self, index, remaining):
+        if not self.total:
+            return 100
+        return int(100 * self.elapsed(index, remaining) / self.total)
+
+    def remaining(self, index, remaining):
+        # Program seconds left when step index has remaining seconds left
+        return self.total - self.elapsed(index, remaining)
+
+
+def compile_program(name, mode, operation_map):
+    # Validate a mode_config entry and resolve its operations to handlers, raising ConfigError on any problem
+    if not isinstance(mode, dict) or not mode.get('display_name', None):
+        error_msg = f'Mode {name} needs a display_name, received {mode}'
+        log.fatal(error_msg)
+        raise ConfigError(error_msg)
+    operations = mode.get('operations', None)
+    if not operations:
+        error_msg = f'Mode {name} has no operations'
+        log.fatal(error_msg)
+        raise ConfigError(error_msg)
+    steps = list()
+    start = 0
+    for index, entry in enumerate(operations):
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+            error_msg = f'Mode {name} step {index} must be (operation, seconds), received {entry}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        operation, seconds = entry
+        if operation not in operation_map:
+            error_msg = f'Mode {name} step {index} uses unknown operation {operation}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        if not isinstance(seconds, int) or isinstance(seconds, bool) or seconds < 0:
+            error_msg = f'Mode {name} step {index} needs a whole number of seconds, received {seconds}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        steps.append(Step(operation, operation_map[operation], seconds, start))
+        start += seconds
+    return Program(name, mode['display_name'], tuple(steps), start)
+
+
+def _unchanged(program, mode):
+    # Whether mode still describes the compiled program
+    try:
+        return program.display_name == mode['display_name'] and \
+            [(step.operation, step.seconds) for step in program.steps] == \
+            [(operation, seconds) for operation, seconds in mode['operations']]
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def compile_programs(modes, operation_map, previous=None):
+    # Every program of a mode_config, in order; any invalid program rejects the whole configuration.
+    # previous maps names to programs compiled earlier, those whose definition is unchanged are reused as
+    # they are, so a reload only compiles what changed and a paused or journaled run keeps its program.
+    if not modes:
+        error_msg = f'No modes configured'
+        log.fatal(error_msg)
+        raise ConfigError(error_msg)
+    previous = previous or dict()
+    programs = list()
+    for name, mode in modes.items():
+        if name in previous and _unchanged(previous[name], mode):
+            programs.append(previous[name])
+        else:
+            programs.append(compile_program(name, mode, operation_map))
+    return programs
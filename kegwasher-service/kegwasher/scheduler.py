@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import logging
+import os
+import threading
+import time
+
+from kegwasher import metrics
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class ResourceScheduler(object):
+    # Shares limited utilities between stations. limits caps how much of each resource may be in use at
+    # once, e.g. {'heaters': 2, 'co2_in': 1}; resources without a limit are free for all.
+    #
+    # A station asks for the resources of its next step before switching to it. The step's grant replaces
+    # the station's previous one, but both are counted until settle() confirms the devices have switched,
+    # so the limits hold even while outputs change over. A station that has to wait must release() first,
+    # with its devices off, so no station ever waits while holding something; that rules out deadlock
+    # between stations waiting on each other. Waiting stations are served in arrival order,
+    # except that a later station whose step fits right now may go ahead of a blocked one (backfill),
+    # at most max_bypass times in a row so the blocked station isn't starved.
+    def __init__(self, *args, **kwargs):
+        self._condition = threading.Condition()
+        self._held = dict()
+        self._in_use = dict()
+        self._limits = None
+        self._max_bypass = None
+        self._waiting = list()
+        #
+        self.limits = kwargs.get('limits', dict())
+        self.max_bypass = kwargs.get('max_bypass', 4)
+
+    @property
+    def in_use(self):
+        with self._condition:
+            return {resource: amount for resource, amount in self._in_use.items() if amount}
+
+    @property
+    def limits(self):
+        return self._limits
+
+    @limits.setter
+    def limits(self, limits=None):
+        for resource, limit in (limits or dict()).items():
+            if not isinstance(limit, int) or limit < 0:
+                error_msg = f'Resource limit for {resource} must be a positive integer, received {limit}'
+                log.fatal(error_msg)
+                raise ConfigError(error_msg)
+        self._limits = dict(limits or dict())
+
+    @property
+    def max_bypass(self):
+        return self._max_bypass
+
+    @max_bypass.setter
+    def max_bypass(self, max_bypass=None):
+        if not isinstance(max_bypass, int) or max_bypass < 0:
+            error_msg = f'Scheduler max_bypass must be a positive integer, received {max_bypass}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._max_bypass = max_bypass
+
+    def _fits(self, station, needs):
+        held = self._held.get(station, dict())
+        for resource, amount in needs.items():
+            if resource not in self._limits:
+                continue
+            extra = max(amount - held.get(resource, 0), 0)
+            if self._in_use.get(resource, 0) + extra > self._limits[resource]:
+                return False
+        return True
+
+    def _hold(self, station, needs):
+        # Replace the station's holding with needs, keeping the larger of each while both are counted
+        held = self._held.get(station, dict())
+        union = {resource: max(held.get(resource, 0), needs.get(resource, 0)) for resource in set(held) | set(needs)}
+        self._set(station, union)
+
+    def _set(self, station, needs):
+        for resource, amount in self._held.pop(station, dict()).items():
+            self._in_use[resource] -= amount
+        for resource, amount in needs.items():
+            self._in_use[resource] = self._in_use.get(resource, 0) + amount
+        if needs:
+            self._held[station] = dict(needs)
+        self._condition.notify_all()
+
+    def _turn(self, entry):
+        # Whether the waiter may take its resources now, first come first served with bounded backfill
+        if not self._fits(entry[0], entry[1]):
+            return False
+        for earlier in self._waiting:
+            if earlier is entry:
+                return True
+            if earlier[2] >= self._max_bypass:
+                return False
+        return True
+
+    def acquire(self, station, needs, token=None):
+        # Block until needs fit within the limits. Returns False if the token was cancelled while waiting.
+        # The station should hold nothing, see try_acquire.
+        def wake():
+            with self._condition:
+                self._condition.notify_all()
+
+        if token is not None:
+            token.add_listener(wake)
+        entry = [station, needs, 0]
+        start = time.monotonic()
+        try:
+            with self._condition:
+                self._waiting.append(entry)
+                try:
+                    while not self._turn(entry):
+                        if token is not None and token.cancelled:
+                            return False
+                        log.debug(f'{station} waiting for resources {needs}, in use {self._in_use}')
+                        self._condition.wait()
+                    if token is not None and token.cancelled:
+                        return False
+                    # Everyone still queued ahead of us has now been passed once more
+                    for earlier in self._waiting:
+                        if earlier is entry:
+                            break
+                        earlier[2] += 1
+                    self._hold(station, needs)
+                    return True
+                finally:
+                    self._waiting.remove(entry)
+                    self._condition.notify_all()
+        finally:
+            if token is not None:
+                token.remove_listener(wake)
+            metrics.resource_wait.labels(station).observe(time.monotonic() - start)
+
+    def release(self, station):
+        with self._condition:
+            self._set(station, dict())
+
+    def settle(self, station, needs):
+        # The station's devices now match needs, drop whatever the previous step held beyond that
+        with self._condition:
+            self._set(station, needs)
+
+    def try_acquire(self, station, needs):
+        # Take needs if they fit right now and nobody is queued ahead, without waiting
+        with self._condition:
+            if not self._fits(station, needs) or any(entry[2] >= self._max_bypass for entry in self._waiting):
+                return False
+            for entry in self._waiting:
+                entry[2] += 1
+            self._hold(station, needs)
+            return True
+
+    def validate(self, station, resources):
+        # Every operation must fit on its own, or a station could wait forever
+        for operation, needs in resources.items():
+            for resource, amount in needs.items():
+                if amount > self._limits.get(resource, amount):
+                    error_msg = f'Operation {operation} of {station} needs {amount} {resource}, ' \
+                                f'more than the limit of {self._limits[resource]}'
+                    log.fatal(error_msg)
+                    raise ConfigError(error_msg)
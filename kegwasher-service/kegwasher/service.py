@@ -2,80 +2,139 @@
 #
 # Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
 
+import functools
 import logging
 import os
-import RPi.GPIO as GPIO
 import threading
 import time
 
+from kegwasher import backend, metrics
 from kegwasher.actions import Action
-from kegwasher.config import pin_config, mode_config
-from kegwasher.exceptions import AbortException, ConfigError
+from kegwasher.api import Progress, Snapshot
+from kegwasher.cancellation import CancellationToken
+from kegwasher.clock import from_speed
+from kegwasher.config import pin_config, mode_config, service_config
+from kegwasher.dispatcher import Dispatcher
+from kegwasher.backend import GPIO
+from kegwasher.exceptions import AbortException, ConfigError, ControlError
 from kegwasher.hardware import *
+from kegwasher.inputs import InputProcessor
+from kegwasher.journal import Journal, fingerprint, resume_point, validate_rules
 from kegwasher.linked_list import *
 from kegwasher.operations import Operations
+from kegwasher.optimizer import optimize_modes, summary
+from kegwasher.programs import compile_programs
+from kegwasher.state import State
+from kegwasher.telemetry import Telemetry
 
 
 log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
 
-GPIO.setmode(GPIO.BCM)
-
 
 class KegWasher(threading.Thread):
-    def __init__(self, pin_config=None, mode_config=None):
-        log.debug(f'Initializing KegWasher')
-        threading.Thread.__init__(self)
-        # self._state tracks global state among all threads
-        self._state = {
+    def __init__(self, pin_config=None, mode_config=None, service_config=None, clock=None, name='kegwasher',
+                 scheduler=None, startup=None, inputs=None):
+        log.debug(f'Initializing KegWasher {name}')
+        # The thread name doubles as the station name when one daemon drives several washers
+        threading.Thread.__init__(self, name=name)
+        # self._state tracks global state among all threads, changes to it wake the run loop
+        self._state = State({
             'aborted': False,
             'alive': True,
             'button_lock': False,
-            'enter_button_press_time': 0,
-            'mode_button_press_time': 0,
-            'status': 'initialize'
-        }
+            'status': 'initialize',
+            'token': None,
+            'progress': None,
+            'ready': False
+        })
+        self._stats = {'loop_wakeups': 0}
         # self._threads keeps tracks of all spawned threads
         self._threads = list()
         # Make sure we have a good configuration
         self._pin_config = self._validate_hardware_config(pin_config)
+        self._service_config = service_config or dict()
+        # Every wait and press timing goes through this clock, a VirtualClock runs programs time-warped
+        self._clock = clock or from_speed(self._service_config.get('clock_speed', 1))
+        # Real pins and bus, or the in-process simulation
+        backend.select(self._service_config.get('backend', None))
+        GPIO.setmode(GPIO.BCM)
         # self._hardware is the collection of our hardware interfaces
         self._hardware = dict()
         self._hardware['display'] = Display().init_display(pin_config.get('display'))
         self._hardware.get('display').clear()
         self._hardware.get('display').message(f'Initializing....\nPlease.Standby..')
+        self._mark(startup, 'display')
         if pin_config.get('io_expanders', None):
-            self._hardware['expanders'] = self._init_expanders(pin_config.get('io_expanders'))
+            self._hardware['expanders'] = self._init_expanders(pin_config.get('io_expanders'), self._clock)
         else:
             self._hardware['expanders'] = dict()
-        self._hardware['heaters'] = self._init_heaters(pin_config.get('heaters'), self._hardware.get('expanders'))
-        self._hardware['pumps'] = self._init_pumps(pin_config.get('pumps'), self._hardware.get('expanders'))
-        self._hardware['valves'] = self._init_valves(pin_config.get('valves'), self._hardware.get('expanders'))
-        self._hardware['switches'] = self._init_switches(pin_config.get('switches'), self._hardware.get('expanders'))
+        self._mark(startup, 'bus probe')
+        self._hardware['heaters'] = self._init_heaters(pin_config.get('heaters'), self._hardware.get('expanders'), name)
+        self._hardware['pumps'] = self._init_pumps(pin_config.get('pumps'), self._hardware.get('expanders'), name)
+        self._hardware['valves'] = self._init_valves(pin_config.get('valves'), self._hardware.get('expanders'), name)
+        self._mark(startup, 'devices')
+        # Which devices were on when, kept in fixed memory and read through the control API
+        self._telemetry = self._init_telemetry(self._service_config.get('telemetry', dict()), self._hardware,
+                                               self._clock, name)
         # self._operations is the map of what the hardware can do
-        self._operations = Operations(hardware=self._hardware)
+        self._operations = Operations(hardware=self._hardware, operation_devices=pin_config.get('operations', None))
         self._operations.all_off_closed()
-        # self._modes is the map of what the user can do
-        self._modes = self._init_modes(mode_config)
+        # Shared utilities are handed out by the scheduler when several stations run at once
+        self._scheduler = scheduler
+        if self._scheduler:
+            self._scheduler.validate(name, self._operations.resources)
+        # self._modes is the map of what the user can do, compiled and checked before any input is accepted.
+        # Reloaded programs are staged and swapped in by the run loop between runs.
+        self._modes = CircularDoublyLinkedList()
+        self._nodes = dict()
+        self._programs = dict()
+        self._staged = None
+        self._staged_lock = threading.Lock()
+        journal_config = self._service_config.get('journal', dict())
+        self._resume_rules = validate_rules(journal_config.get('resume', None), self._operations.operation_map)
+        self._swap_modes(self.prepare_modes(mode_config))
+        # A program cut short by a power loss is offered for resuming on the Select Mode screen
+        self._journal = self._init_journal(journal_config, name, self._clock)
+        self._recover(self._resume_rules)
+        self._mark(startup, 'config validation')
+        # Switch interrupts are handed to a fixed pool of workers, started before any edge can arrive
+        self._dispatcher = Dispatcher(factory=self._new_action, name=name, clock=self._clock,
+                                      **self._service_config.get('dispatcher', dict()))
+        self._dispatcher.start()
+        # Switch edges are debounced into press/hold/abort events on one thread, shared when stations pass theirs
+        self._own_inputs = inputs is None
+        self._inputs = inputs or InputProcessor(clock=self._clock, **self._service_config.get('inputs', dict()))
+        self._inputs.start()
+        self._hardware['switches'] = self._init_switches(pin_config.get('switches'), self._hardware.get('expanders'), name)
+        self._mark(startup, 'switches')
+        # What the station is doing, for the control API; republished by the run loop on every state change
+        self._snapshot = None
+        self._publish()
+
+    @staticmethod
+    def _mark(startup, phase):
+        if startup:
+            startup.mark(phase)
 
     @staticmethod
-    def _init_expanders(expanders=list()):
+    def _init_expanders(expanders=list(), clock=None):
         log.debug(f'Initializing IO Expanders')
         configured_expanders = dict()
         for expander in expanders:
             for check in ['name', 'address', 'gpios', 'bus']:
-                if not expander.get(check, None):
+                if expander.get(check, None) in [None, '']:
                     error_msg = f'Missing correct expander configuration {expander}'
                     log.fatal(error_msg)
                     raise ConfigError(error_msg)
-            configured_expanders[expander.get('name')] = Expander(**expander)
+            configured_expanders[expander.get('name')] = Expander(clock=clock, **expander)
         return configured_expanders
 
     @staticmethod
-    def _init_heaters(heaters=list(), expanders=dict()):
+    def _init_heaters(heaters=list(), expanders=dict(), station=None):
         log.debug(f'Initializing heaters')
         configured_heaters = dict()
         for heater in heaters:
-            if not heater.get('name', None) and not heater.get('pin', None):
+            if not heater.get('name', None) or heater.get('pin', None) is None:
                 error_msg = f'Missing correct heater configuration {heater}'
                 log.fatal(error_msg)
                 raise ConfigError(error_msg)
@@ -86,23 +145,48 @@ class KegWasher(threading.Thread):
                     error_msg = f'Device has non-existent IO Expander configured {heater}'
                     log.fatal(error_msg)
                     raise ConfigError(error_msg)
-            configured_heaters[heater.get('name')] = Heater(**heater)
+            configured_heaters[heater.get('name')] = Heater(station=station, **heater)
         return configured_heaters
 
     @staticmethod
-    def _init_modes(modes=None):
-        log.debug(f'Creating circular doubly linked list from defined modes')
+    def _init_journal(journal_config=dict(), station=None, clock=None):
+        directory = journal_config.get('directory', None)
+        if not directory:
+            log.debug(f'Run journal disabled')
+            return None
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            log.warning(f'Unable to create journal directory {directory}, runs will not survive a restart: {e}')
+            return None
+        return Journal(path=os.path.join(directory, f'{station}.journal'),
+                       sync_interval=journal_config.get('sync_interval', 10), clock=clock)
+
+    @staticmethod
+    def _init_telemetry(telemetry_config=dict(), hardware=dict(), clock=None, station=None):
+        if not telemetry_config.get('capacity', 0):
+            log.debug(f'Device telemetry disabled')
+            return None
+        telemetry = Telemetry(capacity=telemetry_config.get('capacity'), clock=clock, hardware=hardware,
+                              station=station)
+        telemetry.attach()
+        log.debug(f'Recording device telemetry, {telemetry.capacity} changes in {telemetry.memory} bytes')
+        return telemetry
+
+    @staticmethod
+    def _init_modes(modes=None, operation_map=dict(), previous=None):
+        log.debug(f'Creating circular doubly linked list from compiled modes')
         cdll = CircularDoublyLinkedList()
-        for mode, data in modes.items():
-            cdll.append(Node(data))
+        for program in compile_programs(modes, operation_map, previous):
+            cdll.append(Node(program))
         return cdll
 
     @staticmethod
-    def _init_pumps(pumps=list(), expanders=dict()):
+    def _init_pumps(pumps=list(), expanders=dict(), station=None):
         log.debug(f'Initializing pumps')
         configured_pumps = dict()
         for pump in pumps:
-            if not pump.get('name', None) and not pump.get('pin', None):
+            if not pump.get('name', None) or pump.get('pin', None) is None:
                 error_msg = f'Missing correct pump configuration {pump}'
                 log.fatal(error_msg)
                 raise ConfigError(error_msg)
@@ -113,39 +197,48 @@ class KegWasher(threading.Thread):
                     error_msg = f'Device has non-existent IO Expander configured {pump}'
                     log.fatal(error_msg)
                     raise ConfigError(error_msg)
-            configured_pumps[pump.get('name')] = Pump(**pump)
+            configured_pumps[pump.get('name')] = Pump(station=station, **pump)
         return configured_pumps
 
-    def _init_switches(self, switches=list(), expanders=dict()):
+    def _init_switches(self, switches=list(), expanders=dict(), station=None):
         log.debug(f'Initializing switches')
         configured_switches = dict()
         for switch in switches:
             if not switch.get('name', None) \
-                    and not switch.get('pin', None) \
-                    and not switch.get('PUD', None) \
-                    and not switch.get('event', None) \
-                    and not switch.get('action', None):
+                    or switch.get('pin', None) is None \
+                    or not switch.get('PUD', None) \
+                    or not switch.get('event', None) \
+                    or not switch.get('action', None):
                 error_msg = f'Invalid switch configuration: {switch}'
                 log.fatal(error_msg)
                 raise ConfigError(error_msg)
+            if switch.get('expander', None):
+                if expanders.get(switch.get('expander'), None):
+                    switch['expander'] = expanders[switch['expander']]
+                else:
+                    error_msg = f'Device has non-existent IO Expander configured {switch}'
+                    log.fatal(error_msg)
+                    raise ConfigError(error_msg)
             pin = switch.get('pin')
             name = switch.get('name')
-            switch_object = Switch(**switch)
-            configured_switches[pin] = switch_object
+            switch_object = Switch(station=station, **switch)
+            # Expander pin numbers would clash with Pi pins, those switches are only known by name
+            if not switch_object.expander:
+                configured_switches[pin] = switch_object
             configured_switches[name] = switch_object
             log.debug(f'Configuring event detection for {switch.get("name")}, action: {switch.get("action")}')
-            GPIO.add_event_detect(pin, configured_switches[pin].event, self.sw_interrupt_handler, 100)
+            self._inputs.add(switch_object, functools.partial(self._switch_event, switch_object.action), station)
         return configured_switches
 
     @staticmethod
-    def _init_valves(valves=list(), expanders=dict()):
+    def _init_valves(valves=list(), expanders=dict(), station=None):
         log.debug(f'Initializing valves')
         configured_valves = dict()
         for valve in valves:
-            if not valve.get('name', None) and not valve.get('pin', None):
+            if not valve.get('name', None) or valve.get('pin', None) is None:
                 error_msg = f'Missing valve configuration: {valve}'
                 log.fatal(error_msg)
-                raise Exception(error_msg)
+                raise ConfigError(error_msg)
             if valve.get('expander', None):
                 if expanders.get(valve.get('expander'), None):
                     valve['expander'] = expanders[valve['expander']]
@@ -153,7 +246,7 @@ class KegWasher(threading.Thread):
                     error_msg = f'Device has non-existent IO Expander configured {valve}'
                     log.fatal(error_msg)
                     raise ConfigError(error_msg)
-            configured_valves[valve.get('name')] = Valve(**valve)
+            configured_valves[valve.get('name')] = Valve(station=station, **valve)
         return configured_valves
 
     @staticmethod
@@ -167,67 +260,233 @@ class KegWasher(threading.Thread):
                 pin_config.get('valves')):
             error_msg = f'Invalid Hardware Configuration Received: {pin_config}'
             log.fatal(error_msg)
-            raise Exception(error_msg)
+            raise ConfigError(error_msg)
         return pin_config
 
-    def sw_interrupt_handler(self, *args):
-        log.debug(f'Switch Interrupt Handler received event for pin {args[0]}')
-        t = Action(**{'action': self._hardware.get('switches').get(args[0]).action,
-                       'hardware': self._hardware,
-                       'modes': self._modes,
-                       'operations': self._operations,
-                       'state': self._state,
-                       'threads': self._threads})
-        t.daemon = False
-        t.start()
-        self._threads.append(t)
+    def prepare_modes(self, mode_config=None):
+        # Compile a new set of mode programs, reusing those that didn't change; raises ConfigError if any is
+        # invalid. The result goes to stage_modes(), nothing changes before that.
+        optimizer = self._service_config.get('optimizer', dict())
+        if optimizer.get('enabled', False):
+            mode_config, reports = optimize_modes(mode_config, self._operations.operation_devices,
+                                                  optimizer.get('min_dwell', None), self._resume_rules,
+                                                  optimizer.get('transition', 0))
+            for report in reports:
+                log.log(logging.INFO if report.changes or report.violations else logging.DEBUG,
+                        f'Optimized {summary(report)}')
+        ring = self._init_modes(mode_config, self._operations.operation_map, self._programs)
+        nodes, node = dict(), ring.head
+        for i in range(len(mode_config)):
+            nodes[node.data.name] = node
+            node = node.next
+        return ring, nodes
+
+    def stage_modes(self, prepared):
+        # Hand prepared modes to the run loop, which swaps them in once no program is running
+        with self._staged_lock:
+            self._staged = prepared
+        self._state.notify()
+
+    def _swap_modes(self, prepared):
+        # The selected mode stays selected by name, the swap itself is a single head replacement
+        ring, nodes = prepared
+        selected = self._modes.data.name if self._modes.data else None
+        self._modes.replace(nodes.get(selected, ring.head))
+        self._nodes = nodes
+        self._programs = {name: node.data for name, node in nodes.items()}
+
+    def _apply_staged_modes(self):
+        # Never while a program runs; a paused or aborted run keeps resuming if its program didn't change
+        if self._staged is None or self._state['status'] in ['execute_mode', 'executing', 'paused']:
+            return
+        with self._staged_lock:
+            prepared, self._staged = self._staged, None
+        self._swap_modes(prepared)
+        log.info(f'Reloaded {len(prepared[1])} modes, {self._modes.data.display_name} selected')
+        if self._state['status'] == 'select_mode':
+            t = self._new_action('display_mode_select')
+            t.start()
+            self._threads.append(t)
+
+    def _recover(self, resume_rules=None):
+        # Select the program the journal was left in the middle of, and where its run picks up again
+        run = self._journal.recover() if self._journal else None
+        if not run:
+            return
+        first = self._modes.head
+        while self._modes.data.name != run['mode'] or fingerprint(self._modes.data) != run['fingerprint']:
+            self._modes.next()
+            if self._modes.head is first:
+                log.warning(f'Unfinished run of {run["mode"]} no longer matches its program, not resuming')
+                return
+        program = self._modes.data
+        step, remaining = resume_point(program, run['step'], run['elapsed'], resume_rules)
+        log.info(f'Unfinished run of {program.display_name} found, resumable at step {step} '
+                 f'with {remaining} seconds left')
+        self._state['progress'] = {'mode': program, 'step': step, 'remaining': remaining}
+
+    def _new_action(self, action, submitted=None, event=None):
+        return Action(**{'action': action,
+                         'clock': self._clock,
+                         'event': event,
+                         'hardware': self._hardware,
+                         'journal': self._journal,
+                         'modes': self._modes,
+                         'operations': self._operations,
+                         'scheduler': self._scheduler,
+                         'state': self._state,
+                         'station': self.name,
+                         'submitted': submitted,
+                         'threads': self._threads})
+
+    def _switch_event(self, action, event, timestamp):
+        log.debug(f'Switch event {event} for {action}')
+        self._dispatcher.submit(action, timestamp, event)
+
+    def _publish(self):
+        # A fresh snapshot on every state change. It is swapped in whole and never modified, so API threads read
+        # it without a lock and without holding up this loop or the program thread.
+        status = self._state['status']
+        token = self._state.get('token', None)
+        program = None
+        if status in ['executing', 'paused'] and token is not None and token.program and token.progress:
+            running, (operation, remaining) = token.program, token.progress
+            step = token.step
+            program = Progress(running.name, running.display_name, step, len(running.steps), operation, remaining,
+                               running.remaining(step, remaining), running.percent(step, remaining))
+        selected = self._modes.data
+        progress = self._state.get('progress', None)
+        devices = tuple((kind, name, device.value) for kind in ['heaters', 'pumps', 'valves']
+                        for name, device in self._hardware.get(kind, dict()).items())
+        self._snapshot = Snapshot(self.name, self._state.version, time.time(), status, self._state.get('ready', False),
+                                  self._state.get('aborted', False), selected.name, selected.display_name,
+                                  progress is not None and progress['mode'] is selected, program,
+                                  self._operations.current, devices, self._hardware.get('display').text)
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def telemetry(self):
+        return self._telemetry
+
+    @property
+    def programs(self):
+        # Mode name to compiled program, in selection order; replaced whole when modes are reloaded
+        return self._programs
+
+    def _command(self, action, event, allowed):
+        if self._state['status'] not in allowed or (action != 'pause' and self._state.get('button_lock', False)):
+            raise ControlError(f'{self.name} is {self._state["status"]}, {action} needs it to be {" or ".join(allowed)}')
+        self._dispatcher.submit(action, None, event)
+
+    def select_mode(self, name=None):
+        # As pressing Mode until name shows
+        if name not in self._nodes:
+            raise ControlError(f'{self.name} has no mode {name}')
+        if self._state['status'] != 'select_mode' or self._state.get('button_lock', False):
+            raise ControlError(f'{self.name} is {self._state["status"]}, modes can only be selected in select_mode')
+        self._modes.replace(self._nodes[name])
+        self._dispatcher.submit('display_mode_select')
+
+    def start_mode(self, name=None):
+        # As pressing Enter, on name or whatever is selected
+        if name is not None:
+            self.select_mode(name)
+        self._command('enter', 'press', ['select_mode'])
+
+    def pause_mode(self):
+        self._command('pause', 'press', ['executing'])
+
+    def resume_mode(self):
+        self._command('pause', 'press', ['paused'])
+
+    def abort_mode(self):
+        # As opening the abort switch, always taken; it clears when the switch is cycled back to its run position
+        self._dispatcher.submit('abort', None, 'asserted')
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    def _reap_threads(self):
+        for t in list(self._threads):
+            if not t.is_alive():
+                log.debug('Reaping thread')
+                self._threads.remove(t)
 
     def run(self):
         log.debug('Entering Infinite Loop Handler')
         try:
+            version = self._state.version
             while self._state.get('alive', False):
-                if self._state.get('aborted', False):
-                    time.sleep(1)
-                else:
-                    if len(self._threads) >= 1:
-                        for t in self._threads:
-                            if t.is_alive():
-                                t.join(timeout=0.01)
-                            if not t.is_alive():
-                                log.debug('Reaping thread')
-                                self._threads.remove(t)
-                    if self._state['status'] in ['execute_mode', 'initialize', 'post_initialize']:
-                        act = self._state['status']
-                        log.debug(f'Current status: {act}')
-                        if self._state['status'] == 'execute_mode':
-                            log.debug('setting status to: executing')
-                            self._state['status'] = 'executing'
-                        if self._state['status'] == 'post_initialize':
-                            act = 'display_mode_select'
-                            self._state['status'] = 'select_mode'
-                        t = Action(**{'action': act,
-                                      'hardware': self._hardware,
-                                      'modes': self._modes,
-                                      'operations': self._operations,
-                                      'state': self._state,
-                                      'threads': self._threads})
-                        t.daemon = False
-                        t.start()
-                        self._threads.append(t)
-                    time.sleep(0.01)
+                self._reap_threads()
+                self._apply_staged_modes()
+                self._publish()
+                if not self._state.get('aborted', False) and \
+                        self._state['status'] in ['execute_mode', 'initialize', 'post_initialize']:
+                    act = self._state['status']
+                    log.debug(f'Current status: {act}')
+                    if self._state['status'] == 'execute_mode':
+                        log.debug('setting status to: executing')
+                        self._state.update(status='executing', token=CancellationToken(self._clock))
+                    if self._state['status'] == 'initialize':
+                        self._state['status'] = 'initializing'
+                    if self._state['status'] == 'post_initialize':
+                        act = 'display_mode_select'
+                        self._state['status'] = 'select_mode'
+                    t = self._new_action(act)
+                    t.daemon = False
+                    t.start()
+                    self._threads.append(t)
+                metrics.action_threads.labels(self.name).set(len(self._threads) + self._dispatcher.stats['active'])
+                # Sleep until a thread changes the shared state or exits
+                version = self._state.wait(version)
+                self._stats['loop_wakeups'] += 1
         except KeyboardInterrupt:
             log.info('Received Keyboard Interrupt')
-            if len(self._threads) >= 1:
-                for t in self._thread:
-                    t.abort_thread()
-            self._display.clear()
-            self._operations.all_off_closed()
-            GPIO.cleanup()
+            self.shutdown()
             raise AbortException('Received Keyboard Interrupt')
 
+    def wait_ready(self, timeout=None):
+        # Block until the mode selection is on the display, returns False if that didn't happen in time
+        version = self._state.version
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._state.get('ready', False):
+            left = None if deadline is None else deadline - time.monotonic()
+            if left is not None and left <= 0:
+                return False
+            version = self._state.wait(version, left)
+        return True
+
+    def shutdown(self, cleanup=True):
+        # Stop the program and the switch workers and leave every device off. When several stations share
+        # the GPIO controller only the last one out should clean it up.
+        if self._state.get('token', None):
+            self._state['token'].cancel()
+        self.stop()
+        if self._own_inputs:
+            self._inputs.stop()
+        self._dispatcher.stop()
+        self._hardware.get('display').clear()
+        self._hardware.get('display').flush()
+        self._operations.all_off_closed()
+        if self._journal:
+            self._journal.close()
+        if cleanup:
+            GPIO.cleanup()
+
+    def stop(self):
+        self._state['alive'] = False
+
 
 if __name__ == '__main__':
-    keg_washer = KegWasher(pin_config, mode_config)
+    keg_washer = KegWasher(pin_config, mode_config, service_config)
     keg_washer.daemon = True
     keg_washer.start()
     keg_washer.join()
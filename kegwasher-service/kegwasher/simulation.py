@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import logging
+import os
+import threading
+import time
+
+from kegwasher.backend import GPIOConstants
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class SimulatedGPIO(GPIOConstants):
+    # In-process stand-in for RPi.GPIO. Input pins read their pull resistor unless something drives
+    # them with inject(), edges on inputs fire the callbacks registered with add_event_detect.
+    # Callbacks run synchronously in the thread that caused the edge.
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._mode = None
+        self._pins = None
+        self._events = None
+        self._stats = None
+        self.reset()
+
+    @property
+    def stats(self):
+        return dict(self._stats)
+
+    def _check_mode(self):
+        if self._mode is None:
+            raise RuntimeError('Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)')
+
+    def _pin(self, channel):
+        self._check_mode()
+        if channel not in self._pins:
+            raise RuntimeError(f'The GPIO channel {channel} has not been set up')
+        return self._pins[channel]
+
+    def _level(self, pin):
+        if pin['direction'] == self.OUT:
+            return pin['output']
+        if pin['driven'] is not None:
+            return pin['driven']
+        return self.HIGH if pin['pull'] == self.PUD_UP else self.LOW
+
+    def _fire(self, channel, before, after):
+        if before == after or channel not in self._events:
+            return
+        self._stats['edges'] += 1
+        edge, callbacks, bouncetime, last = self._events[channel]
+        if edge == self.RISING and not after or edge == self.FALLING and after:
+            return
+        now = time.monotonic()
+        if bouncetime and last is not None and (now - last) * 1000 < bouncetime:
+            return
+        self._events[channel][3] = now
+        for callback in list(callbacks):
+            callback(channel)
+
+    def add_event_callback(self, channel, callback):
+        with self._lock:
+            self._events[channel][1].append(callback)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self._lock:
+            if self._pin(channel)['direction'] != self.IN:
+                raise RuntimeError(f'You must setup() the GPIO channel {channel} as an input first')
+            self._events[channel] = [edge, [callback] if callback else list(), bouncetime, None]
+
+    def cleanup(self, channel=None):
+        with self._lock:
+            if channel is None:
+                self._pins.clear()
+                self._events.clear()
+            else:
+                self._pins.pop(channel, None)
+                self._events.pop(channel, None)
+
+    def getmode(self):
+        return self._mode
+
+    def input(self, channel):
+        with self._lock:
+            self._stats['inputs'] += 1
+            return self._level(self._pin(channel))
+
+    def output(self, channel, value):
+        with self._lock:
+            pin = self._pin(channel)
+            if pin['direction'] != self.OUT:
+                raise RuntimeError(f'The GPIO channel {channel} has not been set up as an OUTPUT')
+            self._stats['outputs'] += 1
+            pin['output'] = self.HIGH if value else self.LOW
+
+    def remove_event_detect(self, channel):
+        with self._lock:
+            self._events.pop(channel, None)
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def setup(self, channel, direction, pull_up_down=GPIOConstants.PUD_OFF, initial=None):
+        with self._lock:
+            self._check_mode()
+            driven = self._pins.get(channel, dict()).get('driven', None)
+            self._pins[channel] = {'direction': direction, 'pull': pull_up_down, 'driven': driven,
+                                   'output': self.HIGH if initial else self.LOW}
+
+    def setwarnings(self, warnings):
+        pass
+
+    def reset(self):
+        with self._lock:
+            self._mode = None
+            self._pins = dict()
+            self._events = dict()
+            self._stats = {'inputs': 0, 'outputs': 0, 'edges': 0}
+
+    # Simulation controls
+    def inject(self, channel, level):
+        # Drive an input pin from outside, like a switch closing, and fire any matching edge callbacks
+        with self._lock:
+            pin = self._pins.setdefault(channel, {'direction': self.IN, 'pull': self.PUD_OFF,
+                                                  'driven': None, 'output': self.LOW})
+            before = self._level(pin)
+            pin['driven'] = self.HIGH if level else self.LOW
+            after = self._level(pin)
+        self._fire(channel, before, after)
+
+    def level(self, channel):
+        with self._lock:
+            return self._level(self._pins[channel])
+
+    def release(self, channel):
+        # Stop driving an input pin, it falls back to its pull resistor
+        with self._lock:
+            pin = self._pins[channel]
+            before = self._level(pin)
+            pin['driven'] = None
+            after = self._level(pin)
+        self._fire(channel, before, after)
+
+
+class SimulatedPCA9555(object):
+    # Register file of a PCA9555 16-bit I/O expander
+    #   0/1 input, 2/3 output, 4/5 polarity inversion, 6/7 configuration (1 = input)
+    # INT is asserted while an input pin differs from what its port last read, reading the port releases it.
+    # interrupt_line, if set, is called with the INT level (0 asserted) whenever it changes.
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._inputs = 0
+        self._registers = None
+        self._snapshot = None
+        self._int = 1
+        self.interrupt_line = None
+        self.reset()
+
+    @property
+    def registers(self):
+        return list(self._registers)
+
+    def _input(self, register):
+        port = register & 1
+        config = self._registers[6 + port]
+        output = self._registers[2 + port]
+        external = (self._inputs >> (8 * port)) & 0xFF
+        return ((external & config) | (output & ~config & 0xFF)) ^ self._registers[4 + port]
+
+    def _signal(self):
+        # Recompute INT and tell the line about a change, outside the lock as it may call straight back in
+        if self.interrupt_line is None:
+            return
+        with self._lock:
+            level = 0
+            for port in range(2):
+                if (self._input(port) ^ self._snapshot[port]) & self._registers[6 + port]:
+                    level = 1
+            level = 1 - level
+            changed, self._int = level != self._int, level
+        if changed and self.interrupt_line:
+            self.interrupt_line(level)
+
+    def read(self, register):
+        with self._lock:
+            if not 0 <= register <= 7:
+                raise OSError(121, 'Remote I/O error')
+            if register > 1:
+                return self._registers[register]
+            value = self._snapshot[register] = self._input(register)
+        self._signal()
+        return value
+
+    def reset(self):
+        # Power-on defaults, also what the chip falls back to after a brown-out
+        with self._lock:
+            self._registers = [0x00, 0x00, 0xFF, 0xFF, 0x00, 0x00, 0xFF, 0xFF]
+            self._snapshot = [self._input(0), self._input(1)]
+
+    def set_input(self, pin, level):
+        with self._lock:
+            if level:
+                self._inputs |= 1 << pin
+            else:
+                self._inputs &= ~(1 << pin)
+        self._signal()
+
+    def write(self, register, value):
+        with self._lock:
+            if not 0 <= register <= 7:
+                raise OSError(121, 'Remote I/O error')
+            if register >= 2:
+                self._registers[register] = value & 0xFF
+        self._signal()
+
+
+class SimulatedSMBus(object):
+    # smbus2.SMBus compatible view of the simulated devices on one bus
+    def __init__(self, simulation, bus):
+        self._bus = bus
+        self._simulation = simulation
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _device(self, address):
+        return self._simulation.device(self._bus, address)
+
+    def close(self):
+        pass
+
+    def read_byte_data(self, i2c_addr, register, force=None):
+        self._simulation.count(self._bus, i2c_addr, 'reads')
+        return self._device(i2c_addr).read(register)
+
+    def read_word_data(self, i2c_addr, register, force=None):
+        self._simulation.count(self._bus, i2c_addr, 'reads')
+        device = self._device(i2c_addr)
+        return device.read(register) | (device.read(register + 1) << 8)
+
+    def write_byte_data(self, i2c_addr, register, value, force=None):
+        self._simulation.count(self._bus, i2c_addr, 'writes')
+        self._device(i2c_addr).write(register, value)
+
+    def write_word_data(self, i2c_addr, register, value, force=None):
+        self._simulation.count(self._bus, i2c_addr, 'writes')
+        device = self._device(i2c_addr)
+        device.write(register, value & 0xFF)
+        device.write(register + 1, (value >> 8) & 0xFF)
+
+
+class SimulatedCharLCD(object):
+    # Virtual HD44780 character display with the Adafruit_CharLCD interface
+    def __init__(self, rs, en, d4, d5, d6, d7, cols, lines, backlight=None, *args, **kwargs):
+        self._columns = cols
+        self._rows = lines
+        self._cursor = [0, 0]
+        self._ddram = None
+        self.backlight = 1
+        self.stats = {'bytes': 0, 'commands': 0}
+        self.clear()
+
+    @property
+    def text(self):
+        return '\n'.join(''.join(row) for row in self._ddram)
+
+    def _command(self):
+        self.stats['commands'] += 1
+        self.stats['bytes'] += 1
+
+    def autoscroll(self, autoscroll):
+        self._command()
+
+    def blink(self, blink):
+        self._command()
+
+    def clear(self):
+        self._command()
+        self._ddram = [[' '] * self._columns for row in range(self._rows)]
+        self._cursor = [0, 0]
+
+    def create_char(self, location, pattern):
+        self._command()
+        self.stats['bytes'] += len(pattern)
+
+    def enable_display(self, enable):
+        self._command()
+
+    def home(self):
+        self._command()
+        self._cursor = [0, 0]
+
+    def message(self, text):
+        for char in text:
+            if char == '\n':
+                self.set_cursor(0, self._cursor[1] + 1)
+            else:
+                self.write8(ord(char), True)
+
+    def set_backlight(self, backlight):
+        self.backlight = backlight
+
+    def set_cursor(self, col, row):
+        self._command()
+        self._cursor = [min(col, self._columns - 1), min(row, self._rows - 1)]
+
+    def show_cursor(self, show):
+        self._command()
+
+    def write8(self, value, char_mode=False):
+        if not char_mode:
+            self._command()
+            return
+        self.stats['bytes'] += 1
+        column, row = self._cursor
+        if column < self._columns:
+            self._ddram[row][column] = chr(value)
+        self._cursor[0] += 1
+
+
+class Simulation(object):
+    # Shared simulated hardware: one GPIO controller, the devices on each I2C bus and the LCDs created.
+    # Any address in the PCA955x range gets an expander on first access, other addresses don't answer.
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.gpio = SimulatedGPIO()
+        self.devices = None
+        self.lcds = None
+        self.io = None
+        self.reset()
+
+    def add_device(self, bus, address, device):
+        with self._lock:
+            self.devices[(bus, address)] = device
+        return device
+
+    def char_lcd(self, *args, **kwargs):
+        lcd = SimulatedCharLCD(*args, **kwargs)
+        self.lcds.append(lcd)
+        return lcd
+
+    def count(self, bus, address, kind):
+        with self._lock:
+            counts = self.io.setdefault((bus, address), {'reads': 0, 'writes': 0})
+            counts[kind] += 1
+
+    def device(self, bus, address):
+        with self._lock:
+            if (bus, address) not in self.devices:
+                if not 0x20 <= address <= 0x27:
+                    raise OSError(121, 'Remote I/O error')
+                self.devices[(bus, address)] = SimulatedPCA9555()
+            return self.devices[(bus, address)]
+
+    def connect_interrupt(self, bus, address, channel):
+        # Wire the INT output of the expander at address to a GPIO input, it idles high
+        device = self.device(bus, address)
+        device.interrupt_line = lambda level: self.gpio.inject(channel, level)
+        self.gpio.inject(channel, 1)
+        return device
+
+    def reset(self):
+        with self._lock:
+            self.gpio.reset()
+            self.devices = dict()
+            self.lcds = list()
+            self.io = dict()
+
+    def smbus(self, bus):
+        return SimulatedSMBus(self, bus)
+
+
+simulation = Simulation()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import logging
+import os
+import time
+
+from kegwasher import metrics
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+def _process_age():
+    # Seconds since this process was started, counting interpreter start-up, or 0 where /proc isn't available
+    try:
+        with open('/proc/uptime') as uptime, open('/proc/self/stat') as stat:
+            started = int(stat.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+            return max(float(uptime.read().split()[0]) - started, 0)
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def uptime():
+    # Seconds since the system booted, None where /proc isn't available
+    try:
+        with open('/proc/uptime') as uptime:
+            return float(uptime.read().split()[0])
+    except (OSError, ValueError):
+        return None
+
+
+class StartupReport(object):
+    # Times the phases of daemon start-up. Each mark() closes the phase that ran since the previous one,
+    # marks of the same phase (one per station) add up.
+    def __init__(self, budget=None):
+        self._started = time.monotonic() - _process_age()
+        self._last = self._started
+        self._phases = dict()
+        self.budget = budget
+
+    @property
+    def phases(self):
+        return dict(self._phases)
+
+    @property
+    def total(self):
+        return self._last - self._started
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self._phases[phase] = self._phases.get(phase, 0) + now - self._last
+        self._last = now
+
+    def report(self, ready=True):
+        # Log the phases and flag a start-up slower than the budget, returns {phase: seconds}
+        if not ready:
+            log.warning(f'Not every station shows Select Mode after {round(self.total, 3)}s')
+        for phase, seconds in self._phases.items():
+            log.info(f'Startup {phase}: {round(seconds, 3)}s')
+            metrics.startup_seconds.labels(phase).set(seconds)
+        booted = uptime()
+        log.info(f'Startup took {round(self.total, 3)}s' + (f', {round(booted, 1)}s after boot' if booted else ''))
+        if self.budget and self.total > self.budget:
+            log.warning(f'Startup took {round(self.total, 3)}s, over its budget of {self.budget}s')
+        return self.phases
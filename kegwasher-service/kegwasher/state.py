@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import logging
+import os
+import threading
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class State(object):
+    # Dict-like state shared by all threads. Every change bumps a version number and wakes anyone
+    # blocked in wait(), so the controller can sleep until something actually happens.
+    def __init__(self, *args, **kwargs):
+        self._condition = threading.Condition()
+        self._data = dict(*args, **kwargs)
+        self._version = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._condition:
+            if key in self._data and self._data[key] == value:
+                return
+            self._data[key] = value
+            self._bump()
+
+    def __repr__(self):
+        return f'State(version={self._version}, {self._data})'
+
+    def _bump(self):
+        self._version += 1
+        self._condition.notify_all()
+
+    @property
+    def version(self):
+        return self._version
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def notify(self):
+        # Wake waiters without changing any value, e.g. when a worker thread exits
+        with self._condition:
+            self._bump()
+
+    def update(self, *args, **kwargs):
+        # Apply several changes as one version bump
+        with self._condition:
+            changes = {key: value for key, value in dict(*args, **kwargs).items()
+                       if key not in self._data or self._data[key] != value}
+            if changes:
+                self._data.update(changes)
+                self._bump()
+
+    def wait(self, version, timeout=None):
+        # Block until the version moves past the one the caller last saw, returns the current version
+        with self._condition:
+            self._condition.wait_for(lambda: self._version != version, timeout)
+            return self._version
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import copy
+import hashlib
+import logging
+import os
+import time
+
+from kegwasher import configfile, metrics
+from kegwasher.api import ControlServer
+from kegwasher.clock import from_speed
+from kegwasher.exceptions import ConfigError
+from kegwasher.inputs import InputProcessor
+from kegwasher.scheduler import ResourceScheduler
+from kegwasher.service import KegWasher
+from kegwasher.watch import FileWatcher
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+
+class Stations(object):
+    # Runs one KegWasher per washing head. Each station has its own state, mode ring, display, switches
+    # and device names, stations only share the GPIO controller, the I2C buses, the clock and the utilities
+    # handed out by the resource scheduler.
+    # pin_config either describes a single washer, or carries a 'stations' list of such descriptions,
+    # each with a 'name' and optionally its own 'modes' and 'operations'.
+    def __init__(self, pin_config=None, mode_config=None, service_config=None, clock=None, startup=None):
+        log.debug(f'Initializing Stations')
+        self._service_config = service_config or dict()
+        self._clock = clock or from_speed(self._service_config.get('clock_speed', 1))
+        station_configs = self._validate_stations(pin_config)
+        # Mode programs may come from a file that is watched and reloaded while the daemon runs
+        reload_config = self._service_config.get('mode_reload', dict())
+        self._mode_file = reload_config.get('file', None)
+        self._mode_digest = None
+        self._watcher = None
+        if self._mode_file:
+            try:
+                mode_config = self._load_modes(self._mode_file)
+            except (ConfigError, OSError, ValueError) as e:
+                log.error(f'Unable to load modes from {self._mode_file}, using the built-in modes: {e}')
+            self._watcher = FileWatcher(path=self._mode_file, callback=self.reload_modes,
+                                        poll_interval=reload_config.get('poll_interval', 2))
+        if startup:
+            startup.mark('config validation')
+        self._exporter = metrics.Exporter(**self._service_config.get('metrics', dict()))
+        # Stations draw on the same supply lines and power budget, steps wait their turn for them
+        self._scheduler = ResourceScheduler(**self._service_config.get('resources', dict()))
+        # One thread debounces the switches of every station
+        self._inputs = InputProcessor(clock=self._clock, **self._service_config.get('inputs', dict()))
+        self._washers = dict()
+        # Stations running the shared modes, the others bring their own
+        self._shared_modes = list()
+        for station in station_configs:
+            station = copy.deepcopy(station)
+            name = station.pop('name')
+            modes = station.pop('modes', None)
+            if not modes:
+                modes = mode_config
+                self._shared_modes.append(name)
+            self._washers[name] = KegWasher(station, modes, self._service_config, self._clock, name,
+                                             self._scheduler, startup, self._inputs)
+        # Local control and status API over every station
+        self._api = ControlServer(stations=self._washers, **self._service_config.get('api', dict()))
+
+    @staticmethod
+    def _validate_stations(pin_config=None):
+        if not pin_config:
+            error_msg = f'Invalid Hardware Configuration Received: {pin_config}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        stations = pin_config.get('stations', None) or [dict(pin_config, name='kegwasher')]
+        # No two stations may claim the same station name, GPIO pin or expander
+        names, pins, expanders = set(), dict(), dict()
+        for station in stations:
+            name = station.get('name', None)
+            if not name or name in names:
+                error_msg = f'Stations need unique names, received {name}'
+                log.fatal(error_msg)
+                raise ConfigError(error_msg)
+            names.add(name)
+            for expander in station.get('io_expanders', list()):
+                key = (expander.get('bus'), expander.get('address'))
+                if key in expanders:
+                    error_msg = f'Expander {expander.get("name")} of {name} is already used by {expanders[key]}'
+                    log.fatal(error_msg)
+                    raise ConfigError(error_msg)
+                expanders[key] = name
+            # Expander INT lines go to Pi pins as well
+            used = [expander.get('interrupt') for expander in station.get('io_expanders', list())
+                    if expander.get('interrupt', None) is not None]
+            used.extend(entry.get('pin') for entry in station.get('display', dict()).values() if isinstance(entry, dict))
+            for kind in ['heaters', 'pumps', 'switches', 'valves']:
+                used.extend(device.get('pin') for device in station.get(kind, list()) if not device.get('expander', None))
+            for pin in used:
+                if pin in pins and pins[pin] != name:
+                    error_msg = f'GPIO pin {pin} of {name} is already used by {pins[pin]}'
+                    log.fatal(error_msg)
+                    raise ConfigError(error_msg)
+                pins[pin] = name
+        return stations
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def stations(self):
+        return dict(self._washers)
+
+    def _load_modes(self, path):
+        with open(path, 'rb') as mode_file:
+            data = mode_file.read()
+        modes = configfile.parse(data, path)
+        if not isinstance(modes, dict) or not all(isinstance(mode, dict) for mode in modes.values()):
+            error_msg = f'{path} must map mode names to modes'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._mode_digest = hashlib.sha256(data).digest()
+        return modes
+
+    def reload_modes(self, path=None):
+        # Load, validate and compile the mode file for every station that shares it, then stage the new modes
+        # on all of them; if any station rejects them, all keep what they have. Returns whether modes changed.
+        path = path or self._mode_file
+        digest = self._mode_digest
+        try:
+            modes = self._load_modes(path)
+            if self._mode_digest == digest:
+                return False
+            prepared = {name: self._washers[name].prepare_modes(modes) for name in self._shared_modes}
+        except (ConfigError, OSError, ValueError) as e:
+            self._mode_digest = digest
+            log.error(f'Keeping the current modes, {path} was rejected: {e}')
+            return False
+        for name, modes in prepared.items():
+            self._washers[name].stage_modes(modes)
+        log.info(f'Loaded modes from {path} for {len(prepared)} stations')
+        return True
+
+    def join(self, timeout=None):
+        for washer in self._washers.values():
+            washer.join(timeout)
+
+    def wait_ready(self, timeout=None):
+        # Block until every station shows its mode selection, returns False if one didn't in time
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for washer in self._washers.values():
+            left = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not washer.wait_ready(left):
+                return False
+        return True
+
+    def shutdown(self):
+        # Every station off, then the GPIO controller is released once
+        log.info(f'Shutting down {len(self._washers)} stations')
+        self._api.stop()
+        if self._watcher:
+            self._watcher.stop()
+        self._inputs.stop()
+        washers = list(self._washers.values())
+        for index, washer in enumerate(washers):
+            washer.shutdown(cleanup=index == len(washers) - 1)
+        self._exporter.stop()
+
+    def start(self):
+        self._exporter.start()
+        self._api.start()
+        if self._watcher:
+            self._watcher.start()
+        for name, washer in self._washers.items():
+            log.info(f'Starting station {name}')
+            washer.daemon = True
+            washer.start()
+
+    def stop(self):
+        for washer in self._washers.values():
+            washer.stop()
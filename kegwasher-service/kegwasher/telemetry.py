@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import array
+import csv
+import logging
+import os
+import threading
+import time
+
+from kegwasher import clock
+from kegwasher.exceptions import ConfigError
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+# Output devices in bit order, the low bit of the state mask is the first valve
+_kinds = ['valves', 'pumps', 'heaters']
+
+
+class Telemetry(object):
+    # History of which output devices were on, for the last capacity state changes of one station.
+    # Each change is stored as the clock's monotonic time and a packed bitmask of every valve, pump and heater,
+    # one bit per device, in arrays allocated once at start-up: the oldest changes are overwritten and memory
+    # never grows. A change costs entry_size bytes, 16 up to 64 devices, so the default 16384 changes take
+    # 256 KiB per station and hold several hundred cycles (a cycle makes one change per step, plus one per
+    # device switched outside a transition).
+    # GPIO devices report through HardwareObject.on/off, expander devices through the expander's output port
+    # writes, where transitions set a whole port at once.
+    def __init__(self, *args, **kwargs):
+        self._capacity = None
+        self.capacity = kwargs.get('capacity', 16384)
+        self._clock = kwargs.get('clock', None) or clock.real
+        hardware = kwargs.get('hardware', dict())
+        self.station = kwargs.get('station', None)
+        # (kind, name) per bit, and the bit of each GPIO device and of each expander pin
+        self.columns = list()
+        self._bits = dict()
+        self._pins = dict()
+        for kind in _kinds:
+            for name, device in hardware.get(kind, dict()).items():
+                bit = len(self.columns)
+                self.columns.append((kind, name))
+                if device.expander:
+                    self._pins.setdefault(device.expander.GPIO, list()).append((device.pin, bit))
+                else:
+                    self._bits[device] = bit
+        # 64 bit words per entry
+        self._words = max(1, (len(self.columns) + 63) // 64)
+        self._times = array.array('d', [0]) * self._capacity
+        self._masks = array.array('Q', [0]) * (self._capacity * self._words)
+        # Per expander, the station bits and the port pins our devices occupy, and {port value on those pins:
+        # station bits}. A station drives a handful of distinct values, each is translated once and then looked up.
+        self._ports = {expander: (sum(1 << bit for pin, bit in pins), sum(1 << pin for pin, bit in pins), dict())
+                       for expander, pins in self._pins.items()}
+        # Next slot to write and the number of entries held
+        self._head = 0
+        self._count = 0
+        self._mask = 0
+        self._lock = threading.Lock()
+        # Recorded times are monotonic, this turns them into wall-clock time for export
+        self._epoch = time.time() - self._clock.monotonic()
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @capacity.setter
+    def capacity(self, capacity=None):
+        if not isinstance(capacity, int) or isinstance(capacity, bool) or capacity < 2:
+            error_msg = f'Telemetry capacity must be a number of entries of at least 2, received {capacity}'
+            log.fatal(error_msg)
+            raise ConfigError(error_msg)
+        self._capacity = capacity
+
+    @property
+    def entry_size(self):
+        # Bytes per recorded state change
+        return self._times.itemsize + self._masks.itemsize * self._words
+
+    @property
+    def memory(self):
+        return self._capacity * self.entry_size
+
+    def __len__(self):
+        return self._count
+
+    def attach(self):
+        # Start recording: GPIO devices report to us, expanders call back on each output port write
+        with self._lock:
+            for device, bit in self._bits.items():
+                if device.value:
+                    self._mask |= 1 << bit
+            for expander, pins in self._pins.items():
+                self._mask = self._apply_port(self._mask, pins, expander.outputvalue)
+            self._append(self._mask)
+        for device in self._bits:
+            device.telemetry = self
+        for expander in self._pins:
+            expander.add_output_listener(self.port_written)
+
+    def detach(self):
+        for device in self._bits:
+            device.telemetry = None
+        for expander in self._pins:
+            expander.remove_output_listener(self.port_written)
+
+    @staticmethod
+    def _apply_port(mask, pins, value):
+        for pin, bit in pins:
+            if value & (1 << pin):
+                mask |= 1 << bit
+            else:
+                mask &= ~(1 << bit)
+        return mask
+
+    def _append(self, mask):
+        head = self._head
+        self._times[head] = self._clock.monotonic()
+        if self._words == 1:
+            self._masks[head] = mask
+        else:
+            for word in range(self._words):
+                self._masks[head * self._words + word] = (mask >> (64 * word)) & 0xFFFFFFFFFFFFFFFF
+        self._head = head + 1 if head + 1 < self._capacity else 0
+        if self._count < self._capacity:
+            self._count += 1
+
+    def record(self, device, value):
+        # A GPIO device was switched
+        bit = 1 << self._bits[device]
+        with self._lock:
+            mask = self._mask | bit if value else self._mask & ~bit
+            if mask != self._mask:
+                self._mask = mask
+                self._append(mask)
+
+    def port_written(self, expander, value):
+        # An expander's output port is about to be set to value; pins of other stations' devices are ignored
+        bits, used, translated = self._ports[expander]
+        value &= used
+        pins = translated.get(value, None)
+        if pins is None:
+            pins = translated.setdefault(value, self._apply_port(0, self._pins[expander], value))
+        with self._lock:
+            mask = (self._mask & ~bits) | pins
+            if mask != self._mask:
+                self._mask = mask
+                self._append(mask)
+
+    def _entry(self, index):
+        # index 0 is the oldest entry held
+        slot = (self._head - self._count + index) % self._capacity
+        mask = 0
+        for word in range(self._words):
+            mask |= self._masks[slot * self._words + word] << (64 * word)
+        return self._times[slot], mask
+
+    def _find(self, timestamp):
+        # Index of the first entry recorded after timestamp
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, start=None, end=None):
+        # [(monotonic time, mask)] of the state changes between start and end, led by the state in effect at
+        # start when one is known. Times are the clock's monotonic seconds.
+        with self._lock:
+            first = 0 if start is None else max(self._find(start) - 1, 0)
+            last = self._count if end is None else self._find(end)
+            entries = [self._entry(index) for index in range(first, last)]
+        if start is not None and entries and entries[0][0] < start:
+            entries[0] = (start, entries[0][1])
+        return entries
+
+    def decode(self, mask):
+        # {kind: {name: 0 or 1}} of a recorded mask
+        state = {kind: dict() for kind in _kinds}
+        for bit, (kind, name) in enumerate(self.columns):
+            state[kind][name] = (mask >> bit) & 1
+        return state
+
+    def state_at(self, timestamp):
+        entries = self.query(timestamp, timestamp)
+        if not entries or entries[0][0] > timestamp:
+            return None
+        return self.decode(entries[0][1])
+
+    def _buckets(self, entries, end, interval):
+        # Share of each interval every device was on, a pulse shorter than an interval still shows
+        bucket, on = entries[0][0], [0.0] * len(self.columns)
+        for (at, mask), until in zip(entries, [at for at, mask in entries[1:]] + [end]):
+            while at < until:
+                step = min(until, bucket + interval) - at
+                for bit in range(len(self.columns)):
+                    if (mask >> bit) & 1:
+                        on[bit] += step
+                at += step
+                if at >= bucket + interval:
+                    yield bucket, [round(seconds / interval, 3) for seconds in on]
+                    bucket, on = bucket + interval, [0.0] * len(self.columns)
+        if at > bucket:
+            yield bucket, [round(seconds / (at - bucket), 3) for seconds in on]
+
+    def export_csv(self, output, start=None, end=None, interval=None):
+        # Writes time (wall clock, seconds since the epoch), monotonic time, then one column per device to the
+        # text file output. Without interval there is a row per state change with 0/1 values; with interval
+        # seconds a row per interval with the share of it each device was on. Returns the number of rows.
+        end = self._clock.monotonic() if end is None else end
+        entries = [entry for entry in self.query(start, end) if entry[0] <= end]
+        writer = csv.writer(output)
+        writer.writerow(['time', 'monotonic'] + [f'{kind}.{name}' for kind, name in self.columns])
+        if not entries:
+            return 0
+        if interval:
+            rows = self._buckets(entries, end, interval)
+        else:
+            rows = ((at, [(mask >> bit) & 1 for bit in range(len(self.columns))]) for at, mask in entries)
+        count = 0
+        for at, values in rows:
+            writer.writerow([f'{at + self._epoch:.3f}', f'{at:.3f}'] + values)
+            count += 1
+        return count
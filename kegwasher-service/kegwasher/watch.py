@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+log = logging.getLogger(os.getenv('LOGGER_NAME', 'kegwasher'))
+
+# inotify(7) event bits for a file being written and closed, or renamed into place
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_event = struct.Struct('iIII')
+
+
+def _inotify(directory):
+    # An inotify descriptor watching directory, or None where the C library doesn't have inotify
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class FileWatcher(object):
+    # Calls callback(path) on its own thread whenever path is written or replaced. The file's directory is
+    # watched with inotify, so editors that save by writing a new file and renaming it are seen as well;
+    # a burst of events within settle seconds causes one call. The thread sleeps until an event or stop(),
+    # which wakes it through a pipe. Without inotify the file is polled with stat() every poll_interval seconds.
+    def __init__(self, *args, **kwargs):
+        self.callback = kwargs.get('callback', None)
+        self.path = os.path.abspath(kwargs.get('path', None))
+        self.poll_interval = kwargs.get('poll_interval', 2)
+        self.settle = kwargs.get('settle', 0.1)
+        self._stop = threading.Event()
+        self._thread = None
+        # Read end and write end of the pipe stop() wakes the inotify wait with
+        self._wakeup = None
+
+    def _changed(self):
+        try:
+            self.callback(self.path)
+        except Exception:
+            log.exception(f'Handling a change of {self.path} failed')
+
+    def _poll(self):
+        def signature():
+            try:
+                stat = os.stat(self.path)
+                return stat.st_ino, stat.st_size, stat.st_mtime_ns
+            except OSError:
+                return None
+
+        last = signature()
+        while not self._stop.wait(self.poll_interval):
+            current = signature()
+            if current != last and current is not None:
+                self._changed()
+            last = current
+
+    def _watch(self, fd):
+        name = os.fsencode(os.path.basename(self.path))
+        try:
+            while not self._stop.is_set():
+                if fd not in select.select([fd, self._wakeup[0]], [], [])[0]:
+                    continue
+                seen = False
+                # Drain the burst, an editor's save is often several events
+                while select.select([fd], [], [], self.settle)[0]:
+                    buffer = os.read(fd, 4096)
+                    offset = 0
+                    while offset < len(buffer):
+                        wd, mask, cookie, length = _event.unpack_from(buffer, offset)
+                        offset += _event.size
+                        if buffer[offset:offset + length].rstrip(b'\0') == name:
+                            seen = True
+                        offset += length
+                if seen:
+                    self._changed()
+        finally:
+            os.close(fd)
+
+    def _run(self):
+        fd = _inotify(os.path.dirname(self.path))
+        if fd is None:
+            log.info(f'inotify unavailable, polling {self.path} every {self.poll_interval}s')
+            self._poll()
+        else:
+            log.debug(f'Watching {self.path} with inotify')
+            self._watch(fd)
+
+    def start(self):
+        self._stop.clear()
+        self._wakeup = os.pipe()
+        self._thread = threading.Thread(target=self._run, name='kegwasher-watch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._wakeup:
+            os.write(self._wakeup[1], b'\0')
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._wakeup:
+            for end in self._wakeup:
+                os.close(end)
+            self._wakeup = None
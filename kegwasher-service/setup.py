@@ -28,8 +28,11 @@ setup(
     long_description=readme,
     long_description_content_type="text/markdown",
     install_requires=getRequires(),
-    python_requires='>=3.6',
-    entry_points={"console_scripts": ["kegwasher = kegwasher.kegwasher:main"]},
+    python_requires='>=3.7',
+    entry_points={"console_scripts": ["kegwasher = kegwasher.kegwasher:main",
+                                    "kegwasher-benchmark = kegwasher.benchmark:main",
+                                    "kegwasher-config = kegwasher.configfile:main",
+                                    "kegwasher-optimize = kegwasher.optimizer:main"]},
     classifiers=[
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
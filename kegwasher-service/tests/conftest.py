@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import copy
+import http.client
+import json
+import socket
+import time
+
+import pytest
+
+from kegwasher import backend
+
+backend.select('simulation')
+
+from kegwasher.clock import VirtualClock
+from kegwasher.config import pin_config, mode_config, service_config
+from kegwasher.simulation import simulation
+from kegwasher.stations import Stations
+
+
+def switch_pin(config, name):
+    return next(switch['pin'] for switch in config['switches'] if switch['name'] == name)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return predicate()
+
+
+def histogram_count(histogram, station):
+    # Observations of every series of histogram labelled with station
+    return sum(series.count for values, series in list(histogram._series.items()) if values[0] == station)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super(UnixHTTPConnection, self).__init__('localhost')
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(self._path)
+
+
+def request(path, method, url, body=None):
+    connection = UnixHTTPConnection(path)
+    connection.request(method, url, json.dumps(body) if body is not None else None)
+    response = connection.getresponse()
+    data = response.read()
+    connection.close()
+    return response.status, json.loads(data) if response.getheader('Content-Type') == 'application/json' else data
+
+
+@pytest.fixture
+def make_stations(tmp_path):
+    # Stations on the simulated hardware, their abort switches in the run position; shut down after the test
+    made = list()
+
+    def make(config=None, modes=None, clock=None, **overrides):
+        simulation.reset()
+        config = copy.deepcopy(config or pin_config)
+        for station in config.get('stations', [config]):
+            simulation.gpio.inject(switch_pin(station, 'abort'), 1)
+        options = dict(service_config, backend='simulation', journal=dict(), api=dict())
+        options.update(overrides)
+        stations = Stations(config, modes or mode_config, options, clock=clock or VirtualClock(50))
+        made.append(stations)
+        stations.start()
+        assert stations.wait_ready(5)
+        return stations
+
+    yield make
+    for stations in made:
+        stations.shutdown()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import time
+
+from kegwasher import metrics
+
+from conftest import histogram_count, request
+
+
+def test_api_abort_is_not_a_switch_interrupt(make_stations, tmp_path):
+    socket_path = str(tmp_path / 'api.sock')
+    stations = make_stations(api={'socket': socket_path, 'port': 0})
+    washer = stations.stations['kegwasher']
+    interrupts = histogram_count(metrics.interrupt_latency, 'kegwasher')
+    aborts = histogram_count(metrics.abort_latency, 'kegwasher')
+    assert request(socket_path, 'POST', '/stations/kegwasher/start', {'mode': 'sanitize'})[0] == 202
+    assert request(socket_path, 'POST', '/stations/kegwasher/abort')[0] == 202
+    deadline = time.monotonic() + 5
+    while not washer.snapshot.aborted and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert washer.snapshot.aborted
+    washer._dispatcher.wait_idle(5)
+    assert histogram_count(metrics.interrupt_latency, 'kegwasher') == interrupts
+    assert histogram_count(metrics.abort_latency, 'kegwasher') == aborts
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import json
+
+import pytest
+
+from kegwasher import configfile
+from kegwasher.config import pin_config, mode_config
+from kegwasher.exceptions import ConfigError
+
+
+def _document():
+    return json.loads(configfile.export(pin_config, mode_config))
+
+
+def test_exported_configuration_checks():
+    hardware, modes = configfile.check(_document(), 'test.json')
+    assert [switch['name'] for switch in hardware['switches']] == [switch['name'] for switch in pin_config['switches']]
+    assert set(modes) == set(mode_config)
+
+
+def test_station_without_abort_switch_is_rejected():
+    document = _document()
+    document['hardware']['switches'] = [switch for switch in document['hardware']['switches']
+                                        if switch['name'] != 'abort']
+    with pytest.raises(ConfigError, match=r'hardware\.switches must include the abort switch'):
+        configfile.check(document, 'test.json')
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import threading
+
+from kegwasher.dispatcher import Dispatcher
+
+
+class _Recorder(object):
+    # Action factory recording (action, event) as each action runs, the first one blocks until released
+    def __init__(self):
+        self.ran = list()
+        self.running = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, action, submitted, event):
+        recorder = self
+
+        class Run(object):
+            def run(self):
+                recorder.ran.append((action, event))
+                if len(recorder.ran) == 1:
+                    recorder.running.set()
+                    recorder.release.wait(2)
+
+        return Run()
+
+
+def _dispatcher(recorder):
+    dispatcher = Dispatcher(factory=recorder, workers=2)
+    dispatcher.start()
+    return dispatcher
+
+
+def test_abort_events_run_in_order():
+    recorder = _Recorder()
+    dispatcher = _dispatcher(recorder)
+    try:
+        dispatcher.submit('abort', event='asserted')
+        assert recorder.running.wait(2)
+        for event in ['cleared', 'asserted']:
+            dispatcher.submit('abort', event=event)
+        dispatcher.submit('mode', event='press')
+        recorder.release.set()
+        assert dispatcher.wait_idle(2)
+    finally:
+        recorder.release.set()
+        dispatcher.stop()
+    # The last abort event applied matches the switch
+    assert [event for action, event in recorder.ran if action == 'abort'] == ['asserted', 'cleared', 'asserted']
+
+
+def test_only_identical_events_coalesce():
+    recorder = _Recorder()
+    dispatcher = _dispatcher(recorder)
+    try:
+        dispatcher.submit('mode', event='press')
+        assert recorder.running.wait(2)
+        assert dispatcher.submit('mode', event='press')
+        assert dispatcher.submit('mode', event='long_press')
+        assert dispatcher.submit('mode', event='press')
+        assert not dispatcher.submit('mode', event='press')
+        recorder.release.set()
+        assert dispatcher.wait_idle(2)
+    finally:
+        recorder.release.set()
+        dispatcher.stop()
+    assert recorder.ran == [('mode', 'press'), ('mode', 'press'), ('mode', 'long_press'), ('mode', 'press')]
+    assert dispatcher.stats['coalesced'] == 1
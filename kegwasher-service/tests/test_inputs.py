@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import threading
+import time
+
+from kegwasher.clock import VirtualClock
+from kegwasher.inputs import InputProcessor
+
+from conftest import wait_for
+
+
+class FakeSwitch(object):
+    def __init__(self, name='mode', action='mode', state=0):
+        self.name = name
+        self.action = action
+        self.expander = None
+        self.pin = 5
+        self.event = 'both'
+        self.state = state
+        self.callback = None
+
+    def add_event_detect(self, event, callback):
+        self.callback = callback
+
+    def edge(self, state):
+        self.state = state
+        self.callback(self.pin)
+
+
+def test_slow_handler_does_not_hold_up_edges():
+    switch, emitting, release, events = FakeSwitch(), threading.Event(), threading.Event(), list()
+
+    def emit(event, timestamp):
+        events.append(event)
+        emitting.set()
+        release.wait(2)
+
+    processor = InputProcessor(debounce=0.01)
+    processor.add(switch, emit)
+    processor.start()
+    try:
+        switch.edge(1)
+        time.sleep(0.05)
+        switch.edge(0)
+        assert emitting.wait(2)
+        # The input thread is inside the handler, edges must still be taken at once
+        start = time.monotonic()
+        switch.edge(1)
+        assert time.monotonic() - start < 0.05
+        release.set()
+        assert wait_for(lambda: processor.stats['edges'] == 3)
+    finally:
+        release.set()
+        processor.stop()
+    assert events == ['press']
+
+
+def test_debounce_follows_the_clock():
+    clock, events = VirtualClock(0), list()
+    switch = FakeSwitch()
+    processor = InputProcessor(clock=clock, debounce=0.02)
+    processor.add(switch, lambda event, timestamp: events.append((event, timestamp)))
+    processor.start()
+    try:
+        switch.edge(1)
+        time.sleep(0.05)
+        clock.advance(0.05)
+        time.sleep(0.05)
+        switch.edge(0)
+        # Real time passes but the clock stands still, the release hasn't settled
+        time.sleep(0.1)
+        assert events == list()
+        clock.advance(0.05)
+        assert wait_for(lambda: events)
+    finally:
+        processor.stop()
+    assert events == [('press', 0.05)]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+from kegwasher.clock import VirtualClock
+from kegwasher.journal import Journal
+from kegwasher.programs import compile_program
+
+
+def test_progress_is_synced_on_the_station_clock(tmp_path):
+    clock = VirtualClock(0)
+    program = compile_program('t', {'display_name': 'T', 'operations': [['drain', 60]]}, {'drain': lambda: None})
+    journal = Journal(path=str(tmp_path / 'station.journal'), sync_interval=10, clock=clock)
+    journal.begin(program)
+    journal.step(0, 'drain')
+    synced = journal.stats['syncs']
+    for elapsed in range(1, 10):
+        clock.advance(1)
+        journal.progress(0, elapsed)
+    # Nine seconds of clock time, however long it took for real, is short of the interval
+    assert journal.stats == {'syncs': synced, 'pending': 9}
+    clock.advance(1)
+    journal.progress(0, 10)
+    assert journal.stats == {'syncs': synced + 1, 'pending': 0}
+    journal.close()
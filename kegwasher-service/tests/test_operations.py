@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import copy
+
+from kegwasher.config import pin_config
+from kegwasher.simulation import simulation
+
+
+def test_operation_names_matching_attributes_are_transitions(make_stations):
+    config = copy.deepcopy(pin_config)
+    config['operations'] = {'all_off_closed': {}, 'drain': {'valves': ['waste_out']},
+                            'resources': {'valves': ['air_in']}, 'transition': {'valves': ['water_in']},
+                            'current': {'pumps': ['pump_1']}}
+    operations = make_stations(config, {'t': {'display_name': 'T', 'operations': [['drain', 1]]}}) \
+        .stations['kegwasher']._operations
+    handlers = operations.operation_map
+    assert handlers['drain'] == operations.drain
+    for name, (kind, device) in [('resources', ('valves', 'air_in')), ('transition', ('valves', 'water_in')),
+                                 ('current', ('pumps', 'pump_1'))]:
+        handlers[name]()
+        assert operations.current == name
+        assert operations._hardware[kind][device].value == 1
+
+
+def test_transition_writes_only_what_differs(make_stations):
+    operations = make_stations().stations['kegwasher']._operations
+    expander = operations._hardware['expanders']['expander0'].GPIO
+    operations.transition('rinse')
+    writes = list()
+    expander.add_output_listener(lambda expander, value: writes.append(value))
+    # Already there, the bus isn't touched
+    before = simulation.io[(1, 0x20)]['writes']
+    operations.transition('rinse')
+    assert writes == list() and simulation.io[(1, 0x20)]['writes'] == before
+    # rinse to sanitize swaps water_in (pin 3) for sanitizer_in (pin 2) in one port write
+    rinse = expander.outputvalue
+    operations.transition('sanitize')
+    assert len(writes) == 1 and simulation.io[(1, 0x20)]['writes'] == before + 1
+    assert writes[0] ^ rinse == (1 << 3) | (1 << 2)
+    valves = operations._hardware['valves']
+    assert valves['sanitizer_in'].value == 1 and valves['water_in'].value == 0 and valves['pump_in'].value == 1
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+from kegwasher.config import mode_config, service_config
+from kegwasher.operations import Operations
+from kegwasher.optimizer import optimize_modes, optimize_program
+
+devices = Operations.operation_devices
+resume_rules = service_config['journal']['resume']
+
+
+def _timeline(steps):
+    # [(devices left on, seconds)] with adjacent spans of the same devices joined, what the hardware sees
+    timeline = list()
+    for operation, seconds in steps:
+        on = frozenset((kind, name) for kind, names in devices[operation].items() for name in names)
+        if timeline and timeline[-1][0] == on:
+            timeline[-1] = (on, timeline[-1][1] + seconds)
+        elif seconds:
+            timeline.append((on, seconds))
+    return timeline
+
+
+def test_default_modes_keep_their_device_timeline():
+    optimized, reports = optimize_modes(mode_config, devices, resume_rules=resume_rules)
+    for name, mode in mode_config.items():
+        assert _timeline(optimized[name]['operations']) == _timeline(mode['operations']), name
+    assert [(report.name, report.steps, report.optimized_steps, report.seconds, report.optimized_seconds)
+            for report in reports] == [
+        ('clean', 16, 14, 1030, 1030), ('deep_clean', 23, 21, 1500, 1500), ('sanitize', 8, 8, 230, 230),
+        ('rinse_empty', 6, 5, 440, 440), ('sanitizer_fill', 1, 1, 10, 10), ('cleaner_fill', 1, 1, 10, 10),
+        ('self_test', 10, 10, 50, 50)]
+
+
+def test_only_steps_driving_the_same_devices_merge():
+    optimized = optimize_modes(mode_config, devices, resume_rules=resume_rules)[0]
+    # air_fill_open and drain open the same valves; co2_fill_closed shuts waste_out, so it stays its own step
+    assert optimized['clean']['operations'] == [
+        ('air_fill_open', 30), ('rinse', 300), ('drain', 40), ('clean_open', 30), ('clean_closed', 300),
+        ('drain', 40), ('rinse', 60), ('co2_fill_open', 10), ('drain', 30), ('sanitize', 120), ('co2_fill_open', 10),
+        ('drain', 30), ('co2_fill_open', 5), ('co2_fill_closed', 25)]
+    assert optimized['rinse_empty']['operations'] == [
+        ('air_fill_open', 30), ('air_fill_closed', 10), ('drain', 30), ('rinse', 300), ('drain', 70)]
+    assert optimized['sanitize']['operations'] == [tuple(step) for step in mode_config['sanitize']['operations']]
+
+
+def test_zero_second_steps_drop_and_resume_rules_keep_steps_apart():
+    steps, changes = optimize_program([('rinse', 10), ('co2_fill_open', 0), ('air_fill_open', 5), ('drain', 20)],
+                                      devices, resume_rules)
+    assert steps == [('rinse', 10), ('drain', 25)]
+    assert [(change.kind, change.index) for change in changes] == [('drop', 1), ('merge', 2)]
+    # A step that resumes differently after a power loss isn't folded into its neighbour
+    steps = optimize_program([('air_fill_open', 5), ('drain', 20)], devices, {'drain': 'restart'})[0]
+    assert steps == [('air_fill_open', 5), ('drain', 20)]
+
+
+def test_minimum_cycle_follows_the_dwell_rules():
+    modes = {'test': {'display_name': 'Test', 'operations': [['rinse', 60], ['air_fill_open', 10], ['drain', 30],
+                                                             ['co2_fill_closed', 2]]}}
+    report = optimize_modes(modes, devices, {'default': 5, 'drain': 20, 'co2_fill_closed': 4}, resume_rules, 1)[1][0]
+    # rinse 5, merged air_fill_open + drain the longer rule 20, co2_fill_closed 4, plus 1 per step change
+    assert report.minimum_seconds == 5 + 20 + 4 + 3
+    assert report.seconds == 102 + 4 and report.optimized_seconds == 102 + 3
+    assert report.violations == [(2, 'co2_fill_closed', 2, 4)]
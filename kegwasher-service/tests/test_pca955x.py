@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import threading
+
+import pytest
+
+from kegwasher.backend import GPIO
+from kegwasher.pca955x import pca955x
+from kegwasher.simulation import simulation
+
+from conftest import wait_for
+
+
+@pytest.fixture
+def expander():
+    simulation.reset()
+    expander = pca955x(address=0x20, bus=1, gpios=16)
+    for pin in range(8):
+        expander.setup(pin, GPIO.OUT)
+    return expander, simulation.device(1, 0x20)
+
+
+def _outputs(chip):
+    registers = chip.registers
+    return registers[2] | (registers[3] << 8)
+
+
+def test_failed_write_is_rewritten(expander):
+    expander, chip = expander
+    write = chip.write
+
+    def fail(register, value):
+        raise OSError(121, 'Remote I/O error')
+
+    chip.write = fail
+    with pytest.raises(OSError):
+        expander.output(0, 0)
+    chip.write = write
+    assert _outputs(chip) & 1
+    # The shadow says off, the next access puts the chip right
+    expander.input(9)
+    assert not _outputs(chip) & 1
+    assert _outputs(chip) == expander.outputvalue
+
+
+def test_verify_reads_the_chip_without_the_lock(expander):
+    expander, chip = expander
+    read, reading, release = chip.read, threading.Event(), threading.Event()
+
+    def slow(register):
+        reading.set()
+        release.wait(2)
+        return read(register)
+
+    chip.read = slow
+    verifying = threading.Thread(target=expander.verify)
+    verifying.start()
+    try:
+        assert reading.wait(2)
+        # The bus is busy with the read-back, but pin changes can be decided and queued meanwhile
+        assert expander._lock.acquire(timeout=0.5)
+        expander._lock.release()
+    finally:
+        release.set()
+        verifying.join()
+    chip.read = read
+    expander.output(1, 0)
+    assert not _outputs(chip) & 2
+    assert expander.verify() == dict()
+
+
+def test_urgent_write_is_not_overtaken_by_a_stale_routine_write(expander):
+    expander, chip = expander
+    expander.output_mask(0xff, 0)
+    read, reading, release = chip.read, threading.Event(), threading.Event()
+
+    def slow(register):
+        if not reading.is_set():
+            reading.set()
+            release.wait(2)
+        return read(register)
+
+    chip.read = slow
+    threads = [threading.Thread(target=expander.input, args=(9,))]
+    threads[0].start()
+    try:
+        assert reading.wait(2)
+        # Behind the read holding the bus: a routine write turning every output on, then another read
+        for target in [lambda: expander.output_mask(0xff, 0xff), lambda: expander.input(9)]:
+            threads.append(threading.Thread(target=target))
+            threads[-1].start()
+            assert wait_for(lambda: len(expander.i2c._queue) == len(threads) - 1)
+
+        def abort():
+            with expander.transaction(urgent=True):
+                expander.output_mask(0xff, 0)
+
+        threads.append(threading.Thread(target=abort))
+        threads[-1].start()
+        assert wait_for(lambda: expander.outputvalue & 0xff == 0)
+    finally:
+        release.set()
+        for thread in threads:
+            thread.join()
+    chip.read = read
+    assert _outputs(chip) & 0xff == 0
+    assert _outputs(chip) == expander.outputvalue
+
+
+def test_nested_transaction_commits_once_on_the_outermost_exit(expander):
+    expander, chip = expander
+    expander.output_mask(0xff, 0)
+    writes = simulation.io[(1, 0x20)]['writes']
+    with expander.transaction():
+        expander.output(0, 1)
+        with expander.transaction():
+            expander.output(1, 1)
+            expander.output(2, 1)
+        # The inner block's changes wait for the outer one
+        assert simulation.io[(1, 0x20)]['writes'] == writes
+        expander.output(2, 0)
+    assert simulation.io[(1, 0x20)]['writes'] == writes + 1
+    assert _outputs(chip) & 0xff == 0b011
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+from kegwasher.journal import resume_point
+from kegwasher.programs import compile_program, compile_programs
+
+operation_map = {'rinse': object(), 'drain': object(), 'all_off_closed': object()}
+mode = {'display_name': 'Test', 'operations': [['rinse', 30], ['all_off_closed', 0], ['drain', 10], ['rinse', 60]]}
+
+
+def test_progress_at_step_boundaries():
+    program = compile_program('test', mode, operation_map)
+    assert [step.start for step in program.steps] == [0, 30, 30, 40] and program.total == 100
+    # A step starting and the one before it ending are the same point of the program
+    for index, step in enumerate(program.steps):
+        assert program.remaining(index, step.seconds) == 100 - step.start
+        assert program.percent(index, step.seconds) == step.start
+        if index:
+            assert program.remaining(index - 1, 0) == program.remaining(index, step.seconds)
+    assert program.remaining(3, 0) == 0 and program.percent(3, 0) == 100
+    assert program.remaining(3, 15) == 15 and program.percent(3, 15) == 85
+
+
+def test_progress_on_resume():
+    program = compile_program('test', mode, operation_map)
+    # Unchanged on reload, a resumed run keeps the program it started with
+    assert compile_programs({'test': mode}, operation_map, {'test': program})[0] is program
+    # Cut off 4 seconds into drain: continue picks up the 6 seconds left, restart runs drain again
+    step, remaining = resume_point(program, 2, 4, {'drain': 'continue'})
+    assert (step, remaining) == (2, 6)
+    assert program.remaining(step, remaining) == 66 and program.percent(step, remaining) == 34
+    step, remaining = resume_point(program, 2, 4, {'drain': 'restart'})
+    assert program.remaining(step, remaining) == 70 and program.percent(step, remaining) == 30
+    # A rewind to the 0 second step before drain lands on the same point as the start of drain
+    step, remaining = resume_point(program, 2, 4, {'drain': 'rewind'})
+    assert (step, remaining) == (1, 0) and program.remaining(step, remaining) == 70
+
+
+def test_empty_program_is_complete():
+    program = compile_program('fill', {'display_name': 'Fill', 'operations': [['drain', 0]]}, operation_map)
+    assert program.total == 0 and program.percent(0, 0) == 100 and program.remaining(0, 0) == 0
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import time
+
+from kegwasher import benchmark, metrics
+
+from conftest import wait_for
+
+
+def test_idle_station_does_not_wake(make_stations):
+    washer = make_stations().stations['kegwasher']
+    time.sleep(0.2)
+    wakeups = washer.stats['loop_wakeups']
+    time.sleep(1)
+    assert washer.stats['loop_wakeups'] - wakeups == 0
+
+
+def test_idle_benchmark_flags_wakeups():
+    baseline = {'idle': {'cpu_seconds_per_second': 0.00005, 'loop_wakeups_per_second': 0.0}}
+    quiet = {'idle': {'cpu_seconds_per_second': 0.0001, 'loop_wakeups_per_second': 0.0}}
+    busy = {'idle': {'cpu_seconds_per_second': 0.02, 'loop_wakeups_per_second': 2.0}}
+    assert benchmark.compare(baseline, quiet) == dict()
+    assert set(benchmark.compare(baseline, busy)) == {'idle.cpu_seconds_per_second', 'idle.loop_wakeups_per_second'}
+
+
+def test_step_seconds_leave_out_pauses(make_stations):
+    washer = make_stations(modes={'t': {'display_name': 'T', 'operations': [['co2_fill_open', 4]]}}) \
+        .stations['kegwasher']
+    series = metrics.step_seconds.labels('kegwasher', 'co2_fill_open')
+    count, total = series.count, series.sum
+    washer.start_mode('t')
+    assert wait_for(lambda: washer.snapshot.status == 'executing' and washer.snapshot.program is not None)
+    washer.pause_mode()
+    assert wait_for(lambda: washer.snapshot.status == 'paused')
+    # 10 seconds paused on the 50x clock
+    time.sleep(0.2)
+    washer.resume_mode()
+    assert wait_for(lambda: washer.snapshot.status == 'execute_complete')
+    assert series.count == count + 1
+    assert 4 <= series.sum - total < 5
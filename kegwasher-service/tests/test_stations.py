@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+from kegwasher.benchmark import _station_config
+
+from conftest import wait_for
+
+
+def test_paused_station_gives_up_shared_utilities(make_stations):
+    modes = {'long_rinse': {'display_name': 'Long Rinse', 'operations': [['rinse', 600]]},
+             'short_rinse': {'display_name': 'Short Rinse', 'operations': [['rinse', 2]]}}
+    limits = {'limits': {'heaters': 1, 'pumps': 1}, 'max_bypass': 4}
+    stations = make_stations({'stations': [_station_config(0), _station_config(1)]}, modes, resources=limits)
+    a, b = stations.stations['station_1'], stations.stations['station_2']
+    a.start_mode('long_rinse')
+    assert wait_for(lambda: a.snapshot.status == 'executing' and a.snapshot.program is not None)
+    a.pause_mode()
+    assert wait_for(lambda: a.snapshot.status == 'paused')
+    # Station B gets the heater and pump while A is paused and runs its program to the end
+    b.start_mode('short_rinse')
+    assert wait_for(lambda: b.snapshot.status == 'execute_complete')
+    # A takes them back on resume and carries on
+    a.resume_mode()
+    assert wait_for(lambda: a.snapshot.status == 'executing')
+    assert wait_for(lambda: dict((name, value) for kind, name, value in a.snapshot.devices)['pump_1'] == 1)
+    a.abort_mode()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import csv
+import io
+
+from kegwasher.clock import VirtualClock
+from kegwasher.telemetry import Telemetry
+
+
+class FakeDevice(object):
+    def __init__(self):
+        self.expander = None
+        self.telemetry = None
+        self.value = 0
+
+
+def _telemetry(capacity=16):
+    # Valves a and b then pump p, bits 0, 1 and 2; recording from time 0 with everything off
+    clock = VirtualClock(0)
+    hardware = {'valves': {'a': FakeDevice(), 'b': FakeDevice()}, 'pumps': {'p': FakeDevice()}}
+    telemetry = Telemetry(capacity=capacity, clock=clock, hardware=hardware, station='test')
+    telemetry.attach()
+    return telemetry, clock, hardware
+
+
+def test_ring_overwrites_the_oldest_entries():
+    telemetry, clock, hardware = _telemetry(capacity=4)
+    memory = telemetry.memory
+    assert memory == 4 * telemetry.entry_size == 64
+    for second in range(1, 7):
+        clock.advance(1)
+        telemetry.record(hardware['valves']['a'], second % 2)
+    assert len(telemetry) == 4
+    assert telemetry.query() == [(3, 1), (4, 0), (5, 1), (6, 0)]
+    assert telemetry.memory == memory
+    assert len(telemetry._times) == 4 and len(telemetry._masks) == 4
+    # Switching to the state already recorded costs nothing
+    telemetry.record(hardware['valves']['a'], 0)
+    assert len(telemetry.query(6)) == 1
+
+
+def test_query_is_led_by_the_state_at_start():
+    telemetry, clock, hardware = _telemetry()
+    for device, value in [('a', 1), ('b', 1), ('a', 0)]:
+        clock.advance(1)
+        telemetry.record(hardware['valves'][device], value)
+    assert telemetry.query() == [(0, 0), (1, 1), (2, 3), (3, 2)]
+    assert telemetry.query(1.5, 2.5) == [(1.5, 1), (2, 3)]
+    assert telemetry.query(2, 2) == [(2, 3)]
+    assert telemetry.query(None, 1) == [(0, 0), (1, 1)]
+    assert telemetry.query(10) == [(10, 2)]
+    assert telemetry.state_at(2.5) == {'valves': {'a': 1, 'b': 1}, 'pumps': {'p': 0}, 'heaters': dict()}
+    assert telemetry.state_at(-1) is None
+
+
+def test_csv_export_downsamples_to_the_share_of_each_interval():
+    telemetry, clock, hardware = _telemetry()
+    clock.advance(0.25)
+    telemetry.record(hardware['valves']['a'], 1)
+    clock.advance(0.5)
+    telemetry.record(hardware['valves']['a'], 0)
+    clock.advance(0.5)
+    telemetry.record(hardware['pumps']['p'], 1)
+    output = io.StringIO()
+    assert telemetry.export_csv(output, start=0, end=2, interval=1) == 2
+    rows = list(csv.reader(io.StringIO(output.getvalue())))
+    assert rows[0] == ['time', 'monotonic', 'valves.a', 'valves.b', 'pumps.p']
+    assert [row[1:] for row in rows[1:]] == [['0.000', '0.5', '0.0', '0.0'], ['1.000', '0.0', '0.0', '0.75']]
+    # Without an interval, a row per state change
+    output = io.StringIO()
+    assert telemetry.export_csv(output, start=0, end=2) == 4
+    rows = list(csv.reader(io.StringIO(output.getvalue())))
+    assert [row[1:] for row in rows[1:]] == [['0.000', '0', '0', '0'], ['0.250', '1', '0', '0'],
+                                             ['0.750', '0', '0', '0'], ['1.250', '0', '0', '1']]
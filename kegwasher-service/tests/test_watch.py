@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2020 Kyle Hultman <khultman@gmail.com>
+
+import select
+import threading
+import time
+
+from kegwasher import watch
+
+from conftest import wait_for
+
+
+class CountingSelect(object):
+    def __init__(self):
+        self.calls = 0
+
+    def select(self, *args):
+        self.calls += 1
+        return select.select(*args)
+
+
+def test_watcher_sleeps_until_a_change(tmp_path, monkeypatch):
+    counting = CountingSelect()
+    monkeypatch.setattr(watch, 'select', counting)
+    path = tmp_path / 'modes.json'
+    path.write_text('{}')
+    changed = threading.Event()
+    watcher = watch.FileWatcher(path=str(path), callback=lambda path: changed.set())
+    watcher.start()
+    try:
+        assert wait_for(lambda: counting.calls)
+        time.sleep(1.2)
+        # One wait for the first event, no wakeups while nothing happens
+        assert counting.calls == 1
+        path.write_text('{"changed": true}')
+        assert changed.wait(2)
+    finally:
+        start = time.monotonic()
+        watcher.stop()
+    assert time.monotonic() - start < 0.5